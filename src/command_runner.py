@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import signal
+import selectors
+import subprocess
+import tracing
+
+# bytes kept of each output stream, half from the start and half from the end
+MAX_OUTPUT = 1024 * 1024
+# seconds between SIGTERM and SIGKILL of a timed out process group
+KILL_GRACE = 5
+
+# jsonl file that gets one timing record per command, see set_command_log
+command_log = None
+# time.monotonic() after which no command may run, see set_deadline
+deadline = None
+# process groups of the commands running in this process
+running_groups = set()
+
+
+def set_command_log(path):
+    global command_log
+    command_log = path
+
+
+def set_deadline(seconds):
+    """Clip the timeout of every following command so that none runs longer
+    than seconds from now, None removes the deadline"""
+    global deadline
+    deadline = None if seconds is None else time.monotonic() + seconds
+
+
+def clip_timeout(timeout):
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def past_deadline():
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def kill_running():
+    for pgid in list(running_groups):
+        kill_group(pgid, signal.SIGKILL)
+
+
+class BoundedBuffer:
+    """Keeps the first and last limit / 2 bytes of a stream, optionally
+    writing the whole stream to a file"""
+
+    def __init__(self, limit, path=None):
+        self.limit = limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+        self.file = open(path, 'wb') if path is not None else None
+
+    def write(self, data):
+        if self.file is not None:
+            self.file.write(data)
+        room = self.limit // 2 - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        self.tail += data
+        if len(self.tail) > self.limit // 2:
+            excess = len(self.tail) - self.limit // 2
+            self.dropped += excess
+            del self.tail[:excess]
+
+    def getvalue(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        data = bytes(self.head)
+        if self.dropped > 0:
+            data += ('\n... ' + str(self.dropped) + ' bytes dropped ...\n').encode('utf-8')
+        return (data + bytes(self.tail)).decode('utf-8', errors='replace')
+
+
+class CommandResult:
+
+    def __init__(self, cmd, cwd, out, err, returncode, timed_out, wall_time, cpu_time):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.out = out
+        self.err = err
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+
+    def to_dict(self):
+        return {
+            'cmd': self.cmd,
+            'cwd': self.cwd,
+            'returncode': self.returncode,
+            'timed_out': self.timed_out,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+        }
+
+
+def kill_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def wait_process(p, timeout):
+    """Wait for p without polling and kill what is left of its process group
+
+    Returns (exited, rusage), rusage covers the command and the processes
+    it waited for. It is None where pidfd_open is not available.
+    """
+    if hasattr(os, 'pidfd_open'):
+        pidfd = os.pidfd_open(p.pid)
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(pidfd, selectors.EVENT_READ)
+                if not selector.select(timeout):
+                    return False, None
+        finally:
+            os.close(pidfd)
+        # the unreaped leader keeps the group id from being reused
+        kill_group(p.pid, signal.SIGKILL)
+        _, status, rusage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        return True, rusage
+    try:
+        p.wait(timeout)
+    except subprocess.TimeoutExpired:
+        return False, None
+    kill_group(p.pid, signal.SIGKILL)
+    return True, None
+
+
+def run_command(cmd, timeout=300, cwd=None, max_output=MAX_OUTPUT, out_path=None, err_path=None):
+    """Run cmd in its own process group and wait for it without polling
+
+    Output is read as it arrives into bounded buffers, the full streams go
+    to out_path and err_path when given. On timeout the whole process group
+    (e.g. defects4j, ant and the test JVM) is terminated, and killed if it
+    does not exit within KILL_GRACE seconds. Processes the command leaves
+    behind in its group are killed as well. The timeout is clipped to the
+    deadline of the process, a command past it does not start.
+    """
+    start = time.monotonic()
+    timeout = clip_timeout(timeout)
+    if timeout is not None and timeout <= 0:
+        result = CommandResult(cmd, cwd, '', '', None, True, 0.0, 0.0)
+        log_command(result)
+        return result
+    p = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, start_new_session=True)
+    running_groups.add(p.pid)
+    try:
+        result = wait_command(p, cmd, cwd, start, timeout, max_output, out_path, err_path)
+    finally:
+        running_groups.discard(p.pid)
+    log_command(result)
+    return result
+
+
+def wait_command(p, cmd, cwd, start, timeout, max_output, out_path, err_path):
+    buffers = {p.stdout.fileno(): BoundedBuffer(max_output, out_path),
+               p.stderr.fileno(): BoundedBuffer(max_output, err_path)}
+    open_streams = len(buffers)
+    deadline = None if timeout is None else start + timeout
+    # readable once the command exits, leftover processes may still hold its output open
+    pidfd = os.pidfd_open(p.pid) if hasattr(os, 'pidfd_open') else None
+    exited = False
+    timed_out = False
+    with selectors.DefaultSelector() as selector:
+        for fd in buffers:
+            selector.register(fd, selectors.EVENT_READ)
+        if pidfd is not None:
+            selector.register(pidfd, selectors.EVENT_READ)
+        while open_streams > 0:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                timed_out = not exited
+                break
+            for key, _ in selector.select(remaining):
+                if key.fd == pidfd:
+                    exited = True
+                    selector.unregister(pidfd)
+                    # only drain what is left for a moment
+                    drain_deadline = time.monotonic() + 1
+                    deadline = drain_deadline if deadline is None else min(deadline, drain_deadline)
+                    continue
+                data = os.read(key.fd, 65536)
+                if data:
+                    buffers[key.fd].write(data)
+                else:
+                    selector.unregister(key.fd)
+                    open_streams -= 1
+    if pidfd is not None:
+        os.close(pidfd)
+    if timed_out:
+        kill_group(p.pid, signal.SIGTERM)
+        exited, rusage = wait_process(p, KILL_GRACE)
+    else:
+        remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+        exited, rusage = wait_process(p, remaining)
+        # output closed but the process hangs
+        timed_out = not exited
+    if not exited:
+        kill_group(p.pid, signal.SIGKILL)
+        exited, rusage = wait_process(p, None)
+    p.stdout.close()
+    p.stderr.close()
+    out, err = [buffer.getvalue() for buffer in buffers.values()]
+    result = CommandResult(
+        cmd, cwd, out, err, p.returncode, timed_out, time.monotonic() - start,
+        None if rusage is None else rusage.ru_utime + rusage.ru_stime
+    )
+    return result
+
+
+def command_name(cmd):
+    """Program and, for defects4j and git, subcommand of cmd"""
+    name = os.path.basename(cmd[0])
+    if name in ('defects4j', 'git') and len(cmd) > 1:
+        name += ' ' + cmd[1]
+    return name
+
+
+def log_command(result):
+    tracing.event('command', time.time() - result.wall_time, result.wall_time,
+                  'timeout' if result.timed_out else result.returncode,
+                  cmd=command_name(result.cmd), cpu_time=result.cpu_time)
+    if command_log is None:
+        return
+    with open(command_log, 'a') as f:
+        f.write(json.dumps(result.to_dict()) + '\n')
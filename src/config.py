@@ -15,10 +15,42 @@ class App:
     "MAX_NUM_CODEX_CODE_SUGGESTIONS" : 10,
     "TESTS" : 'trigger',
     "PATCH_GRANULARITY" : 'line',
-    "OUTPUT_DIR" : ""
+    "OUTPUT_DIR" : "",
+    "CONCURRENCY" : 1,
+    "REQUESTS_PER_MINUTE" : 20,
+    "TOKENS_PER_MINUTE" : 40000,
+    "MAX_BACKOFF" : 60.0,
+    "WORKSPACE_POOL" : False,
+    "WORKERS" : None,
+    "PATCH_WORKERS" : 1,
+    "BASELINE_DIR" : "",
+    "REFRESH_BASELINE" : False,
+    "BATCH_TESTS" : False,
+    "BATCH_RELEVANT" : False,
+    "TEST_DAEMON" : False,
+    "VERDICT_CACHE" : "",
+    "REUSE_VERDICTS" : True,
+    "PRESCREEN" : True,
+    "BUG_TIMEOUT" : 3600,
+    "STOP_POLICY" : 'none',
+    "STOP_PLAUSIBLE" : 1,
+    "STOP_K" : [1, 5, 20, 100],
+    "QUEUE_LEASE" : 300,
+    "QUEUE_ATTEMPTS" : 3,
+    "FAIL_FAST" : True,
+    "TEST_HISTORY" : "",
+    "COVERAGE_AUDIT" : 10,
+    "TIMEOUT_MULTIPLIER" : 5,
+    "TIMEOUT_FLOOR" : 60
 
   }
-  __setters = ["TEMP", "MAX_TOKENS", "TOP_P", "CODEX_ENGINE", "NUM_CODEX_RETRIES", "MAX_NUM_CODEX_CODE_SUGGESTIONS", "TESTS", "PATCH_GRANULARITY", "TMP_DIR", "OUTPUT_DIR"]
+  __setters = ["TEMP", "MAX_TOKENS", "TOP_P", "CODEX_ENGINE", "NUM_CODEX_RETRIES", "MAX_NUM_CODEX_CODE_SUGGESTIONS", "TESTS", "PATCH_GRANULARITY", "TMP_DIR", "OUTPUT_DIR",
+               "CONCURRENCY", "REQUESTS_PER_MINUTE", "TOKENS_PER_MINUTE", "MAX_BACKOFF", "WORKSPACE_POOL",
+               "WORKERS", "PATCH_WORKERS", "BASELINE_DIR", "REFRESH_BASELINE",
+               "BATCH_TESTS", "BATCH_RELEVANT", "TEST_DAEMON", "VERDICT_CACHE", "REUSE_VERDICTS",
+               "PRESCREEN", "BUG_TIMEOUT", "STOP_POLICY", "STOP_PLAUSIBLE", "STOP_K",
+               "QUEUE_LEASE", "QUEUE_ATTEMPTS", "FAIL_FAST", "TEST_HISTORY",
+               "COVERAGE_AUDIT", "TIMEOUT_MULTIPLIER", "TIMEOUT_FLOOR"]
 
   @staticmethod
   def config(name):
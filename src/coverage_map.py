@@ -0,0 +1,133 @@
+import os
+import re
+import json
+import xml.etree.ElementTree as ET
+
+# written by defects4j coverage into the working directory
+COVERAGE_XML = 'coverage.xml'
+# files of a coverage run removed afterwards, so they do not end up in the next run
+COVERAGE_OUTPUTS = [COVERAGE_XML, 'cobertura.ser', 'summary.csv']
+# JUnit 4 methods annotated with @Test and JUnit 3 methods named test*
+TEST_METHOD = re.compile(r'@Test\b(?:\s*\([^)]*\))?(?:\s+@\w+(?:\([^)]*\))?)*\s+(?:public\s+)?(?:final\s+)?void\s+(\w+)\s*\('
+                         r'|\bpublic\s+(?:final\s+)?void\s+(test\w*)\s*\(\s*\)')
+COMMENT = re.compile(r'/\*.*?\*/|//[^\n]*', re.DOTALL)
+
+
+def source_class(src_dir, path):
+    """Fully qualified name of the class in source file path of the checkout"""
+    rel_path = os.path.relpath(path, src_dir)
+    return rel_path[:-len('.java')].replace(os.sep, '.')
+
+
+def instrumented_classes(bin_dir, class_name):
+    """class_name and its nested and anonymous classes compiled into bin_dir"""
+    names = [class_name]
+    package_dir = os.path.join(bin_dir, *class_name.split('.')[:-1])
+    prefix = class_name.split('.')[-1] + '$'
+    if os.path.isdir(package_dir):
+        for name in sorted(os.listdir(package_dir)):
+            if name.startswith(prefix) and name.endswith('.class'):
+                names.append(class_name + name[len(prefix) - 1:-len('.class')])
+    return names
+
+
+def test_methods(test_src_dir, test_class):
+    """Test methods declared in the source of test_class, in their order.
+    Inherited test methods are not found, so a class without any is not
+    covered method by method"""
+    source = os.path.join(test_src_dir, *test_class.split('.')) + '.java'
+    if not os.path.exists(source):
+        return []
+    with open(source, 'r', errors='replace') as f:
+        code = COMMENT.sub('', f.read())
+    methods = []
+    for match in TEST_METHOD.finditer(code):
+        method = match.group(1) or match.group(2)
+        if method not in methods:
+            methods.append(method)
+    return methods
+
+
+def covered_lines(xml_path, rel_path):
+    """Lines of source file rel_path (relative to its source dir) that ran at
+    least once, None if the report can not be read"""
+    lines = set()
+    try:
+        root = ET.parse(xml_path).getroot()
+    except ET.ParseError:
+        return None
+    for cls in root.iter('class'):
+        # inner classes are separate entries with the same file name
+        if cls.get('filename') != rel_path:
+            continue
+        for line in cls.iter('line'):
+            if int(line.get('hits', '0')) > 0:
+                lines.add(int(line.get('number')))
+    return lines
+
+
+def clear_outputs(project_dir):
+    for name in COVERAGE_OUTPUTS:
+        output = os.path.join(project_dir, name)
+        if os.path.exists(output):
+            os.remove(output)
+
+
+class CoverageMap:
+    """Lines of one patched file mapped to the relevant test classes that
+    execute them, on the unpatched checkout
+
+    Test classes whose coverage run failed or timed out are kept as
+    unknown and always selected.
+    """
+
+    def __init__(self, path, lines=None, unknown=None):
+        self.path = path
+        self.lines = lines if lines is not None else {}
+        self.unknown = unknown if unknown is not None else []
+
+    def add(self, test_class, lines):
+        for line in lines:
+            self.lines.setdefault(line, set()).add(test_class)
+
+    def covering(self, relevant_tests, start_loc, end_loc):
+        """relevant_tests that run any of lines start_loc to end_loc, in their order"""
+        selected = set(self.unknown)
+        for line in range(int(start_loc), int(end_loc) + 1):
+            selected.update(self.lines.get(line, ()))
+        return [test for test in relevant_tests if test in selected]
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'lines': {str(line): sorted(tests) for line, tests in sorted(self.lines.items())},
+            'unknown': self.unknown,
+        }
+
+    @staticmethod
+    def from_dict(d):
+        lines = {int(line): set(tests) for line, tests in d['lines'].items()}
+        return CoverageMap(d['path'], lines, d['unknown'])
+
+
+def load_coverage(coverage_file, path):
+    if not os.path.exists(coverage_file):
+        return None
+    with open(coverage_file, 'r') as f:
+        maps = json.load(f)
+    if path not in maps:
+        return None
+    return CoverageMap.from_dict(maps[path])
+
+
+def store_coverage(coverage_file, coverage_map):
+    """Add the map of one file to the coverage file of its bug"""
+    maps = {}
+    if os.path.exists(coverage_file):
+        with open(coverage_file, 'r') as f:
+            maps = json.load(f)
+    maps[coverage_map.path] = coverage_map.to_dict()
+    os.makedirs(os.path.dirname(os.path.abspath(coverage_file)), exist_ok=True)
+    with open(coverage_file + '.tmp', 'w') as f:
+        json.dump(maps, f, indent=2)
+    os.replace(coverage_file + '.tmp', coverage_file)
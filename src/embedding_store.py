@@ -0,0 +1,192 @@
+import os
+import json
+import argparse
+import numpy as np
+from tqdm import tqdm
+import patch_io
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', type=str, required=True,
+                        help='path prefix of the embedding store')
+    parser.add_argument('--import_json', type=str,
+                        help='json file whose embeddings are copied into the store')
+    parser.add_argument('--export_json', type=str,
+                        help='json file whose records get their embeddings back from the store')
+    parser.add_argument('--output', type=str,
+                        help='where to write the exported json, defaults to overwriting --export_json')
+    parser.add_argument('--kind', choices=['patches', 'dataset'], default='patches',
+                        help='patches: embeddings of generate_embeddings.py, dataset: the -cached.json of generate_patches.py')
+    parser.add_argument('--field', type=str, default='src_wo_comments_embed',
+                        help='embedding field of dataset records, src_wo_comments_embed or issue_embed')
+    return parser.parse_args()
+
+
+class EmbeddingStore:
+    """Append only float32 matrix on disk with a key to row index
+
+    <path>.f32 holds the rows back to back and is read through a read only
+    memmap, <path>.keys.jsonl holds one key per row and <path>.meta.json the
+    dimension. Rows are appended, a key added twice points to its last row.
+    """
+
+    def __init__(self, path):
+        self.vectors_path = path + '.f32'
+        self.keys_path = path + '.keys.jsonl'
+        self.meta_path = path + '.meta.json'
+        self.dim = None
+        self.keys = []
+        self.index = {}
+        self._matrix = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                self.dim = json.load(f)['dim']
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'r') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        self.keys.append(json.loads(line))
+            self.index = {key: row for row, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    @property
+    def matrix(self):
+        """All rows as a read only memmap, nothing is copied into memory"""
+        if self._matrix is None:
+            if len(self.keys) == 0:
+                return np.zeros((0, self.dim or 0), dtype=np.float32)
+            self._matrix = np.memmap(
+                self.vectors_path, dtype=np.float32, mode='r',
+                shape=(len(self.keys), self.dim)
+            )
+        return self._matrix
+
+    def vector(self, key):
+        return self.matrix[self.index[key]]
+
+    def rows(self, keys):
+        """Matrix of the given keys, a view when they are stored contiguously"""
+        idx = [self.index[key] for key in keys]
+        if len(idx) > 0 and idx == list(range(idx[0], idx[0] + len(idx))):
+            return self.matrix[idx[0]:idx[0] + len(idx)]
+        return self.matrix[idx]
+
+    def add(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(keys) == 0:
+            return
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            with open(self.meta_path, 'w') as f:
+                json.dump({'dim': self.dim}, f)
+        assert vectors.shape == (len(keys), self.dim), "Embedding dimension mismatch"
+        # drop rows of an interrupted append that never got their keys
+        if os.path.exists(self.vectors_path):
+            with open(self.vectors_path, 'rb+') as f:
+                f.truncate(len(self.keys) * self.dim * 4)
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.keys_path, 'a') as f:
+            for key in keys:
+                f.write(json.dumps(key) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        for key in keys:
+            self.index[key] = len(self.keys)
+            self.keys.append(key)
+        self._matrix = None
+
+
+def open_field_store(prefix, field):
+    """Store for one embedding field of the dataset, e.g. issue_embed"""
+    return EmbeddingStore(prefix + '-' + field)
+
+
+def patch_key(bug, position):
+    return bug + '#' + str(position)
+
+
+def cosine_similarities(a, b):
+    """Row wise cosine similarity of two equally shaped matrices"""
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    return np.einsum('ij,ij->i', a, b) / np.maximum(norms, 1e-12)
+
+
+def import_patch_embeddings(patches, store):
+    """Move patch embeddings of generate_embeddings.py output into store"""
+    for bug in tqdm(patches):
+        keys, vectors = [], []
+        for position, patch in enumerate(patches[bug]['patches']):
+            if 'embedding' in patch:
+                keys.append(patch_key(bug, position))
+                vectors.append(patch.pop('embedding'))
+        store.add(keys, vectors)
+    return patches
+
+
+def export_patch_embeddings(patches, store):
+    for bug in patches:
+        for position, patch in enumerate(patches[bug]['patches']):
+            key = patch_key(bug, position)
+            if key in store:
+                patch['embedding'] = store.vector(key).tolist()
+    return patches
+
+
+def import_dataset_embeddings(buggy_file, store, field):
+    """Move one embedding field of the dataset records into store"""
+    keys = [bid for bid in buggy_file if field in buggy_file[bid]]
+    store.add(keys, [buggy_file[bid].pop(field) for bid in keys])
+    return buggy_file
+
+
+def export_dataset_embeddings(buggy_file, store, field):
+    for bid in buggy_file:
+        if bid in store:
+            buggy_file[bid][field] = store.vector(bid).tolist()
+    return buggy_file
+
+
+if __name__ == '__main__':
+    args = parse_command_line_args()
+    if args.kind == 'patches':
+        store = EmbeddingStore(args.store)
+    else:
+        store = open_field_store(args.store, args.field)
+
+    if args.import_json is not None:
+        records = patch_io.load_patch_file(args.import_json)
+        if args.kind == 'patches':
+            import_patch_embeddings(records, store)
+        else:
+            import_dataset_embeddings(records, store, args.field)
+        print(f'Stored {len(store)} embeddings in {store.vectors_path}')
+        if args.output is not None:
+            # the json without its embeddings
+            with open(args.output, 'w') as f:
+                json.dump(records, f, indent=2)
+
+    if args.export_json is not None:
+        records = patch_io.load_patch_file(args.export_json)
+        if args.kind == 'patches':
+            export_patch_embeddings(records, store)
+        else:
+            export_dataset_embeddings(records, store, args.field)
+        output = args.output or args.export_json
+        if patch_io.is_jsonl(output):
+            open(output, 'w').close()
+            for bug in records:
+                patch_io.append_bug_record(output, bug, records[bug])
+        else:
+            with open(output, 'w') as f:
+                json.dump(records, f)
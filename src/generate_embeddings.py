@@ -10,15 +10,37 @@ import numpy as np
 import copy
 from tqdm import tqdm
 import time
+import sys
+import tiktoken
+import patch_io
+import embedding_store
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 
 
+EMBEDDING_ENCODING = "cl100k_base"
+# input limit of text-embedding-ada-002
+MAX_INPUT_TOKENS = 8191
+
+
 def parse_command_line_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input', type=str,
                         help='json file containing patches')
     parser.add_argument('--output', type=str,
                         help='output file to save embeddings')
+    parser.add_argument('--batched', action='store_true',
+                        help='embed unique patch texts in batched, concurrent requests and append results per bug')
+    parser.add_argument('--max_batch_inputs', type=int, default=2048,
+                        help='maximum number of texts per embedding request')
+    parser.add_argument('--max_batch_tokens', type=int, default=100000,
+                        help='maximum number of tokens per embedding request')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of embedding requests in flight')
+    parser.add_argument('--bugs_per_flush', type=int, default=20,
+                        help='number of bugs embedded between two appends to the output')
+    parser.add_argument('--embedding_store', type=str,
+                        help='with --batched, write embeddings to this binary store instead of the json records')
     return parser.parse_args()
 
 def setup():
@@ -30,6 +52,97 @@ def setup():
 def get_embedding(text: str, model="text-embedding-ada-002"):
     return openai.Embedding.create(input=[text], model=model)["data"][0]["embedding"]
 
+
+@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
+def get_embeddings(texts, model="text-embedding-ada-002"):
+    """Embed a batch of texts with one request, in input order"""
+    data = openai.Embedding.create(input=texts, model=model)["data"]
+    return [d["embedding"] for d in sorted(data, key=lambda d: d["index"])]
+
+
+def patch_text(patch, bug):
+    text = patch['patch']
+    if text is None:
+        text = "empty"
+        print("empty patch for " + bug)
+    return text
+
+
+def fit_to_model(text, encoding):
+    """Count the tokens of text, truncating it to the model's input limit"""
+    tokens = encoding.encode(text)
+    if len(tokens) > MAX_INPUT_TOKENS:
+        return encoding.decode(tokens[:MAX_INPUT_TOKENS]), MAX_INPUT_TOKENS
+    return text, len(tokens)
+
+
+def pack_batches(texts, encoding, max_inputs, max_tokens):
+    """Greedily pack texts into batches bounded by input count and token count"""
+    batches = []
+    batch, batch_tokens = [], 0
+    for text in texts:
+        fitted, num_tokens = fit_to_model(text, encoding)
+        if len(batch) > 0 and (len(batch) >= max_inputs or batch_tokens + num_tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append((text, fitted))
+        batch_tokens += num_tokens
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def embed_unique_texts(texts, embeddings, encoding, args):
+    """Fill embeddings for texts not embedded yet, one request per batch"""
+    missing = [text for text in dict.fromkeys(texts) if text not in embeddings]
+    batches = pack_batches(missing, encoding, args.max_batch_inputs, args.max_batch_tokens)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(get_embeddings, [fitted for _, fitted in batch]): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            for (text, _), embedding in zip(futures[future], future.result()):
+                embeddings[text] = embedding
+    return len(missing), len(batches)
+
+
+def generate_embeddings_batched(patches, output, args):
+    """Embed all patches, collapsing identical texts, and append finished bugs to a jsonl file"""
+    encoding = tiktoken.get_encoding(EMBEDDING_ENCODING)
+    records_file = output if patch_io.is_jsonl(output) else os.path.splitext(output)[0] + '.jsonl'
+    completed = patch_io.load_completed_patches(records_file)
+    bugs = [bug for bug in patches if bug not in completed]
+    print(f'Skipping {len(completed)} bugs already in {records_file}')
+    store = None
+    if args.embedding_store is not None:
+        store = embedding_store.EmbeddingStore(args.embedding_store)
+    embeddings = {}
+    for start in tqdm(range(0, len(bugs), args.bugs_per_flush)):
+        group = bugs[start:start + args.bugs_per_flush]
+        texts = [patch_text(patch, bug) for bug in group for patch in patches[bug]['patches']]
+        try:
+            num_texts, num_batches = embed_unique_texts(texts, embeddings, encoding, args)
+        except Exception as e:
+            print(e)
+            continue
+        print(f'Embedded {num_texts} unique texts out of {len(texts)} patches in {num_batches} requests')
+        for bug in group:
+            if store is not None:
+                bug_patches = patches[bug]['patches']
+                store.add(
+                    [embedding_store.patch_key(bug, position) for position in range(len(bug_patches))],
+                    [embeddings[patch_text(patch, bug)] for patch in bug_patches]
+                )
+            else:
+                for patch in patches[bug]['patches']:
+                    patch['embedding'] = embeddings[patch_text(patch, bug)]
+            patch_io.append_bug_record(records_file, bug, patches[bug])
+        # texts rarely repeat across bugs, keep memory bounded
+        embeddings.clear()
+    if records_file != output:
+        patch_io.convert_jsonl_to_json(records_file, output)
+
 if __name__ == '__main__':
     args = parse_command_line_args()
     print("Command line args with defaults ==>\n\t" +
@@ -38,8 +151,11 @@ if __name__ == '__main__':
     input_file = args.input
     setup()
 
-    with open(input_file, 'r') as f:
-        patches = json.load(f)
+    patches = patch_io.load_patch_file(input_file)
+
+    if args.batched:
+        generate_embeddings_batched(patches, args.output, args)
+        sys.exit(0)
 
     for bug in tqdm(patches):
         try:
@@ -3,10 +3,15 @@ import os
 from dotenv import load_dotenv
 import json
 import query_model as qm
+import patch_io
+import embedding_store
+import shot_index
 import argparse
 import numpy as np
-from scipy.spatial.distance import cdist
 import copy
+import hashlib
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 
@@ -15,7 +20,10 @@ def parse_command_line_args():
     parser.add_argument('--input', type=str,
                         help='path to file containing buggy files and metadata')
     parser.add_argument('--output', type=str,
-                        help='output file to write generated edit results to')
+                        help='output file to write generated edit results to, '
+                             'a .jsonl file is appended one bug per line')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip bugs already completed in the output file')
     parser.add_argument('--max_num_patches', type=int,
                         help='number of patches to generate')
     parser.add_argument('--model', type=str,
@@ -40,20 +48,62 @@ def parse_command_line_args():
         help='Use the cache with selected k shot_examples',
         action='store_true', default=True
     )
+    parser.add_argument('--shot_metric', choices=['euclidean', 'cosine'], default='euclidean',
+                        help='distance used by closest_source and closest_issue shot selection')
+    parser.add_argument('--shot_corpus', type=str,
+                        help='dataset json to draw closest_* shots from, instead of the input bugs')
+    parser.add_argument('--shot_index', type=str,
+                        help='path prefix where the top-k index of --shot_corpus is persisted')
+    parser.add_argument('--embedding_store', type=str,
+                        help='path prefix of binary embedding stores used by closest_* shot selection, '
+                             'instead of keeping embeddings in the cached json')
+    parser.add_argument('--no_prompt_fitting', action='store_true',
+                        help='do not drop shots or trim the Description of prompts over the context window')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='number of bugs to query concurrently, 1 keeps the sequential loop')
+    parser.add_argument('--requests_per_minute', type=int, default=20,
+                        help='request rate limit shared by concurrent queries')
+    parser.add_argument('--tokens_per_minute', type=int, default=40000,
+                        help='token rate limit shared by concurrent queries')
+    parser.add_argument('--response_cache', type=str,
+                        help='sqlite file caching sampled responses across runs, disabled if not given')
+    parser.add_argument('--response_cache_max_mb', type=int,
+                        help='evict least recently used cached responses above this size')
+    parser.add_argument('--replay', action='store_true',
+                        help='only serve responses from the cache, never query the model')
 
     return parser.parse_args()
 
 
+def get_store_embeddings(buggy_file, bugids, field, texts, store_prefix):
+    """Embeddings of bugids read from the binary store, embedding missing bugs once"""
+    store = embedding_store.open_field_store(store_prefix, field)
+    # move embeddings of an older json cache into the store
+    legacy = [bid for bid in bugids if field in buggy_file[bid] and bid not in store]
+    store.add(legacy, [buggy_file[bid][field] for bid in legacy])
+    missing = [bid for bid in bugids if bid not in store]
+    store.add(missing, [qm.get_embedding(texts(bid)) for bid in tqdm(missing)])
+    cache_modified = False
+    for bid in bugids:
+        if buggy_file[bid].pop(field, None) is not None:
+            cache_modified = True
+    return store.rows(bugids), cache_modified
+
+
 def select_shots(
     buggy_file,
     shot_selection_method,
-    k_shot
+    k_shot,
+    store_prefix=None,
+    shot_metric='euclidean',
+    shot_corpus=None,
+    shot_index_path=None
 ):
     cache_modified = False
+    selections = {}
     bugids = sorted(list(buggy_file.keys()))
     bugid_to_idx = {bid: idx for idx, bid in enumerate(bugids)}
     idx_to_bugids = {bugid_to_idx[bid]: bid for bid in bugid_to_idx}
-    num_bugs = len(idx_to_bugids.keys())
     if shot_selection_method == 'fixed':
         issue_lengths = [
             len(str(buggy_file[idx_to_bugids[idx]]['summary']) +
@@ -67,18 +117,26 @@ def select_shots(
                 taken_idx = sorted_indices[1]
             bugid = idx_to_bugids[idx]
             taken_bugid = idx_to_bugids[taken_idx]
-            buggy_file[bugid]['k_shot'] = [copy.copy(buggy_file[taken_bugid])]
+            selections[bugid] = [taken_bugid]
     elif shot_selection_method == 'random':
         for bid in bugids:
             copied_bids = copy.copy(bugids)
             copied_bids.remove(bid)
             taken_bugids = np.random.choice(copied_bids, k_shot)
-            buggy_file[bid]['k_shot'] = [
-                copy.copy(buggy_file[tbid]) for tbid in taken_bugids]
+            selections[bid] = [str(tbid) for tbid in taken_bugids]
     else:
         print(
             f'Getting embeddings for selecting k_shot based on {shot_selection_method}')
-        if shot_selection_method == 'closest_source':
+        if store_prefix is not None:
+            if shot_selection_method == 'closest_source':
+                source_embeddings, cache_modified = get_store_embeddings(
+                    buggy_file, bugids, 'src_wo_comments_embed',
+                    lambda bid: buggy_file[bid]['src_wo_comments'], store_prefix)
+            else:
+                source_embeddings, cache_modified = get_store_embeddings(
+                    buggy_file, bugids, 'issue_embed',
+                    lambda bid: str(buggy_file[bid]['summary']), store_prefix)
+        elif shot_selection_method == 'closest_source':
             for idx in tqdm(idx_to_bugids.keys()):
                 if 'src_wo_comments_embed' not in buggy_file[idx_to_bugids[idx]]:
                     buggy_file[idx_to_bugids[idx]]['src_wo_comments_embed'] = \
@@ -99,30 +157,94 @@ def select_shots(
             source_embeddings = np.array([
                 buggy_file[idx_to_bugids[idx]]['issue_embed'] for idx in idx_to_bugids.keys()
             ])
-        distant_matrix = cdist(source_embeddings, source_embeddings)
-        for idx in range(num_bugs):
-            bugid = idx_to_bugids[idx]
-            distances = distant_matrix[idx, :]
-            sorted_example_indices = np.argsort(distances)
-            taken = 0
-            for sidx in sorted_example_indices:
-                if sidx == idx:
-                    continue
-                if 'k_shot' not in buggy_file[bugid]:
-                    buggy_file[bugid]['k_shot'] = []
-                buggy_file[bugid]['k_shot'].append(
-                    copy.copy(buggy_file[idx_to_bugids[sidx]]))
-                taken += 1
-                if taken == k_shot:
-                    break
-    return buggy_file, cache_modified
+        if shot_corpus is not None:
+            field = 'src_wo_comments_embed' if shot_selection_method == 'closest_source' else 'issue_embed'
+            index = get_corpus_index(shot_corpus, field, shot_metric, shot_index_path)
+        else:
+            index = shot_index.ShotIndex(source_embeddings, bugids, metric=shot_metric)
+        neighbours, _ = index.query(source_embeddings, k_shot, exclude=bugids)
+        for bugid, shot_bugids in zip(bugids, neighbours):
+            selections[bugid] = shot_bugids
+    return selections, cache_modified
+
+
+def dataset_hash(metadata, shot_corpus=None, shot_metric=None):
+    """Hash of everything shot selection depends on, embeddings excluded"""
+    h = hashlib.sha256()
+    for records in (metadata, shot_corpus or {}):
+        for bid in sorted(records.keys()):
+            record = records[bid]
+            h.update(json.dumps([
+                bid, record.get('src_wo_comments'), record.get('summary'),
+                record.get('Description')
+            ]).encode('utf-8'))
+    h.update(str(shot_metric).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def get_selection_cache_file(prefix, method, k_shot, data_hash):
+    return f"{prefix}-shots-{method}-k{k_shot}-{data_hash}.json"
+
+
+def get_shot_selections(metadata, shot_corpus, cache_prefix=None):
+    """Shot bug ids per bug, read from or written to the selection cache"""
+    data_hash = dataset_hash(metadata, shot_corpus, args.shot_metric)
+    selection_file = None
+    if cache_prefix is not None:
+        selection_file = get_selection_cache_file(
+            cache_prefix, args.shot_selection_method, args.k_shot, data_hash)
+        if args.use_cache and os.path.exists(selection_file):
+            print(f'Reading shot selections from {selection_file}')
+            return json.load(open(selection_file)), False
+    selections, cache_modified = select_shots(
+        metadata,
+        args.shot_selection_method,
+        args.k_shot,
+        args.embedding_store,
+        args.shot_metric,
+        shot_corpus,
+        args.shot_index
+    )
+    if selection_file is not None:
+        print(f'Saving shot selections to {selection_file}')
+        with open(selection_file, 'w') as fp:
+            json.dump(selections, fp)
+    return selections, cache_modified
+
+
+def get_corpus_index(shot_corpus, field, shot_metric, shot_index_path=None):
+    """Top-k index over a separate shot corpus, built once and persisted"""
+    if shot_index_path is not None and shot_index.ShotIndex.exists(shot_index_path):
+        print(f'Loading shot index from {shot_index_path}')
+        index = shot_index.ShotIndex.load(shot_index_path)
+        if index.metric == shot_metric and set(index.keys) == set(shot_corpus.keys()):
+            return index
+        print('Shot index is stale, rebuilding it')
+    corpus_ids = sorted(shot_corpus.keys())
+    for cid in tqdm(corpus_ids):
+        if field not in shot_corpus[cid]:
+            if field == 'src_wo_comments_embed':
+                text = shot_corpus[cid]['src_wo_comments']
+            else:
+                text = str(shot_corpus[cid]['summary'])
+            shot_corpus[cid][field] = qm.get_embedding(text)
+    corpus = np.array([shot_corpus[cid][field] for cid in corpus_ids], dtype=np.float32)
+    index = shot_index.ShotIndex(corpus, corpus_ids, metric=shot_metric)
+    if shot_index_path is not None:
+        print(f'Saving shot index to {shot_index_path}')
+        index.save(shot_index_path)
+    return index
+
+
+# prompt types that include the issue Description
+DESCRIPTION_PROMPTS = ['issue_description', 'discussion', 'chatgpt']
 
 
 def build_prompt(
     prompt_type, issue_summary, issue_description, buggy_file,
-    k_shots=None
+    k_shots=None, shot_records=None
 ):
-    """Build prompt for gpt"""
+    """Build prompt for gpt, k_shots are bug ids resolved from shot_records"""
     if prompt_type == 'basic':
         prompt = "Fix the bug with minimal changes. "
     elif prompt_type == 'issue_summary':
@@ -143,22 +265,34 @@ def build_prompt(
     if k_shots is not None:
         prompt += "\nExample changes "
         for shot in k_shots:
+            if shot_records is not None:
+                shot = shot_records[shot]
             prompt += f"\nBuggy\n{shot['src_wo_comments']}\n"
             prompt += f"Fixed\n{shot['fixed_src_wo_comments']}\n"
     return prompt
 
 
-def generate_patches(metadata, output, num_examples, cache_file=None):
+def generate_patches(metadata, output, num_examples, cache_file=None, shot_cache_prefix=None):
     """Generate patches for a buggy file"""
     patches = {}
     rate_limit_per_minute = 20
+    selections = None
+    shot_records = None
     # query gpt for each json object in the file
     if args.use_k_shot:
-        metadata, cache_modified = select_shots(
-            metadata,
-            args.shot_selection_method,
-            args.k_shot
-        )
+        shot_corpus = None
+        if args.shot_corpus is not None:
+            print(f'Reading shot corpus from {args.shot_corpus}')
+            shot_corpus = json.load(open(args.shot_corpus))
+        # drop deep copied shots that older caches stored in every record
+        stale_shots = [bid for bid in metadata if metadata[bid].pop('k_shot', None) is not None]
+        selections, cache_modified = get_shot_selections(
+            metadata, shot_corpus, shot_cache_prefix)
+        cache_modified = cache_modified or len(stale_shots) > 0
+        if shot_corpus is not None and args.shot_selection_method.startswith('closest'):
+            shot_records = shot_corpus
+        else:
+            shot_records = metadata
         if cache_file is not None and cache_modified:
             print(f'Saving cache to {cache_file}')
             with open(cache_file, 'w') as fp:
@@ -174,31 +308,37 @@ def generate_patches(metadata, output, num_examples, cache_file=None):
             k: metadata[k] for k in list(metadata.keys())[:num_examples]
         }
 
+    completed = {}
+    if args.resume:
+        completed = patch_io.load_completed_patches(output)
+        print(f'Resuming from {output}, skipping {len(completed)} completed bugs')
+        patches.update(completed)
+    elif patch_io.is_jsonl(output):
+        # start a fresh append only file
+        open(output, 'w').close()
+
+    if App.config("CONCURRENCY") > 1:
+        patches, over_length_bugids, no_patch_generated_bugids = asyncio.run(
+            generate_patches_concurrently(
+                metadata, output, completed, selections, shot_records)
+        )
+        report_failed_bugids(over_length_bugids, no_patch_generated_bugids)
+        return
+
     over_length_bugids = []
     no_patch_generated_bugids = []
     for bid_key in tqdm(metadata):
+        if bid_key in completed:
+            continue
         key = bid_key.split('_')[0] + '_' + bid_key.split('_')[1]
-        
-        metadata[bid_key]['summary'] = metadata[bid_key]['summary'] or ''
-        metadata[bid_key]['Description'] = metadata[bid_key]['Description'] or ''
         patches[bid_key] = {'patches': []}
         file = metadata[bid_key]['src_wo_comments']
         
         print("Generating patches for bug " + str(key))
         try:
-            assert (
-                not args.use_k_shot or 
-                'k_shot' in metadata[bid_key].keys()
-            ), "K-shot should've been selected before coming here, if it is used!"
-      
-            prompt = build_prompt(
-                args.prompt,
-                metadata[bid_key]['summary'],
-                metadata[bid_key]['Description'],
-                file,
-                k_shots=metadata[bid_key]['k_shot'] if args.use_k_shot else None
-            )
+            prompt, budget = build_prompt_for_bug(metadata, bid_key, selections, shot_records)
             patches[bid_key]['prompt'] = prompt
+            patches[bid_key]['prompt_budget'] = budget
             
             response_len = 0
             while response_len < App.config("MAX_NUM_CODEX_CODE_SUGGESTIONS"):
@@ -207,7 +347,10 @@ def generate_patches(metadata, output, num_examples, cache_file=None):
                     rate_limit_per_minute
                 )
                 
-                response, cur_resp_len = query_model(prompt, file, n, App.config("CODEX_ENGINE"))
+                response, cur_resp_len = query_model(
+                    prompt, file, n, App.config("CODEX_ENGINE"), first_slot=response_len)
+                if response is None:
+                    break
                 response_len += cur_resp_len
                 if response is not None:
                     print("....saving " + str(response_len) +
@@ -223,15 +366,171 @@ def generate_patches(metadata, output, num_examples, cache_file=None):
             )
             if patches[bid_key]['unique_patches'] == 0:
                 no_patch_generated_bugids.append(key)
-            try:
-                json.dump(patches, open(output, 'w'), indent=2)
-            except:
-                print('Error when writing to file')
+            write_patches(output, patches, bid_key)
         except ValueError as v:
             if "Over Length" in str(v):
                 over_length_bugids.append(key)
         except Exception as e:
             print('Error when querying codex. Exception: ' + str(e))
+    report_failed_bugids(over_length_bugids, no_patch_generated_bugids)
+
+
+def build_prompt_for_bug(metadata, bid_key, selections=None, shot_records=None):
+    """Normalize the issue fields of a bug and build a prompt that fits the model"""
+    metadata[bid_key]['summary'] = metadata[bid_key]['summary'] or ''
+    metadata[bid_key]['Description'] = metadata[bid_key]['Description'] or ''
+    assert (
+        not args.use_k_shot or
+        bid_key in selections
+    ), "K-shot should've been selected before coming here, if it is used!"
+
+    return fit_prompt_to_context(
+        metadata[bid_key],
+        bid_key,
+        list(selections[bid_key]) if args.use_k_shot else None,
+        shot_records
+    )
+
+
+def fit_prompt_to_context(bug, bid_key, k_shots, shot_records):
+    """Build the prompt, dropping the farthest shots and then trimming the
+    Description until prompt, input and reserved answer fit the context window"""
+    model_type = App.config("CODEX_ENGINE")
+    key = bid_key.split('_')[0] + '_' + bid_key.split('_')[1]
+    description = bug['Description']
+    decisions = []
+    while True:
+        prompt = build_prompt(
+            args.prompt,
+            bug['summary'],
+            description,
+            bug['src_wo_comments'],
+            k_shots=k_shots,
+            shot_records=shot_records
+        )
+        budget = qm.get_token_budget(prompt, bug['src_wo_comments'], model_type)
+        if budget['overflow'] == 0 or args.no_prompt_fitting:
+            break
+        # shots are ordered closest first
+        if k_shots:
+            decisions.append('dropped shot ' + str(k_shots.pop()))
+        elif description and args.prompt in DESCRIPTION_PROMPTS:
+            tokens = qm.get_encoding(model_type).encode(description, disallowed_special=())
+            keep = max(len(tokens) - budget['overflow'], 0)
+            description = qm.get_encoding(model_type).decode(tokens[:keep])
+            decisions.append(f'trimmed Description to {keep} tokens')
+        else:
+            break
+    budget['decisions'] = decisions
+    budget['num_shots'] = len(k_shots) if k_shots is not None else 0
+    if len(decisions) > 0 or budget['overflow'] > 0:
+        print(f"Prompt budget for {key}: {budget}")
+    if budget['overflow'] > 0:
+        # known to be rejected, do not send it
+        raise ValueError("Over Length: " + key)
+    return prompt, budget
+
+
+async def generate_patches_for_bug_async(metadata, bid_key, limiter, semaphore,
+                                         selections=None, shot_records=None):
+    """Generate the patches of one bug, querying its chunks concurrently"""
+    rate_limit_per_minute = 20
+    key = bid_key.split('_')[0] + '_' + bid_key.split('_')[1]
+    bug_patches = {'patches': []}
+    file = metadata[bid_key]['src_wo_comments']
+    async with semaphore:
+        print("Generating patches for bug " + str(key))
+        prompt, budget = build_prompt_for_bug(metadata, bid_key, selections, shot_records)
+        bug_patches['prompt'] = prompt
+        bug_patches['prompt_budget'] = budget
+        response_len = 0
+        while response_len < App.config("MAX_NUM_CODEX_CODE_SUGGESTIONS"):
+            remaining = App.config("MAX_NUM_CODEX_CODE_SUGGESTIONS") - response_len
+            chunks = [
+                (response_len + start, min(remaining - start, rate_limit_per_minute))
+                for start in range(0, remaining, rate_limit_per_minute)
+            ]
+            try:
+                results = await asyncio.gather(*[
+                    qm.get_codex_response_async(
+                        prompt, file, n, App.config("CODEX_ENGINE"), limiter, first_slot)
+                    for first_slot, n in chunks
+                ])
+            except ValueError as v:
+                # tag the error with the bug so the caller can report it
+                raise ValueError(str(v) + ": " + key)
+            if all(response is None for response, _ in results):
+                break
+            for response, cur_resp_len in results:
+                if response is None:
+                    continue
+                response_len += cur_resp_len
+                if App.config("CODEX_ENGINE") == "gpt-3.5-turbo":
+                    append_responses_to_patches_gpt3_5(
+                        {bid_key: bug_patches}, bid_key, response)
+                else:
+                    append_responses_to_patches(
+                        {bid_key: bug_patches}, bid_key, response)
+            print("....saving " + str(response_len) +
+                  " patches for " + str(key))
+    bug_patches['response_length'] = response_len
+    bug_patches['unique_patches'] = len(bug_patches['patches'])
+    return bid_key, bug_patches
+
+
+async def generate_patches_concurrently(metadata, output, completed,
+                                        selections=None, shot_records=None):
+    """Generate patches for many bugs at once behind a shared rate limiter"""
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(
+        max_workers=App.config("CONCURRENCY") * 5))
+    limiter = qm.RateLimiter(
+        App.config("REQUESTS_PER_MINUTE"),
+        App.config("TOKENS_PER_MINUTE")
+    )
+    semaphore = asyncio.Semaphore(App.config("CONCURRENCY"))
+    results = dict(completed)
+    over_length_bugids = []
+    no_patch_generated_bugids = []
+    tasks = [
+        asyncio.ensure_future(
+            generate_patches_for_bug_async(
+                metadata, bid_key, limiter, semaphore, selections, shot_records))
+        for bid_key in metadata if bid_key not in completed
+    ]
+    for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+        try:
+            bid_key, bug_patches = await task
+        except ValueError as v:
+            if "Over Length" in str(v):
+                over_length_bugids.append(str(v).split(':')[-1].strip())
+            continue
+        except Exception as e:
+            print('Error when querying codex. Exception: ' + str(e))
+            continue
+        key = bid_key.split('_')[0] + '_' + bid_key.split('_')[1]
+        results[bid_key] = bug_patches
+        if bug_patches['unique_patches'] == 0:
+            no_patch_generated_bugids.append(key)
+        # keep the same key order as the sequential run
+        patches = {k: results[k] for k in metadata if k in results}
+        write_patches(output, patches, bid_key)
+    patches = {k: results[k] for k in metadata if k in results}
+    return patches, over_length_bugids, no_patch_generated_bugids
+
+
+def write_patches(output, patches, bid_key):
+    """Persist the bug just generated, appending a single record in jsonl mode"""
+    try:
+        if patch_io.is_jsonl(output):
+            patch_io.append_bug_record(output, bid_key, patches[bid_key])
+        else:
+            json.dump(patches, open(output, 'w'), indent=2)
+    except:
+        print('Error when writing to file')
+
+
+def report_failed_bugids(over_length_bugids, no_patch_generated_bugids):
     if len(over_length_bugids) > 0 or len(no_patch_generated_bugids) > 0:
         print('=' * 100)
         print("No patch was generated for the following bugids")
@@ -245,8 +544,8 @@ def generate_patches(metadata, output, num_examples, cache_file=None):
         print('=' * 100)
 
 
-def query_model(prompt, file, n, model):
-        response, cur_resp_len = qm.get_codex_response_with_retries(prompt, file, n, model )
+def query_model(prompt, file, n, model, first_slot=0):
+        response, cur_resp_len = qm.get_codex_response_with_retries(prompt, file, n, model, first_slot)
         return response, cur_resp_len
 
 def append_responses_to_patches(patches, bugid_key, response):
@@ -271,10 +570,19 @@ if __name__ == '__main__':
     App.set("CODEX_ENGINE", args.model)
     App.set("MAX_NUM_CODEX_CODE_SUGGESTIONS", args.max_num_patches)
     App.set("TEMP", args.sampling_temp)
+    App.set("CONCURRENCY", args.concurrency)
+    App.set("REQUESTS_PER_MINUTE", args.requests_per_minute)
+    App.set("TOKENS_PER_MINUTE", args.tokens_per_minute)
     input_file = args.input
     output_file = args.output
     num_examples = args.num_examples
     qm.setup()
+    if args.response_cache is not None:
+        qm.setup_response_cache(
+            args.response_cache,
+            args.response_cache_max_mb * 1024 * 1024 if args.response_cache_max_mb else None,
+            read_only=args.replay
+        )
 
     # open json file and read file text
     cache_file = input_file + "-cached.json"
@@ -286,5 +594,5 @@ if __name__ == '__main__':
         buggy_file = json.load(open(input_file))
 
     generate_patches(
-        buggy_file, output_file, num_examples, cache_file
+        buggy_file, output_file, num_examples, cache_file, input_file
     )
\ No newline at end of file
@@ -0,0 +1,79 @@
+import os
+import json
+import argparse
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True,
+                        help='jsonl patch file written by generate_patches.py')
+    parser.add_argument('--output', type=str, required=True,
+                        help='json file in the layout validate.py consumes')
+    return parser.parse_args()
+
+
+def is_jsonl(path):
+    return path.endswith('.jsonl')
+
+
+def append_bug_record(path, bid_key, bug_patches):
+    """Append one bug as a single line and fsync it, so a crash loses at most that bug"""
+    with open(path, 'a') as f:
+        f.write(json.dumps({bid_key: bug_patches}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_patch_records(path):
+    """Read a jsonl patch file into a dict keyed by bug, last record wins"""
+    patches = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                # partially written record of an interrupted run
+                break
+            line = line.strip()
+            if line:
+                patches.update(json.loads(line))
+    return patches
+
+
+def truncate_partial_record(path):
+    """Drop a trailing line that was cut off by a crash so appends stay valid"""
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if len(data) == 0 or data.endswith(b'\n'):
+            return
+        f.truncate(data.rfind(b'\n') + 1)
+
+
+def load_completed_patches(path):
+    """Return the bugs already written to path, for --resume"""
+    if not os.path.exists(path):
+        return {}
+    if is_jsonl(path):
+        truncate_partial_record(path)
+        return read_patch_records(path)
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def load_patch_file(path):
+    """Load candidate patches from either the json or the jsonl layout"""
+    if is_jsonl(path):
+        return read_patch_records(path)
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def convert_jsonl_to_json(jsonl_path, json_path):
+    patches = read_patch_records(jsonl_path)
+    with open(json_path, 'w') as f:
+        json.dump(patches, f, indent=2)
+    return patches
+
+
+if __name__ == '__main__':
+    args = parse_command_line_args()
+    patches = convert_jsonl_to_json(args.input, args.output)
+    print(f'Wrote {len(patches)} bugs to {args.output}')
@@ -6,55 +6,87 @@ import subprocess
 import time
 import sys
 import tokenization
+import tracing
+import hashlib
+import re
 
 
-def apply_patch(tmp_dir,path, start_loc, end_loc, patch, level):
-    if(level == "line"):
-        backup_file = apply_patch_line(tmp_dir,path, start_loc, end_loc, patch)        
-    else:
-       backup_file =  apply_patch_file(tmp_dir, path, patch)
-    
-    return backup_file
-
-
-#replace patch in the file at a line level
-def insert_fix(file_path, start_loc, end_loc, patch, project_dir):
-    file_path = os.path.join(project_dir, file_path)
-    #create backup with original file contents
-    shutil.copyfile(file_path, file_path + '.bak')
-
-    with open(file_path, 'r') as file:
-        data = file.readlines()
-
-    patched = False
-    #replace the lines in the file with the patch
-    with open(file_path, 'w') as file:
-        for idx, line in enumerate(data):
-            if start_loc - 1 <= idx <= end_loc -1:
-                if not patched:
-                    file.write(patch)
-                    patched = True
-            else:
-                file.write(line)
-
-    return file_path + '.bak'
-
-def apply_patch_file(project_dir, file_path, patch):
-    patch = patch.strip()
-    file_path = project_dir + file_path
-    #create backup with original file contents
-    shutil.copyfile(file_path, file_path + '.bak')
-    #replace the lines in the file with the patch
-    with open(file_path, 'w') as file:
-        file.write(patch)
-    
-    return file_path + '.bak'
-
-def apply_patch_line(tmp_dir, path, start_loc, end_loc, patch):
-     files = []
-     #create backup with original file contents
-     shutil.copyfile(path, path + '.bak')
-     patch = patch.strip()
-     patched_file = insert_fix(path, int(start_loc), int(end_loc), patch, tmp_dir)
-     return path + '.bak'
+#pristine file contents per (working copy, path), loaded once per bug
+patch_targets = {}
 
+
+class PatchTarget:
+    """The file a bug's patches replace, with its pristine bytes and line
+    offsets kept in memory, so applying and restoring a patch is a single
+    atomic write and never reads the file again"""
+
+    def __init__(self, project_dir, path):
+        self.file_path = os.path.join(project_dir, path)
+        with tracing.span('load-target'), open(self.file_path, 'rb') as file:
+            self.pristine = file.read()
+        self.digest = hashlib.sha256(self.pristine).hexdigest()
+        self.mode = os.stat(self.file_path).st_mode
+        # offset where every line starts, and the end of the file
+        self.line_offsets = [0] + [match.end() for match in re.finditer(b'\n', self.pristine)]
+        if self.line_offsets[-1] != len(self.pristine):
+            self.line_offsets.append(len(self.pristine))
+        self.num_lines = len(self.line_offsets) - 1
+        self.written = self.stat_key()
+        self.patched = False
+
+    def stat_key(self):
+        st = os.stat(self.file_path)
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    def patched_content(self, start_loc, end_loc, patch, level):
+        patch = patch.strip().encode('utf-8')
+        if level != 'line':
+            # file level patches replace the whole file
+            return patch
+        start_loc, end_loc = int(start_loc), int(end_loc)
+        if max(start_loc, 1) > self.num_lines or end_loc < max(start_loc, 1):
+            # no line of the file is in the range to replace
+            return self.pristine
+        # lines start_loc to end_loc (1-based, inclusive) are replaced by the patch
+        prefix = self.pristine[:self.line_offsets[max(start_loc - 1, 0)]]
+        suffix = self.pristine[self.line_offsets[min(end_loc, self.num_lines)]:]
+        return prefix + patch + suffix
+
+    def write(self, content):
+        """Replace the file in one step, the new inode also leaves a hardlinked template alone"""
+        tmp_path = self.file_path + '.nl2fix-tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(content)
+        os.chmod(tmp_path, self.mode)
+        os.replace(tmp_path, self.file_path)
+        self.written = self.stat_key()
+
+    def verify(self):
+        """Check the file is the pristine one, hashing it only if it changed since it was written"""
+        if self.stat_key() == self.written:
+            return True
+        with open(self.file_path, 'rb') as file:
+            return hashlib.sha256(file.read()).hexdigest() == self.digest
+
+    def apply(self, start_loc, end_loc, patch, level):
+        with tracing.span('apply'):
+            if self.patched or not self.verify():
+                raise RuntimeError('Not the pristine file before patching ' + self.file_path)
+            self.write(self.patched_content(start_loc, end_loc, patch, level))
+            self.patched = True
+
+    def restore(self):
+        with tracing.span('restore'):
+            self.write(self.pristine)
+            self.patched = False
+
+
+def get_patch_target(project_dir, path):
+    key = (project_dir, path)
+    if key not in patch_targets:
+        patch_targets[key] = PatchTarget(project_dir, path)
+    return patch_targets[key]
+
+
+def release_patch_targets():
+    patch_targets.clear()
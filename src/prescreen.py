@@ -0,0 +1,318 @@
+import re
+import tokenization
+
+# sub reasons of an 'uncompilable' verdict given without compiling
+EMPTY = 'empty'
+UNTERMINATED = 'unterminated-literal'
+INVALID_TOKEN = 'invalid-token'
+UNBALANCED = 'unbalanced-brackets'
+PARSE_ERROR = 'parse-error'
+
+CODE_TAG = re.compile(r'<code>(.*?)(?:</code>|$)', re.DOTALL | re.IGNORECASE)
+CODE_FENCE = re.compile(r'```[\w+-]*[ \t]*\n?(.*?)(?:```|$)', re.DOTALL)
+
+IDENTIFIER = re.compile(r'[A-Za-z_$][\w$]*')
+BRACKETS = {'(': ')', '[': ']', '{': '}'}
+CLOSING = {v: k for k, v in BRACKETS.items()}
+# characters that can not appear in java source outside literals and comments
+INVALID_CHARACTERS = set('#`')
+# reserved words that are neither identifiers nor type names
+RESERVED = {'abstract', 'assert', 'break', 'case', 'catch', 'class', 'const', 'continue', 'default',
+            'do', 'else', 'enum', 'extends', 'final', 'finally', 'for', 'goto', 'if', 'implements',
+            'import', 'instanceof', 'interface', 'native', 'new', 'package', 'private', 'protected',
+            'public', 'return', 'static', 'strictfp', 'super', 'switch', 'synchronized', 'this',
+            'throw', 'throws', 'transient', 'try', 'volatile', 'while', 'true', 'false', 'null'}
+
+MODIFIERS = {'public', 'protected', 'private', 'static', 'abstract', 'final', 'native',
+             'synchronized', 'transient', 'volatile', 'strictfp', 'default', 'sealed'}
+TYPE_KEYWORDS = {'class', 'interface', 'enum', 'record'}
+
+
+class ParseError(Exception):
+    pass
+
+
+def extract_code(response, level='line'):
+    """Code of a model response
+
+    The chatgpt prompt asks for the code surrounded with <code> tags, and
+    chat models also answer in markdown code fences. A response that
+    passes check_patch is code as it is, so <code> in a javadoc or a fence
+    in a comment is left alone. Otherwise the longest tagged or fenced block
+    that passes is taken, and the response as is when none does.
+    """
+    if check_patch(response, level) is None:
+        return response
+    for pattern in (CODE_TAG, CODE_FENCE):
+        blocks = [block for block in pattern.findall(response) if check_patch(block, level) is None]
+        if len(blocks) > 0:
+            return max(blocks, key=len)
+    return response
+
+
+def check_patch(code, level='line'):
+    """None if code may compile, otherwise the reason it can not
+
+    Only checks what holds for any valid java: literals and comments are
+    closed, brackets match, and the patch is a sequence of member
+    declarations (line level) or a compilation unit (file level). Method
+    bodies are not parsed beyond their brackets.
+    """
+    tokens = []
+    for kind, text, terminated in tokenization.java_tokens(code):
+        if not terminated:
+            return UNTERMINATED
+        if kind in ('space', 'line_comment', 'block_comment'):
+            continue
+        if kind == 'operator' and text in INVALID_CHARACTERS:
+            return INVALID_TOKEN
+        tokens.append(text)
+    if len(tokens) == 0:
+        return EMPTY
+    matching = match_brackets(tokens)
+    if matching is None:
+        return UNBALANCED
+    parser = MemberParser(tokens, matching)
+    try:
+        if level == 'line':
+            parser.members(len(tokens))
+        else:
+            parser.compilation_unit()
+    except ParseError:
+        return PARSE_ERROR
+    return None
+
+
+def match_brackets(tokens):
+    """Index of the matching bracket of every bracket token, None if unbalanced"""
+    matching = {}
+    stack = []
+    for i, token in enumerate(tokens):
+        if token in BRACKETS:
+            stack.append(i)
+        elif token in CLOSING:
+            if len(stack) == 0 or tokens[stack[-1]] != CLOSING[token]:
+                return None
+            opening = stack.pop()
+            matching[opening] = i
+            matching[i] = opening
+    if len(stack) > 0:
+        return None
+    return matching
+
+
+class MemberParser:
+    """Declaration level parser over the tokens of a patch, bracketed parts
+    (parameters, initializers, bodies) are skipped as a whole"""
+
+    def __init__(self, tokens, matching):
+        self.tokens = tokens
+        self.matching = matching
+        self.pos = 0
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return None
+
+    def expect(self, token):
+        if self.peek() != token:
+            raise ParseError('Expected ' + token + ' at ' + str(self.pos))
+        self.pos += 1
+
+    def identifier(self):
+        token = self.peek()
+        if token is None or not IDENTIFIER.fullmatch(token) or token in RESERVED:
+            raise ParseError('Expected an identifier at ' + str(self.pos))
+        self.pos += 1
+        return token
+
+    def skip_brackets(self):
+        """Skip a bracketed part starting at the current token"""
+        self.pos = self.matching[self.pos] + 1
+
+    def skip_angle_brackets(self):
+        depth = 0
+        while True:
+            token = self.peek()
+            if token is None or token in ('{', '}', ';'):
+                raise ParseError('Unclosed type arguments')
+            if token == '<':
+                depth += 1
+            elif token in ('>', '>>', '>>>'):
+                depth -= len(token)
+            elif token in BRACKETS:
+                self.skip_brackets()
+                continue
+            self.pos += 1
+            if depth <= 0:
+                if depth < 0:
+                    raise ParseError('Unbalanced type arguments')
+                return
+
+    def skip_until(self, stops, end):
+        """Skip to the first of stops outside brackets, before end"""
+        while self.pos < end and self.peek() not in stops:
+            if self.peek() in BRACKETS:
+                self.skip_brackets()
+            else:
+                self.pos += 1
+        if self.pos >= end:
+            raise ParseError('Expected one of ' + ' '.join(stops))
+
+    def annotations_and_modifiers(self):
+        while True:
+            token = self.peek()
+            if token == '@' and self.peek(1) != 'interface':
+                self.pos += 1
+                self.qualified_name()
+                if self.peek() == '(':
+                    self.skip_brackets()
+            elif token in MODIFIERS:
+                self.pos += 1
+            elif token == 'non' and self.peek(1) == '-' and self.peek(2) == 'sealed':
+                self.pos += 3
+            else:
+                return
+
+    def qualified_name(self):
+        self.identifier()
+        while self.peek() == '.' and self.peek(1) != '*':
+            self.pos += 1
+            self.identifier()
+
+    def type(self):
+        self.annotations_and_modifiers()
+        if self.peek() == '?':
+            self.pos += 1
+        else:
+            self.identifier()
+        if self.peek() == '<':
+            self.skip_angle_brackets()
+        while self.peek() == '.':
+            self.pos += 1
+            self.annotations_and_modifiers()
+            self.identifier()
+            if self.peek() == '<':
+                self.skip_angle_brackets()
+        self.dimensions()
+        if self.peek() == '...':
+            self.pos += 1
+
+    def dimensions(self):
+        while self.peek() == '[' and self.peek(1) == ']':
+            self.pos += 2
+
+    def body(self):
+        if self.peek() != '{':
+            raise ParseError('Expected a body at ' + str(self.pos))
+        start = self.pos
+        self.skip_brackets()
+        return start
+
+    def compilation_unit(self):
+        end = len(self.tokens)
+        self.annotations_and_modifiers()
+        if self.peek() == 'package':
+            self.pos += 1
+            self.qualified_name()
+            self.expect(';')
+        while self.peek() == 'import':
+            self.pos += 1
+            if self.peek() == 'static':
+                self.pos += 1
+            self.qualified_name()
+            if self.peek() == '.':
+                self.pos += 1
+                self.expect('*')
+            self.expect(';')
+        while self.pos < end:
+            if self.peek() == ';':
+                self.pos += 1
+                continue
+            self.annotations_and_modifiers()
+            if self.peek() not in TYPE_KEYWORDS and self.peek() != '@':
+                raise ParseError('Expected a type declaration at ' + str(self.pos))
+            self.type_declaration()
+
+    def type_declaration(self):
+        if self.peek() == '@':
+            # annotation type
+            self.pos += 1
+        kind = self.peek()
+        self.pos += 1
+        self.identifier()
+        self.skip_until(['{'], len(self.tokens))
+        start = self.body()
+        saved = self.pos
+        self.pos = start + 1
+        if kind == 'enum':
+            self.skip_until([';', '}'], saved)
+            if self.peek() == ';':
+                self.pos += 1
+        self.members(saved - 1)
+        self.pos = saved
+
+    def members(self, end):
+        """Member declarations up to index end"""
+        while self.pos < end:
+            if self.peek() == ';':
+                self.pos += 1
+                continue
+            self.member(end)
+        if self.pos != end:
+            raise ParseError('Declaration runs past its body')
+
+    def member(self, end):
+        self.annotations_and_modifiers()
+        token = self.peek()
+        if token == '{':
+            # initializer block
+            self.body()
+            return
+        if token in TYPE_KEYWORDS and self.peek(1) not in ('(', '.', None) or token == '@':
+            self.type_declaration()
+            return
+        if token == '<':
+            self.skip_angle_brackets()
+            self.annotations_and_modifiers()
+        if self.peek(1) == '{':
+            # compact record constructor
+            self.identifier()
+            self.body()
+            return
+        if self.peek(1) == '(':
+            # constructor
+            self.identifier()
+        else:
+            self.type()
+            self.identifier()
+        if self.peek() == '(':
+            self.method_rest()
+        else:
+            self.field_rest(end)
+
+    def method_rest(self):
+        self.skip_brackets()
+        self.dimensions()
+        if self.peek() == 'throws':
+            self.pos += 1
+            self.type()
+            while self.peek() == ',':
+                self.pos += 1
+                self.type()
+        if self.peek() == 'default':
+            # annotation element
+            self.pos += 1
+            self.skip_until([';'], len(self.tokens))
+        if self.peek() == ';':
+            self.pos += 1
+        else:
+            self.body()
+
+    def field_rest(self, end):
+        self.dimensions()
+        if self.peek() not in ('=', ',', ';'):
+            raise ParseError('Expected a field declaration at ' + str(self.pos))
+        self.skip_until([';'], end)
+        self.pos += 1
@@ -1,4 +1,10 @@
 import time
+import json
+import random
+import sqlite3
+import hashlib
+import asyncio
+import threading
 import openai
 from config import App
 import os
@@ -10,22 +16,106 @@ def setup():
     """Setup OpenAI API"""
     load_dotenv()
     openai.api_key = os.getenv("OPENAI_API_KEY")
+    # allows pointing the client at a local OpenAI compatible server
+    if os.getenv("OPENAI_API_BASE"):
+        openai.api_base = os.getenv("OPENAI_API_BASE")
 
 
-def get_codex_response_with_retries(prompt, buggy_file, n, model_type='edit'):
+def get_embedding(text, model="text-embedding-ada-002"):
+    """Embed a single text, used for k-shot selection"""
+    return openai.Embedding.create(input=[text], model=model)["data"][0]["embedding"]
+
+
+def create_response(prompt, buggy_file, n, model_type='edit'):
+    """Dispatch a single request to the endpoint for model_type"""
+    if model_type == 'edit':
+        return get_or_create_codex_response(prompt, buggy_file, n)
+    elif model_type == 'completion':
+        return get_or_create_codex_completion(prompt, buggy_file, n)
+    elif model_type == 'gpt3.5':
+        return get_or_create_gpt3_5_response(prompt, n)
+    raise ValueError("Model type not supported")
+
+
+def get_backoff_delay(attempt, error=None):
+    """Seconds to wait before retry number attempt, honoring Retry-After"""
+    headers = getattr(error, 'headers', None) or {}
+    retry_after = headers.get('Retry-After') or headers.get('retry-after')
+    if retry_after is not None:
+        try:
+            return float(retry_after) + random.uniform(0, 1)
+        except ValueError:
+            pass
+    # exponential backoff with full jitter
+    return random.uniform(0, min(App.config("MAX_BACKOFF"), 2 ** attempt))
+
+
+def estimate_request_tokens(prompt, buggy_file, n, model_type='edit'):
+    """Token cost of a request, used by the tokens per minute limiter"""
+    budget = get_token_budget(prompt, buggy_file, model_type)
+    return budget['input_tokens'] + n * budget['output_tokens']
+
+
+def get_encoding(model_type):
+    if model_type not in encodings:
+        model = REQUEST_PARAMS.get(model_type, {'model': model_type})['model']
+        try:
+            encodings[model_type] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encodings[model_type] = tiktoken.get_encoding('cl100k_base')
+    return encodings[model_type]
+
+
+def count_tokens(text, model_type='edit'):
+    return len(get_encoding(model_type).encode(text or '', disallowed_special=()))
+
+
+def reserved_output_tokens(buggy_file, model_type):
+    """Tokens to keep free for one sampled answer"""
+    max_tokens = REQUEST_PARAMS.get(model_type, {}).get('max_tokens')
+    if max_tokens is not None:
+        return max_tokens
+    # edits and chat answers rewrite the whole buggy method
+    return max(count_tokens(buggy_file, model_type), App.config("MAX_TOKENS"))
+
+
+def get_token_budget(prompt, buggy_file, model_type='edit'):
+    """Token usage of a request against the context window of model_type"""
+    input_tokens = count_tokens(prompt, model_type)
+    if model_type == 'edit':
+        input_tokens += count_tokens(buggy_file, model_type)
+    output_tokens = reserved_output_tokens(buggy_file, model_type)
+    context_window = CONTEXT_WINDOWS.get(model_type)
+    overflow = 0
+    if context_window is not None:
+        overflow = input_tokens + output_tokens - context_window
+    return {
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'context_window': context_window,
+        'overflow': max(overflow, 0),
+    }
+
+
+def get_codex_response_with_retries(prompt, buggy_file, n, model_type='edit', first_slot=0):
+    """Query codex with retries, serving samples from the response cache first"""
+    cache = get_response_cache()
+    if cache is None:
+        return query_codex_with_retries(prompt, buggy_file, n, model_type)
+    key = response_cache_key(prompt, buggy_file, model_type)
+    hits, missing = cache.lookup(key, range(first_slot, first_slot + n))
+    response = None
+    if len(missing) > 0 and not cache.read_only:
+        response, _ = query_codex_with_retries(
+            prompt, buggy_file, len(missing), model_type)
+    return merge_cached_response(cache, key, hits, missing, response)
+
+
+def query_codex_with_retries(prompt, buggy_file, n, model_type='edit'):
     """Query codex with retries"""
-    rate_limit_per_minute = 3 if model_type == 'completion' else 20
-    delay = 60.0 # / rate_limit_per_minute
-    for _ in range(App.config("NUM_CODEX_RETRIES")):
+    for attempt in range(App.config("NUM_CODEX_RETRIES")):
         try:
-            if model_type == 'edit':
-                response = get_or_create_codex_response(prompt, buggy_file, n)
-            elif model_type == 'completion':
-                response = get_or_create_codex_completion(prompt, buggy_file, n)
-            elif model_type == 'gpt3.5':
-                response = get_or_create_gpt3_5_response(prompt, n)
-            else:
-                raise ValueError("Model type not supported")
+            response = create_response(prompt, buggy_file, n, model_type)
             response_len = min(
                 len(response['choices']),
                 App.config("MAX_NUM_CODEX_CODE_SUGGESTIONS")
@@ -35,7 +125,7 @@ def get_codex_response_with_retries(prompt, buggy_file, n, model_type='edit'):
             print(
                 f"RateLimitError Exception in get_codex_response_with_retries {e}"
             )
-            time.sleep(delay)
+            time.sleep(get_backoff_delay(attempt, e))
         except openai.error.OpenAIError as e:
             print(
                 f"OpenAIError Exception in get_codex_response_with_retries {e}"
@@ -43,16 +133,236 @@ def get_codex_response_with_retries(prompt, buggy_file, n, model_type='edit'):
             # if e includes reduce the input size, then return with none
             if "Please reduce " in str(e):
                 raise ValueError("Over Length")
-            time.sleep(delay)
+            time.sleep(get_backoff_delay(attempt, e))
         except Exception as e:
             print(f"Exception in get_codex_response_with_retries {e}")
             # if e includes reduce the input size, then return with none
             if "Please reduce " in str(e):
                 raise ValueError("Over Length")
-            time.sleep(delay)
+            time.sleep(get_backoff_delay(attempt, e))
+    return None, None
+
+
+class RateLimiter:
+    """Token bucket limiting requests per minute and tokens per minute
+
+    clock and sleep default to time.monotonic and asyncio.sleep, tests pass
+    a fake clock instead.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, clock=time.monotonic, sleep=asyncio.sleep):
+        self.capacity = {'requests': float(requests_per_minute),
+                         'tokens': float(tokens_per_minute)}
+        self.level = dict(self.capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.blocked_until = 0.0
+        self.lock = None
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = now - self.updated
+        self.updated = now
+        for name, capacity in self.capacity.items():
+            self.level[name] = min(
+                capacity, self.level[name] + elapsed * capacity / 60.0)
+
+    def pause(self, seconds):
+        """Hold back every request for seconds, e.g. after a rate limit error"""
+        self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+        self.level['requests'] = 0.0
+
+    async def acquire(self, tokens=1):
+        """Wait until one request costing tokens fits in both buckets"""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        tokens = min(tokens, self.capacity['tokens'])
+        async with self.lock:
+            while True:
+                blocked = self.blocked_until - self.clock()
+                if blocked > 0:
+                    await self.sleep(blocked)
+                self._refill()
+                if self.level['requests'] >= 1 and self.level['tokens'] >= tokens:
+                    self.level['requests'] -= 1
+                    self.level['tokens'] -= tokens
+                    return
+                wait = max(
+                    (1 - self.level['requests']) * 60.0 / self.capacity['requests'],
+                    (tokens - self.level['tokens']) * 60.0 / self.capacity['tokens']
+                )
+                await self.sleep(wait)
+
+
+async def get_codex_response_async(prompt, buggy_file, n, model_type, limiter, first_slot=0):
+    """Async counterpart of get_codex_response_with_retries"""
+    cache = get_response_cache()
+    if cache is None:
+        return await query_codex_async(prompt, buggy_file, n, model_type, limiter)
+    key = response_cache_key(prompt, buggy_file, model_type)
+    hits, missing = cache.lookup(key, range(first_slot, first_slot + n))
+    response = None
+    if len(missing) > 0 and not cache.read_only:
+        response, _ = await query_codex_async(
+            prompt, buggy_file, len(missing), model_type, limiter)
+    return merge_cached_response(cache, key, hits, missing, response)
+
+
+async def query_codex_async(prompt, buggy_file, n, model_type, limiter):
+    """Query codex with retries without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    for attempt in range(App.config("NUM_CODEX_RETRIES")):
+        await limiter.acquire(estimate_request_tokens(prompt, buggy_file, n, model_type))
+        try:
+            response = await loop.run_in_executor(
+                None, create_response, prompt, buggy_file, n, model_type)
+            response_len = min(
+                len(response['choices']),
+                App.config("MAX_NUM_CODEX_CODE_SUGGESTIONS")
+            )
+            return response, response_len
+        except openai.error.RateLimitError as e:
+            print(f"RateLimitError Exception in get_codex_response_async {e}")
+            delay = get_backoff_delay(attempt, e)
+            limiter.pause(delay)
+            await limiter.sleep(delay)
+        except Exception as e:
+            print(f"Exception in get_codex_response_async {e}")
+            # if e includes reduce the input size, then return with none
+            if "Please reduce " in str(e):
+                raise ValueError("Over Length")
+            await limiter.sleep(get_backoff_delay(attempt, e))
     return None, None
 
 
+# request parameters that determine the sampled distribution, per model type
+# top_p is never sent, so the API default applies
+REQUEST_PARAMS = {
+    'edit': {'model': 'code-davinci-edit-001', 'top_p': None, 'max_tokens': None},
+    'completion': {'model': 'code-davinci-002', 'top_p': None, 'max_tokens': 750},
+    'gpt3.5': {'model': 'gpt-3.5-turbo', 'top_p': None, 'max_tokens': None},
+}
+
+# context window of each model type, shared by prompt, input and answer
+CONTEXT_WINDOWS = {'edit': 3000, 'completion': 8001, 'gpt3.5': 4096}
+
+response_cache = None
+encodings = {}
+
+
+class ResponseCache:
+    """SQLite store of sampled choices, one row per (request, sample slot)
+
+    Rows are evicted least recently used first once the stored choices
+    exceed max_bytes. A read only cache never queries for missing slots.
+    """
+
+    def __init__(self, path, max_bytes=None, read_only=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS choices ('
+            'key TEXT, slot INTEGER, choice TEXT, size INTEGER, last_used REAL, '
+            'PRIMARY KEY (key, slot))'
+        )
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS choices_last_used ON choices (last_used)')
+        self.conn.commit()
+
+    def lookup(self, key, slots):
+        """Return cached choices by slot and the list of missing slots"""
+        slots = list(slots)
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT slot, choice FROM choices WHERE key = ? AND slot BETWEEN ? AND ?',
+                (key, slots[0], slots[-1])
+            ).fetchall()
+            if len(rows) > 0 and not self.read_only:
+                self.conn.execute(
+                    'UPDATE choices SET last_used = ? WHERE key = ? AND slot BETWEEN ? AND ?',
+                    (time.time(), key, slots[0], slots[-1])
+                )
+                self.conn.commit()
+        hits = {slot: json.loads(choice) for slot, choice in rows}
+        return hits, [slot for slot in slots if slot not in hits]
+
+    def store(self, key, slot_choices):
+        if self.read_only or len(slot_choices) == 0:
+            return
+        now = time.time()
+        rows = []
+        for slot, choice in slot_choices.items():
+            data = json.dumps(choice)
+            rows.append((key, slot, data, len(data), now))
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO choices VALUES (?, ?, ?, ?, ?)', rows)
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        total = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM choices').fetchone()[0]
+        while total > self.max_bytes:
+            oldest = self.conn.execute(
+                'SELECT key, slot, size FROM choices ORDER BY last_used LIMIT 256'
+            ).fetchall()
+            if len(oldest) == 0:
+                break
+            for key, slot, size in oldest:
+                self.conn.execute(
+                    'DELETE FROM choices WHERE key = ? AND slot = ?', (key, slot))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+
+def setup_response_cache(path, max_bytes=None, read_only=False):
+    """Enable the response cache for every following query"""
+    global response_cache
+    response_cache = ResponseCache(path, max_bytes, read_only)
+    return response_cache
+
+
+def get_response_cache():
+    return response_cache
+
+
+def response_cache_key(prompt, buggy_file, model_type):
+    params = dict(REQUEST_PARAMS.get(model_type, {'model': model_type}))
+    params['temperature'] = App.config("TEMP")
+    params['instruction_input'] = hashlib.sha256(
+        json.dumps([prompt, buggy_file]).encode('utf-8')).hexdigest()
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def merge_cached_response(cache, key, hits, missing, response):
+    """Store fresh choices in their slots and return all choices in slot order"""
+    if response is not None:
+        fresh = {
+            slot: json.loads(json.dumps(choice))
+            for slot, choice in zip(missing, response['choices'])
+        }
+        cache.store(key, fresh)
+        hits.update(fresh)
+    if len(hits) == 0:
+        return None, None
+    choices = []
+    for index, slot in enumerate(sorted(hits)):
+        choice = dict(hits[slot])
+        choice['index'] = index
+        choices.append(choice)
+    response_len = min(len(choices), App.config("MAX_NUM_CODEX_CODE_SUGGESTIONS"))
+    return {'choices': choices}, response_len
+
+
 def get_or_create_codex_response(prompt, buggy_file, n):
     # https://beta.openai.com/docs/api-reference/edits
     # {model, input, instruction, n, temperature, top_p}
@@ -0,0 +1,69 @@
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.Method;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.util.Arrays;
+
+/**
+ * Keeps one JVM per working copy and runs tests on request.
+ *
+ * Usage: java -cp [runner build dir] TestDaemon [runner build dir] [cp.test]
+ *
+ * Every stdin line "RUN\tClass::method\tClass..." loads the test classpath,
+ * including recompiled classes, through a fresh class loader and answers with
+ * the TestRunner result lines followed by "##nl2fix DONE". "RUN_FAIL_FAST"
+ * stops at the first failing test like TestRunner --fail-fast. "QUIT" stops
+ * the daemon. Test output and failure traces go to stderr.
+ */
+public class TestDaemon {
+
+    static final String PREFIX = "##nl2fix ";
+
+    public static void main(String[] args) throws Exception {
+        PrintStream results = System.out;
+        System.setOut(System.err);
+        String[] entries = args[1].split(File.pathSeparator);
+        URL[] urls = new URL[entries.length + 1];
+        for (int i = 0; i < entries.length; i++) {
+            urls[i] = new File(entries[i]).toURI().toURL();
+        }
+        urls[entries.length] = new File(args[0]).toURI().toURL();
+        // the extension loader, so junit and the project only come from urls
+        ClassLoader parent = ClassLoader.getSystemClassLoader().getParent();
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        results.println(PREFIX + "READY");
+        results.flush();
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] fields = line.split("\t");
+            if (fields[0].equals("QUIT")) {
+                break;
+            }
+            if (!fields[0].equals("RUN") && !fields[0].equals("RUN_FAIL_FAST")) {
+                continue;
+            }
+            boolean failFast = fields[0].equals("RUN_FAIL_FAST");
+            String[] tests = Arrays.copyOfRange(fields, 1, fields.length);
+            URLClassLoader loader = new URLClassLoader(urls, parent);
+            ClassLoader previous = Thread.currentThread().getContextClassLoader();
+            Thread.currentThread().setContextClassLoader(loader);
+            try {
+                Class<?> runner = Class.forName("TestRunner", true, loader);
+                Method runAll = runner.getMethod("runAll", String[].class, boolean.class, PrintStream.class, PrintStream.class);
+                runAll.invoke(null, tests, failFast, results, System.err);
+            } catch (Throwable t) {
+                t.printStackTrace(System.err);
+            } finally {
+                Thread.currentThread().setContextClassLoader(previous);
+                loader.close();
+            }
+            results.println(PREFIX + "DONE");
+            results.flush();
+        }
+        System.exit(0);
+    }
+}
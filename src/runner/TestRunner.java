@@ -0,0 +1,86 @@
+import java.io.PrintStream;
+import java.util.Arrays;
+
+import org.junit.runner.JUnitCore;
+import org.junit.runner.Request;
+import org.junit.runner.Result;
+import org.junit.runner.notification.Failure;
+
+/**
+ * Runs JUnit tests in a single JVM and reports one line per test.
+ *
+ * Usage: java -cp [cp.test]:[runner build dir] TestRunner [--fail-fast] Class::method Class ...
+ *
+ * stdout gets "##nl2fix PASS|FAIL [test] [millis]" per argument and
+ * "##nl2fix FAILED_METHOD Class::method" for every failing method, the
+ * failure traces go to stderr. With --fail-fast the tests after the first
+ * failing one are not run and get no line. TestDaemon calls runAll through
+ * a fresh class loader instead.
+ */
+public class TestRunner {
+
+    static final String PREFIX = "##nl2fix ";
+
+    public static void main(String[] args) {
+        PrintStream results = System.out;
+        // output of the tests must not interleave with the result lines
+        System.setOut(System.err);
+        if (args.length > 0 && args[0].equals("--fail-fast")) {
+            runAll(Arrays.copyOfRange(args, 1, args.length), true, results, System.err);
+        } else {
+            runAll(args, false, results, System.err);
+        }
+        // tests may leave non daemon threads behind
+        System.exit(0);
+    }
+
+    public static void runAll(String[] tests, PrintStream out, PrintStream err) {
+        runAll(tests, false, out, err);
+    }
+
+    public static void runAll(String[] tests, boolean failFast, PrintStream out, PrintStream err) {
+        JUnitCore core = new JUnitCore();
+        ClassLoader loader = TestRunner.class.getClassLoader();
+        for (String test : tests) {
+            if (!run(core, test, loader, out, err) && failFast) {
+                break;
+            }
+        }
+        out.flush();
+        err.flush();
+    }
+
+    static boolean run(JUnitCore core, String test, ClassLoader loader, PrintStream out, PrintStream err) {
+        String className = test;
+        String method = null;
+        int sep = test.indexOf("::");
+        if (sep >= 0) {
+            className = test.substring(0, sep);
+            method = test.substring(sep + 2);
+        }
+        long start = System.currentTimeMillis();
+        boolean passed;
+        try {
+            Class<?> cls = Class.forName(className, false, loader);
+            Request request = method == null ? Request.aClass(cls) : Request.method(cls, method);
+            Result result = core.run(request);
+            passed = result.wasSuccessful() && result.getRunCount() > 0;
+            for (Failure failure : result.getFailures()) {
+                String failed = failure.getDescription().getClassName() + "::"
+                        + failure.getDescription().getMethodName();
+                out.println(PREFIX + "FAILED_METHOD " + failed);
+                err.println(PREFIX + "TRACE " + failed);
+                err.println(failure.getTrace());
+            }
+        } catch (Throwable t) {
+            passed = false;
+            out.println(PREFIX + "FAILED_METHOD " + test);
+            err.println(PREFIX + "TRACE " + test);
+            t.printStackTrace(err);
+        }
+        long millis = System.currentTimeMillis() - start;
+        out.println(PREFIX + (passed ? "PASS " : "FAIL ") + test + " " + millis);
+        out.flush();
+        return passed;
+    }
+}
@@ -0,0 +1,123 @@
+import os
+import json
+import numpy as np
+from scipy.spatial.distance import cdist
+
+# screening distances within this (relative, for euclidean) distance of the
+# k-th best are ranked again with cdist, well above float64 rounding
+SCREEN_TOLERANCE = 1e-9
+
+
+class ShotIndex:
+    """Exact top-k nearest neighbour search over a corpus of embeddings
+
+    Distances are first computed with blocked matrix products, so memory
+    stays at query_block x corpus_block. Of each block only the candidates
+    within SCREEN_TOLERANCE of the k-th best are kept, and these are ranked
+    again with scipy's cdist, so that the result is the one of a full cdist
+    and argsort. Supports 'euclidean' and 'cosine' metrics.
+    """
+
+    def __init__(self, corpus, keys, metric='euclidean', query_block=256, corpus_block=16384):
+        assert metric in ('euclidean', 'cosine'), "Unsupported metric " + metric
+        assert len(keys) == len(corpus), "One key per corpus row is needed"
+        self.corpus = corpus
+        self.keys = list(keys)
+        self.key_to_row = {key: row for row, key in enumerate(self.keys)}
+        self.metric = metric
+        self.query_block = query_block
+        self.corpus_block = corpus_block
+        self.norms = self.row_norms(corpus)
+        # squared norms bound the rounding error of the expanded euclidean distances
+        self.max_norm = float(self.norms.max(initial=0.0))
+
+    def row_norms(self, matrix):
+        norms = np.empty(len(matrix), dtype=np.float64)
+        for start in range(0, len(matrix), self.corpus_block):
+            block = np.asarray(matrix[start:start + self.corpus_block], dtype=np.float64)
+            if self.metric == 'cosine':
+                norms[start:start + len(block)] = np.linalg.norm(block, axis=1)
+            else:
+                norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+        return norms
+
+    def block_distances(self, queries, query_norms, start, stop):
+        """Screening distances of the block, squared for euclidean"""
+        block = np.asarray(self.corpus[start:stop], dtype=np.float64)
+        products = queries @ block.T
+        if self.metric == 'cosine':
+            denominator = np.maximum(np.outer(query_norms, self.norms[start:stop]), 1e-12)
+            return 1.0 - products / denominator
+        return query_norms[:, None] + self.norms[None, start:stop] - 2.0 * products
+
+    def screen_tolerance(self, query_norms):
+        """Twice the rounding error a screening distance may have, per query"""
+        if self.metric == 'cosine':
+            return np.full(len(query_norms), SCREEN_TOLERANCE)
+        return SCREEN_TOLERANCE * (query_norms + self.max_norm)
+
+    def query(self, queries, k, exclude=None):
+        """Keys and distances of the k closest corpus rows for every query row
+
+        exclude optionally gives, per query, a corpus key that must not be
+        returned (the query bug itself). Neighbours are ordered by their
+        cdist distance, ties by corpus row.
+        """
+        k = min(k, len(self.keys) - (1 if exclude is not None else 0))
+        if k <= 0:
+            return [[] for _ in queries], [np.zeros(0) for _ in queries]
+        queries = np.asarray(queries, dtype=np.float64)
+        all_keys, all_distances = [], []
+        for qstart in range(0, len(queries), self.query_block):
+            block_queries = queries[qstart:qstart + self.query_block]
+            query_norms = self.row_norms(block_queries)
+            tolerance = self.screen_tolerance(query_norms)
+            best_rows = np.zeros((len(block_queries), 0), dtype=np.int64)
+            best_distances = np.zeros((len(block_queries), 0), dtype=np.float64)
+            for start in range(0, len(self.keys), self.corpus_block):
+                stop = min(start + self.corpus_block, len(self.keys))
+                distances = self.block_distances(block_queries, query_norms, start, stop)
+                if exclude is not None:
+                    for i, key in enumerate(exclude[qstart:qstart + self.query_block]):
+                        row = self.key_to_row.get(key)
+                        if row is not None and start <= row < stop:
+                            distances[i, row - start] = np.inf
+                rows = np.broadcast_to(np.arange(start, stop), distances.shape)
+                distances = np.concatenate([best_distances, distances], axis=1)
+                rows = np.concatenate([best_rows, rows], axis=1)
+                if distances.shape[1] > k:
+                    # every row within the tolerance of the k-th best may be among the exact k best
+                    kth = np.partition(distances, k - 1, axis=1)[:, k - 1]
+                    candidates = distances <= (kth + tolerance)[:, None]
+                    width = int(candidates.sum(axis=1).max())
+                    if width < distances.shape[1]:
+                        top = np.argpartition(distances, width - 1, axis=1)[:, :width]
+                        distances = np.take_along_axis(distances, top, axis=1)
+                        rows = np.take_along_axis(rows, top, axis=1)
+                    # rows past the tolerance of their query only pad to width
+                    distances = np.where(distances <= (kth + tolerance)[:, None], distances, np.inf)
+                best_distances, best_rows = distances, rows
+            for query, distances, rows in zip(block_queries, best_distances, best_rows):
+                rows = np.sort(rows[np.isfinite(distances)])
+                exact = cdist(query[None, :], np.asarray(self.corpus[rows], dtype=np.float64), self.metric)[0]
+                order = np.lexsort((rows, exact))[:k]
+                all_keys.append([self.keys[row] for row in rows[order]])
+                all_distances.append(exact[order])
+        return all_keys, all_distances
+
+    def save(self, path):
+        np.save(path + '.npy', np.asarray(self.corpus, dtype=np.float32))
+        with open(path + '.json', 'w') as f:
+            json.dump({'keys': self.keys, 'metric': self.metric}, f)
+
+    @staticmethod
+    def load(path):
+        """Load a saved index, the corpus matrix is memory mapped"""
+        with open(path + '.json', 'r') as f:
+            meta = json.load(f)
+        corpus = np.load(path + '.npy', mmap_mode='r')
+        return ShotIndex(corpus, meta['keys'], meta['metric'])
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + '.json') and os.path.exists(path + '.npy')
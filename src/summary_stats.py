@@ -1,74 +1,160 @@
-
-
-import time
-from datetime import datetime
-import openai
-import config
-import os 
-from dotenv import load_dotenv
+import os
 import json
-import query_model as qm
 import argparse
-import jsonlines
-import pandas
 import numpy as np
 
 def parse_command_line_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--i', type=str,  help='path to directory containing validated patch files')
     parser.add_argument('--prune_compilation', action='store_true',  help='Flag to prune compilation failures')
-    return parser.parse_args() 
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 5, 20, 100], help='k values of pass@k')
+    parser.add_argument('--num_bugs', type=int, help='Number of bugs to average over, bugs without a result file count as not fixed. Default is the number of bugs found')
+    parser.add_argument('--by_project', action='store_true', help='Also report pass@k per project')
+    parser.add_argument('--bootstrap', type=int, default=1000, help='Bootstrap resamples of the bugs for 95%% confidence intervals, 0 disables them')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the bootstrap resamples')
+    return parser.parse_args()
 
+# unbiased estimator of a single bug, the reference pass_at_k_matrix is tested against
 def get_pass_at_k(n, c, k):
     if n - c < k : return 1.0
     return 1.0 - np.prod(1.0 - k / np.arange(n - c + 1, n + 1))
 
-def pass_at_k(input_dir, k, prune_compilation):
-    p_k_list = []
+def is_correct(patch):
+    return patch['correctness'] == 'plausible' and patch['failing_relevant'] == 0
+
+def read_results(input_dir):
+    """Per bug key: number of patches, compilable patches and correct patches,
+    and the early stop entry, reading every result file once"""
+    bugs = {}
+    for file in sorted(os.listdir(input_dir)):
+        if not file.endswith('.jsonl'):
+            continue
+        file_path = os.path.join(input_dir, file)
+        try:
+            with open(file_path, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    for key, result in json.loads(line).items():
+                        patches = result['patches']
+                        bugs[key] = {
+                            'n': len(patches),
+                            'compilable': sum(1 for p in patches if "uncompilable" not in str(p['correctness'])),
+                            'c': sum(1 for p in patches if is_correct(p)),
+                            'early_stop': result.get('early_stop'),
+                            'coverage_audit': result.get('coverage_audit'),
+                        }
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print("Error in file: " + file + ": " + repr(e))
+    return bugs
+
+def pass_at_k_matrix(n, c, ks):
+    """pass@k of every bug (columns) for every k (rows), with k capped at n
+
+    Uses 1 - C(n - c, k) / C(n, k), computed from log factorials so that
+    all bugs and k values are handled in one pass. Bugs without patches
+    get 0.
+    """
+    n = np.asarray(n, dtype=np.int64)
+    c = np.asarray(c, dtype=np.int64)
+    ks = np.asarray(ks, dtype=np.int64)[:, None]
+    k = np.minimum(ks, n[None, :])
+    # log_factorial[m] = log(m!)
+    log_factorial = np.concatenate([[0.0], np.cumsum(np.log(np.arange(1, max(int(n.max(initial=0)), 1) + 1)))])
+    wrong = (n - c)[None, :]
+    enough_wrong = wrong >= k
+    safe_rest = np.where(enough_wrong, wrong - k, 0)
+    log_ratio = log_factorial[np.where(enough_wrong, wrong, 0)] - log_factorial[safe_rest] \
+        - log_factorial[n][None, :] + log_factorial[np.maximum(n[None, :] - k, 0)]
+    result = np.where(enough_wrong, 1.0 - np.exp(log_ratio), 1.0)
+    return np.where(n[None, :] > 0, result, 0.0)
+
+def bootstrap_intervals(per_bug, num_bugs, resamples, seed):
+    """95% percentile intervals of the mean pass@k over bugs resampled with replacement"""
+    rng = np.random.default_rng(seed)
+    # bugs without a result file are resampled as zeros
+    padded = np.zeros((per_bug.shape[0], num_bugs))
+    padded[:, :per_bug.shape[1]] = per_bug
+    means = np.empty((per_bug.shape[0], resamples))
+    # in chunks, so memory stays bounded for many bugs
+    chunk = max(1, 10 ** 6 // max(num_bugs, 1))
+    for start in range(0, resamples, chunk):
+        stop = min(start + chunk, resamples)
+        idx = rng.integers(0, num_bugs, size=(stop - start, num_bugs))
+        means[:, start:stop] = padded[:, idx].mean(axis=2)
+    return np.percentile(means, [2.5, 97.5], axis=1)
 
-    for file in os.listdir(input_dir):
-        if file.endswith('.jsonl'):
-            file_path = os.path.join(input_dir, file)
-            try:
-                correct = 0
-                total = 0
-                jsonObj = pandas.read_json(path_or_buf=file_path, lines=True)
-                
-                for i in jsonObj:
-                    if len (jsonObj[i][0]['patches']) > 0:
-                        prune_comp_failures = []
-                        for p in jsonObj[i][0]['patches']:
-                            if "uncompilable" not in p['correctness'] :
-                                prune_comp_failures.append(p)
-                            if [p][0]['correctness'] == 'plausible':
-                               # if "failing_relevant" in [p][0]:
-                                    if [p][0]['failing_relevant'] == 0:
-                                        correct += 1
-                   
-                if prune_compilation:
-                    total = len(prune_comp_failures)
-                else:
-                    total = len(jsonObj[i][0]['patches'])
-                p_k = get_pass_at_k(total, correct, min(k, total))
-                p_k_list.append(p_k)
-            except:
-                print("Error in file: " + file)
-    
-    p_k_avg = sum(p_k_list)/283 #number of bugs in D4J-nl2fix
-    
-    return p_k_avg
+def skipped_patches(bug):
+    """Unique patches a stopping policy left without a verdict"""
+    early_stop = bug['early_stop']
+    return early_stop['skipped'] if early_stop and early_stop.get('stopped') else 0
+
+def pass_at_k_bounds(bugs, ks, prune_compilation):
+    """Lower and upper pass@k of every bug (columns) for every k (rows)
+
+    The patches validated before first_plausible or n_plausible stopped
+    over-represent plausible ones, so the skipped patches are counted as
+    wrong for the lower and as plausible for the upper bound. Both are the
+    same for bugs validated completely, and for pass_at_k at every k it
+    stopped for.
+    """
+    n = np.array([bug['compilable' if prune_compilation else 'n'] for bug in bugs], dtype=np.int64)
+    c = np.array([bug['c'] for bug in bugs], dtype=np.int64)
+    skipped = np.array([skipped_patches(bug) for bug in bugs], dtype=np.int64)
+    return pass_at_k_matrix(n + skipped, c, ks), pass_at_k_matrix(n + skipped, c + skipped, ks)
+
+def summarize(bugs, ks, prune_compilation, num_bugs=None, resamples=0, seed=0):
+    """Lower and upper mean pass@k over bugs for every k, see pass_at_k_bounds,
+    with optional bootstrap intervals from the low end of the lower to the
+    high end of the upper bound"""
+    lower, upper = pass_at_k_bounds(list(bugs.values()), ks, prune_compilation)
+    num_bugs = max(num_bugs or len(bugs), len(bugs))
+    means = (lower.sum(axis=1) / max(num_bugs, 1), upper.sum(axis=1) / max(num_bugs, 1))
+    intervals = None
+    if resamples > 0 and num_bugs > 0:
+        # the same seed resamples the same bugs for both bounds
+        intervals = (bootstrap_intervals(lower, num_bugs, resamples, seed)[0],
+                     bootstrap_intervals(upper, num_bugs, resamples, seed)[1])
+    return means, intervals
+
+def format_line(name, ks, means, intervals):
+    parts = []
+    for i, k in enumerate(ks):
+        part = "Pass@" + str(k) + ": " + str(means[0][i] * 100) + "%"
+        if not np.isclose(means[0][i], means[1][i]):
+            part += " to " + str(means[1][i] * 100) + "%"
+        if intervals is not None:
+            part += " [" + str(intervals[0][i] * 100) + ", " + str(intervals[1][i] * 100) + "]"
+        parts.append(part)
+    return name + "\n" + "\n".join(parts) if name else "\n".join(parts)
 
 if __name__ == '__main__':
     args = parse_command_line_args()
-    input_dir =  args.i
-    prune_compilation = args.prune_compilation
-    p1 = pass_at_k(input_dir, 1, prune_compilation)
-    print ("Pass@1: " + (str(p1*100)) + "%" )
-    p2 = pass_at_k(input_dir, 5, prune_compilation)
-    print ("Pass@5: " + str(p2*100) + "%" )
-    p3 = pass_at_k(input_dir, 20, prune_compilation)
-    print ("Pass@20: " + str(p3*100) + "%")
-    p4 = pass_at_k(input_dir, 100, prune_compilation)
-    print ("Pass@100: " + str(p4*100) + "%")
-    
-
+    bugs = read_results(args.i)
+    means, intervals = summarize(bugs, args.k, args.prune_compilation, args.num_bugs, args.bootstrap, args.seed)
+    print("Bugs: " + str(max(args.num_bugs or len(bugs), len(bugs))) + " (" + str(len(bugs)) + " with results)")
+    bounded = sum(1 for bug in bugs.values() if skipped_patches(bug) > 0)
+    if bounded > 0:
+        print("Pass@k from bugs stopped early is a range: " + str(bounded) + " bugs with skipped patches counted as wrong,"
+              + " then as plausible")
+    print(format_line("", args.k, means, intervals))
+    if args.by_project:
+        projects = sorted(set(key.split('_')[0] for key in bugs))
+        for project in projects:
+            project_bugs = {key: bug for key, bug in bugs.items() if key.split('_')[0] == project}
+            means, intervals = summarize(project_bugs, args.k, args.prune_compilation, None, args.bootstrap, args.seed)
+            print(format_line(project + " (" + str(len(project_bugs)) + " bugs)", args.k, means, intervals))
+    early_stops = [bug['early_stop'] for bug in bugs.values() if bug['early_stop']]
+    stopped = [s for s in early_stops if s.get('stopped')]
+    if len(stopped) > 0:
+        print ("Stopped early: " + str(len(stopped)) + " bugs, " + str(sum(s['skipped'] for s in stopped)) + " patches skipped")
+    deadline = sum(s.get('deadline', 0) for s in early_stops)
+    if deadline > 0:
+        print ("Deadline reached: " + str(deadline) + " patches without a verdict")
+    audits = [bug['coverage_audit'] for bug in bugs.values() if bug['coverage_audit']]
+    if len(audits) > 0:
+        audited = sum(a['audited'] for a in audits)
+        missed = sum(a['missed'] for a in audits)
+        print ("Coverage selection: " + str(sum(a['selected'] for a in audits)) + " of " + str(sum(a['relevant'] for a in audits)) + " relevant test classes run")
+        print ("Coverage audits: " + str(audited) + " patches, " + str(missed) + " with failures the selection missed"
+               + (" (" + str(missed / audited * 100) + "%)" if audited > 0 else ""))
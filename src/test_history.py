@@ -0,0 +1,143 @@
+import time
+import sqlite3
+import threading
+
+# prior of a test without history, as PRIOR_FAILURES failures in PRIOR_RUNS runs
+PRIOR_FAILURES = 1
+PRIOR_RUNS = 10
+# milliseconds a test is assumed to take before it was ever timed
+DEFAULT_MILLIS = 1000
+# how a test was run, durations of one kind do not predict the other:
+# the JVM runner times the test itself, a defects4j test -t call also
+# starts ant and checks the build
+JVM = 'jvm'
+DEFECTS4J = 'd4j'
+
+
+class TestStats:
+
+    def __init__(self, runs=0, failures=0, timed_runs=0, total_millis=0):
+        self.runs = runs
+        self.failures = failures
+        self.timed_runs = timed_runs
+        self.total_millis = total_millis
+
+    def add(self, passed, millis):
+        self.runs += 1
+        self.failures += 0 if passed else 1
+        if millis is not None:
+            self.timed_runs += 1
+            self.total_millis += millis
+
+    def failure_probability(self):
+        return (self.failures + PRIOR_FAILURES) / (self.runs + PRIOR_RUNS)
+
+    def mean_millis(self):
+        return self.total_millis / self.timed_runs if self.timed_runs > 0 else None
+
+
+class TestHistory:
+    """Outcomes and durations of tests per bug, across patches and runs
+
+    Tests (trigger methods or relevant classes) are ordered by failure
+    probability over expected cost, so that a run stopping at the first
+    failure reaches a failing test early. Stats are kept per kind of run
+    (JVM or DEFECTS4J): the failure probability counts the outcomes of both,
+    the expected cost only the durations of the kind the tests run with.
+    Stats are kept in memory while a bug is validated and added to the
+    SQLite file on flush, several validation processes share the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS test_runs ('
+            'bug TEXT, test TEXT, kind TEXT, runs INTEGER, failures INTEGER, timed_runs INTEGER, total_millis REAL, '
+            'updated REAL, PRIMARY KEY (bug, test, kind))'
+        )
+        # the tests table of files written before durations were kept per kind mixes both, it is dropped
+        self.conn.execute('DROP TABLE IF EXISTS tests')
+        self.conn.commit()
+        # bug -> (test, kind) -> TestStats, and the outcomes not yet written
+        self.stats = {}
+        self.pending = {}
+
+    def load(self, bug):
+        if bug not in self.stats:
+            rows = self.conn.execute(
+                'SELECT test, kind, runs, failures, timed_runs, total_millis FROM test_runs WHERE bug = ?', (bug,)
+            ).fetchall()
+            self.stats[bug] = {(row[0], row[1]): TestStats(*row[2:]) for row in rows}
+        return self.stats[bug]
+
+    def record(self, bug, test, kind, passed, millis=None):
+        """Outcome of a test run with kind, and its duration in milliseconds when it was timed"""
+        with self.lock:
+            self.load(bug).setdefault((test, kind), TestStats()).add(passed, millis)
+            self.pending.setdefault((bug, test, kind), TestStats()).add(passed, millis)
+
+    @staticmethod
+    def outcomes(stats, test):
+        """Runs and failures of test over every kind of run"""
+        runs = [stats[(test, kind)] for kind in (JVM, DEFECTS4J) if (test, kind) in stats]
+        return TestStats(sum(s.runs for s in runs), sum(s.failures for s in runs))
+
+    @staticmethod
+    def mean_millis(stats, test, kind):
+        return stats[(test, kind)].mean_millis() if (test, kind) in stats else None
+
+    def order(self, bug, tests, kind):
+        """tests by failure probability over expected cost when run with kind, ties keep their order"""
+        with self.lock:
+            stats = self.load(bug)
+            known = [self.mean_millis(stats, test, kind) for test in tests]
+            known = [millis for millis in known if millis is not None]
+            default_millis = sorted(known)[len(known) // 2] if len(known) > 0 else DEFAULT_MILLIS
+            scores = {}
+            for test in tests:
+                millis = self.mean_millis(stats, test, kind)
+                scores[test] = self.outcomes(stats, test).failure_probability() / max(millis if millis is not None else default_millis, 1)
+        return sorted(tests, key=lambda test: -scores[test])
+
+    def expected_seconds(self, bug, tests, kind):
+        """Summed mean duration of the tests that were timed when run with kind, and the tests that never were"""
+        with self.lock:
+            stats = self.load(bug)
+            seconds = 0
+            untimed = []
+            for test in tests:
+                millis = self.mean_millis(stats, test, kind)
+                if millis is None:
+                    untimed.append(test)
+                else:
+                    seconds += millis / 1000
+        return seconds, untimed
+
+    def failed_before(self, bug, tests, kind):
+        """tests that failed at least once, most likely to fail first when run with kind"""
+        with self.lock:
+            stats = self.load(bug)
+            failed = [test for test in tests if self.outcomes(stats, test).failures > 0]
+        return self.order(bug, failed, kind)
+
+    def flush(self):
+        with self.lock:
+            rows = [(bug, test, kind, s.runs, s.failures, s.timed_runs, s.total_millis, time.time())
+                    for (bug, test, kind), s in self.pending.items()]
+            self.pending = {}
+            if len(rows) == 0:
+                return
+            self.conn.executemany(
+                'INSERT INTO test_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (bug, test, kind) DO UPDATE SET '
+                'runs = runs + excluded.runs, failures = failures + excluded.failures, '
+                'timed_runs = timed_runs + excluded.timed_runs, '
+                'total_millis = total_millis + excluded.total_millis, updated = excluded.updated',
+                rows
+            )
+            self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
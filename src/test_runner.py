@@ -0,0 +1,220 @@
+import os
+import time
+import fcntl
+import select
+import signal
+import subprocess
+import command_runner
+import tracing
+
+RUNNER_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'runner')
+RUNNER_BUILD_DIR = os.path.join(RUNNER_DIR, 'build')
+RESULT_PREFIX = '##nl2fix '
+
+# compiled class -> source of the java helpers in runner/
+RUNNER_CLASSES = {'TestRunner.class': 'TestRunner.java', 'TestDaemon.class': 'TestDaemon.java'}
+
+# cp.test of each working copy, it holds absolute paths into the copy
+classpaths = {}
+# running TestDaemon per working copy
+daemons = {}
+
+
+def get_test_classpath(project_dir, timeout=300):
+    if project_dir not in classpaths:
+        result = command_runner.run_command(["defects4j", "export", "-p", "cp.test"], timeout, cwd=project_dir)
+        if result.timed_out or result.returncode != 0 or not result.out.strip():
+            return None
+        classpaths[project_dir] = result.out.strip()
+    return classpaths[project_dir]
+
+
+def ensure_runner_compiled(classpath):
+    """Compile the java sources in runner/ once, they only need junit from classpath"""
+    sources = [os.path.join(RUNNER_DIR, name) for name in RUNNER_CLASSES.values()]
+    compiled = [os.path.join(RUNNER_BUILD_DIR, name) for name in RUNNER_CLASSES]
+    os.makedirs(RUNNER_BUILD_DIR, exist_ok=True)
+    with open(os.path.join(RUNNER_BUILD_DIR, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if all(os.path.exists(c) for c in compiled) and \
+                    min(os.path.getmtime(c) for c in compiled) >= max(os.path.getmtime(s) for s in sources):
+                return True
+            result = command_runner.run_command(["javac", "-cp", classpath, "-d", RUNNER_BUILD_DIR] + sources, 300)
+            if result.timed_out or result.returncode != 0:
+                print("Could not compile the test runner", result.err)
+                return False
+            return True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def parse_results(out):
+    """Per test results and failing methods from the runner output"""
+    results = {}
+    failed_methods = []
+    for line in str(out).splitlines():
+        if not line.startswith(RESULT_PREFIX):
+            continue
+        fields = line[len(RESULT_PREFIX):].split(' ')
+        if fields[0] == 'FAILED_METHOD' and len(fields) >= 2:
+            failed_methods.append(fields[1])
+        elif fields[0] in ('PASS', 'FAIL') and len(fields) >= 3:
+            results[fields[1]] = {'passed': fields[0] == 'PASS', 'millis': int(fields[2])}
+    return results, failed_methods
+
+
+def reported_all(results, tests, fail_fast):
+    """Every test has a result, or with fail_fast the tests up to the first failure"""
+    if fail_fast:
+        for test in tests:
+            if test not in results:
+                return False
+            if not results[test]['passed']:
+                return True
+        return True
+    return all(test in results for test in tests)
+
+
+def run_tests(project_dir, tests, timeout=300, fail_fast=False):
+    """Run tests of a compiled checkout in one JVM, in the given order
+
+    Returns (results, failed_methods, out, err), results is None when the
+    runner could not be used or did not report every test, so the caller
+    can fall back to defects4j test. With fail_fast the tests after the
+    first failing one are not run and have no result.
+    """
+    classpath = get_test_classpath(project_dir)
+    if classpath is None or not ensure_runner_compiled(classpath):
+        return None, [], '', ''
+    cmd = ["java", "-cp", classpath + os.pathsep + RUNNER_BUILD_DIR, "TestRunner"]
+    if fail_fast:
+        cmd.append("--fail-fast")
+    result = command_runner.run_command(cmd + list(tests), timeout, cwd=project_dir)
+    if result.timed_out:
+        return None, [], 'TIMEOUT', 'TIMEOUT'
+    results, failed_methods = parse_results(result.out)
+    if not reported_all(results, tests, fail_fast):
+        return None, failed_methods, result.out, result.err
+    return results, failed_methods, result.out, result.err
+
+
+class TestDaemon:
+    """A warm JVM for one working copy, see runner/TestDaemon.java"""
+
+    def __init__(self, project_dir, classpath):
+        self.project_dir = project_dir
+        self.err_path = os.path.join(project_dir, '.nl2fix-daemon.err')
+        self.err_file = open(self.err_path, 'w')
+        self.err_offset = 0
+        self.buffer = b''
+        self.ready = False
+        self.proc = subprocess.Popen(
+            ["java", "-cp", RUNNER_BUILD_DIR, "TestDaemon", RUNNER_BUILD_DIR, classpath],
+            cwd=project_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.err_file,
+            start_new_session=True
+        )
+        command_runner.running_groups.add(self.proc.pid)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def read_until(self, marker, timeout):
+        """Lines up to marker, or None on crash or timeout"""
+        deadline = time.time() + timeout
+        lines = []
+        fd = self.proc.stdout.fileno()
+        while True:
+            while b'\n' in self.buffer:
+                line, self.buffer = self.buffer.split(b'\n', 1)
+                line = line.decode('utf-8', errors='replace')
+                if line == RESULT_PREFIX + marker:
+                    return lines
+                lines.append(line)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if ready:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    return None
+                self.buffer += chunk
+
+    def read_err(self):
+        with open(self.err_path, 'r', errors='replace') as f:
+            f.seek(self.err_offset)
+            err = f.read()
+            self.err_offset = f.tell()
+        return err
+
+    def run(self, tests, timeout, fail_fast=False):
+        timeout = command_runner.clip_timeout(timeout)
+        if not self.ready:
+            with tracing.span('jvm-start') as span:
+                ready = self.read_until('READY', min(timeout, 120)) is not None
+                span.status = 'ok' if ready else 'fail'
+            if not ready:
+                return None, [], '', self.read_err()
+            self.ready = True
+        try:
+            command = 'RUN_FAIL_FAST' if fail_fast else 'RUN'
+            self.proc.stdin.write((command + '\t' + '\t'.join(tests) + '\n').encode('utf-8'))
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return None, [], '', ''
+        lines = self.read_until('DONE', timeout)
+        if lines is None:
+            # crashed or timed out, the caller falls back to defects4j test
+            return None, [], '', self.read_err()
+        out = '\n'.join(lines)
+        results, failed_methods = parse_results(out)
+        if not reported_all(results, tests, fail_fast):
+            return None, failed_methods, out, self.read_err()
+        return results, failed_methods, out, self.read_err()
+
+    def stop(self, kill=False):
+        if self.alive() and kill:
+            command_runner.kill_group(self.proc.pid, signal.SIGKILL)
+            self.proc.wait()
+        elif self.alive():
+            try:
+                self.proc.stdin.write(b'QUIT\n')
+                self.proc.stdin.flush()
+                self.proc.wait(timeout=10)
+            except Exception:
+                command_runner.kill_group(self.proc.pid, signal.SIGKILL)
+                self.proc.wait()
+        command_runner.running_groups.discard(self.proc.pid)
+        self.err_file.close()
+
+
+def run_tests_in_daemon(project_dir, tests, timeout=300, fail_fast=False):
+    """Like run_tests, but through the warm JVM of project_dir
+
+    A crashed or timed out daemon is stopped and results is None, so the
+    caller falls back to defects4j test. The next call starts a new daemon.
+    """
+    classpath = get_test_classpath(project_dir)
+    if classpath is None or not ensure_runner_compiled(classpath):
+        return None, [], '', ''
+    daemon = daemons.get(project_dir)
+    if daemon is None or not daemon.alive():
+        daemon = TestDaemon(project_dir, classpath)
+        daemons[project_dir] = daemon
+    results, failed_methods, out, err = daemon.run(tests, timeout, fail_fast)
+    if results is None:
+        print('Test daemon failed for', project_dir)
+        stop_daemon(project_dir, kill=True)
+    return results, failed_methods, out, err
+
+
+def stop_daemon(project_dir, kill=False):
+    daemon = daemons.pop(project_dir, None)
+    if daemon is not None:
+        daemon.stop(kill)
+
+
+def stop_daemons():
+    for project_dir in list(daemons):
+        stop_daemon(project_dir)
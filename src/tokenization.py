@@ -0,0 +1,51 @@
+import re
+import hashlib
+
+# longest operators first so that e.g. '>>>=' is not split
+JAVA_OPERATORS = [
+    '>>>=', '<<=', '>>=', '>>>', '...', '->', '::', '++', '--', '&&', '||',
+    '==', '!=', '<=', '>=', '+=', '-=', '*=', '/=', '&=', '|=', '^=', '%=',
+    '<<', '>>',
+]
+
+JAVA_TOKEN = re.compile(
+    r'(?P<space>\s+)'
+    r'|(?P<line_comment>//[^\n]*)'
+    r'|(?P<block_comment>/\*(?:.*?(?P<block_comment_end>\*/)|.*))'
+    r'|(?P<text_block>"""(?:(?:\\.|[^\\])*?(?P<text_block_end>""")|.*))'
+    r'|(?P<string>"(?:\\.|[^"\\\n])*(?P<string_end>")?)'
+    r'|(?P<char>\'(?:\\.|[^\'\\\n])*(?P<char_end>\')?)'
+    r'|(?P<number>(?:0[xX][0-9a-fA-F_]+|0[bB][01_]+|(?:\d[\d_]*)?\.?\d[\d_]*(?:[eE][+-]?\d+)?)[lLfFdD]?)'
+    r'|(?P<word>[A-Za-z_$][\w$]*)'
+    r'|(?P<operator>' + '|'.join(re.escape(op) for op in JAVA_OPERATORS) + r'|.)',
+    re.DOTALL
+)
+
+# token kinds that have to be closed
+TERMINATED_KINDS = ('block_comment', 'text_block', 'string', 'char')
+
+
+def java_tokens(code):
+    """(kind, text, terminated) of every lexical element of code, including
+    whitespace and comments. terminated is False for a literal or comment
+    that runs into the end of the code."""
+    for match in JAVA_TOKEN.finditer(code or ''):
+        kind = match.lastgroup
+        terminated = kind not in TERMINATED_KINDS or match.group(kind + '_end') is not None
+        yield kind, match.group(), terminated
+
+
+def tokenize_java(code):
+    """Java tokens of code, without whitespace and comments"""
+    return [text for kind, text, _ in java_tokens(code)
+            if kind not in ('space', 'line_comment', 'block_comment')]
+
+
+def normalize_patch(code):
+    """Canonical form of a patch, equal for patches that only differ in
+    whitespace, comments or brace layout"""
+    return ' '.join(tokenize_java(code))
+
+
+def patch_hash(code):
+    return hashlib.sha256(normalize_patch(code).encode('utf-8')).hexdigest()
@@ -0,0 +1,94 @@
+import json
+import argparse
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--i', type=str, help='path to the jsonl trace written by validate.py --trace')
+    parser.add_argument('--chrome', type=str, help='Also write the trace in Chrome trace event format, for chrome://tracing or ui.perfetto.dev')
+    parser.add_argument('--top', type=int, default=5, help='Number of stages reported per project')
+    return parser.parse_args()
+
+def read_trace(trace_file):
+    events = []
+    with open(trace_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                events.append(json.loads(line))
+    return events
+
+def stage_name(event):
+    if event['stage'] == 'command' and event.get('cmd'):
+        return 'command ' + event['cmd']
+    return event['stage']
+
+def covered_seconds(start, end, intervals):
+    """Seconds of start to end covered by any of the (start, end) intervals"""
+    covered = 0
+    reached = start
+    for interval_start, interval_end in sorted(intervals):
+        interval_start = max(interval_start, reached)
+        interval_end = min(interval_end, end)
+        if interval_end > interval_start:
+            covered += interval_end - interval_start
+            reached = interval_end
+    return covered
+
+def self_times(events):
+    """Seconds of each span while none of its child spans ran. Children on
+    other threads, like the patches of a bug validated in parallel, overlap,
+    so their intervals are merged rather than summed"""
+    children = {}
+    for event in events:
+        if event['parent'] is not None:
+            children.setdefault(event['parent'], []).append((event['start'], event['start'] + event['duration']))
+    own = {}
+    for event in events:
+        end = event['start'] + event['duration']
+        own[event['id']] = event['duration'] - covered_seconds(event['start'], end, children.get(event['id'], []))
+    return own
+
+def summarize(events):
+    """project -> stage -> [self seconds, total seconds, count]"""
+    own = self_times(events)
+    projects = {}
+    for event in events:
+        project = event['bug'].split('_')[0] if event['bug'] else '-'
+        stats = projects.setdefault(project, {}).setdefault(stage_name(event), [0.0, 0.0, 0])
+        stats[0] += own[event['id']]
+        stats[1] += event['duration']
+        stats[2] += 1
+    return projects
+
+def to_chrome(events):
+    """Complete ("X") events with microsecond timestamps, one track per process and thread"""
+    origin = min((event['start'] for event in events), default=0)
+    trace_events = []
+    for event in events:
+        args = {key: value for key, value in event.items() if key not in ('id', 'parent', 'stage', 'start', 'duration', 'pid', 'tid')}
+        trace_events.append({
+            'name': stage_name(event),
+            'cat': event['bug'] or '-',
+            'ph': 'X',
+            'ts': (event['start'] - origin) * 1e6,
+            'dur': event['duration'] * 1e6,
+            'pid': event['pid'],
+            'tid': event['tid'],
+            'args': args,
+        })
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+if __name__ == '__main__':
+    args = parse_command_line_args()
+    events = read_trace(args.i)
+    if args.chrome:
+        with open(args.chrome, 'w') as f:
+            json.dump(to_chrome(events), f)
+    projects = summarize(events)
+    for project in sorted(projects):
+        stages = projects[project]
+        total = sum(stats[0] for stats in stages.values())
+        print(project + " (" + str(round(total, 1)) + "s)")
+        for stage, stats in sorted(stages.items(), key=lambda item: -item[1][0])[:args.top]:
+            share = stats[0] / total * 100 if total > 0 else 0
+            print("  " + stage + ": " + str(round(stats[0], 1)) + "s self, " + str(round(stats[1], 1)) + "s total, "
+                  + str(stats[2]) + " spans, " + str(round(share, 1)) + "%")
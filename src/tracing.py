@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+# jsonl file that gets one event per finished span, see set_trace_file
+trace_file = None
+# open spans of the current thread, innermost last
+local = threading.local()
+
+
+def set_trace_file(path):
+    global trace_file
+    trace_file = path
+
+
+class Span:
+
+    def __init__(self, stage, bug, patch, fields):
+        self.stage = stage
+        self.bug = bug
+        self.patch = patch
+        self.fields = fields
+        # exit status, e.g. the return code of a command or the verdict of a patch
+        self.status = 'ok'
+        self.id = None
+        self.parent = None
+        self.start = time.time()
+        self.clock = time.monotonic()
+
+
+def open_spans():
+    if not hasattr(local, 'stack'):
+        local.stack = []
+    return local.stack
+
+
+def start(stage, bug=None, patch=None, **fields):
+    """Open a span of the current thread, bug and patch default to those of
+    the enclosing span. Spans are only written with a trace file set."""
+    stack = open_spans()
+    parent = stack[-1] if len(stack) > 0 else None
+    if parent is not None:
+        bug = parent.bug if bug is None else bug
+        patch = parent.patch if patch is None else patch
+    span = Span(stage, bug, patch, fields)
+    if trace_file is not None:
+        span.id = uuid.uuid4().hex
+        span.parent = parent.id if parent is not None else None
+    stack.append(span)
+    return span
+
+
+def finish(span):
+    stack = open_spans()
+    if span in stack:
+        # spans left open by an exception end with their enclosing one
+        del stack[stack.index(span):]
+    if trace_file is None:
+        return
+    write_event(span.id, span.parent, span.stage, span.bug, span.patch, span.start,
+                time.monotonic() - span.clock, span.status, span.fields)
+
+
+@contextmanager
+def span(stage, bug=None, patch=None, **fields):
+    current = start(stage, bug, patch, **fields)
+    try:
+        yield current
+    except BaseException:
+        current.status = 'error'
+        raise
+    finally:
+        finish(current)
+
+
+def current():
+    stack = open_spans()
+    return stack[-1] if len(stack) > 0 else None
+
+
+@contextmanager
+def attach(parent):
+    """Nest the spans of a worker thread under parent, a span of the thread that started it"""
+    stack = open_spans()
+    if parent is not None:
+        stack.append(parent)
+    try:
+        yield
+    finally:
+        if parent in stack:
+            del stack[stack.index(parent):]
+
+
+def event(stage, start_time, duration, status, **fields):
+    """A finished span of the current thread, e.g. an external command timed by its caller"""
+    if trace_file is None:
+        return
+    stack = open_spans()
+    parent = stack[-1] if len(stack) > 0 else None
+    write_event(uuid.uuid4().hex, parent.id if parent is not None else None, stage,
+                parent.bug if parent is not None else None, parent.patch if parent is not None else None,
+                start_time, duration, status, fields)
+
+
+def write_event(span_id, parent, stage, bug, patch, start_time, duration, status, fields):
+    record = dict({
+        'id': span_id,
+        'parent': parent,
+        'bug': bug,
+        'patch': patch,
+        'stage': stage,
+        'start': start_time,
+        'duration': duration,
+        'status': status,
+        'pid': os.getpid(),
+        'tid': threading.get_ident(),
+    }, **fields)
+    # one append per event, so processes writing the same file do not interleave lines
+    with open(trace_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
@@ -3,18 +3,49 @@ import os
 import sys
 import path
 import validate_defects4j as validate
+import command_runner
+import tracing
 from config import App
 import time
 
 def parse_command_line_args():
     parser = argparse.ArgumentParser()
     # options that do not affect the metrics
-    parser.add_argument('--patch_file', type=str, required=True, help='path to file containing generated patches')
+    parser.add_argument('--patch_file', type=str, help='path to file containing generated patches, required unless --role is worker or export')
     parser.add_argument('--level', type=str, default='line',  help='patch level')
-    parser.add_argument('--tests', type=str, default='trigger',  help='Which tests to execute, trigger or all (trigger + relevant)')
+    parser.add_argument('--tests', type=str, default='trigger',  help='Which tests to execute, trigger, all (trigger + relevant) or covering (trigger + relevant classes that run the patched lines)')
     parser.add_argument('--num_examples', type=int,  help='How many examples to process, default is all')
+    parser.add_argument('--workers', type=int, help='Global budget of validation workers shared by bugs and patches, default is the number of cpus')
+    parser.add_argument('--patch_workers', type=int, default=1, help='Maximum number of working copies validating patches of the same bug')
+    parser.add_argument('--baseline_dir', type=str, default='', help='Where baseline test results per bug and defects4j version are kept, default is validation-cache/baselines')
+    parser.add_argument('--refresh_baseline', '--refresh-baseline', action='store_true', help='Recompute the cached baseline test results of every bug')
+    parser.add_argument('--batch_tests', action='store_true', help='Compile each patch once and run all its trigger tests in a single JVM')
+    parser.add_argument('--batch_relevant', action='store_true', help='With --batch_tests, also run the relevant test classes in that JVM instead of defects4j test -r')
+    parser.add_argument('--test_daemon', action='store_true', help='With --batch_tests, run tests in a warm JVM per working copy instead of a new JVM per patch')
+    parser.add_argument('--verdict_cache', type=str, default='', help='Where verdicts per bug, normalized patch and test mode are kept across runs, default is validation-cache/verdicts.db')
+    parser.add_argument('--no_verdict_cache', action='store_true', help='Validate every patch again instead of reusing verdicts of earlier runs')
+    parser.add_argument('--no_prescreen', action='store_true', help='Compile every patch, also those the static pre-screen rejects, and apply responses without extracting their code')
+    parser.add_argument('--bug_timeout', type=int, default=3600, help='Seconds a bug may take in total (checkout, baseline and patches), its commands are stopped at this deadline')
+    parser.add_argument('--stop_policy', type=str, default='none', choices=['none', 'first_plausible', 'n_plausible', 'pass_at_k'], help='Stop validating the patches of a bug at the first plausible patch, after --stop_plausible plausible patches, or once pass@k for every --stop_k is 1')
+    parser.add_argument('--stop_plausible', type=int, default=1, help='Number of plausible patches for --stop_policy n_plausible')
+    parser.add_argument('--stop_k', type=int, nargs='+', default=[1, 5, 20, 100], help='k values for --stop_policy pass_at_k')
+    parser.add_argument('--queue', type=str, help='SQLite work queue shared by a coordinator and workers on several hosts, see --role')
+    parser.add_argument('--role', type=str, default='coordinator', choices=['coordinator', 'worker', 'export'], help='With --queue, the coordinator queues the bugs of --patch_file and waits for them, workers validate queued bugs, export writes the results of done bugs')
+    parser.add_argument('--queue_lease', type=int, default=300, help='Seconds a worker holds a bug without a heartbeat before it is retried elsewhere')
+    parser.add_argument('--queue_attempts', type=int, default=3, help='Leases of a bug before it is marked failed')
+    parser.add_argument('--full_suite', action='store_true', help='Run every selected test of a patch for complete failing_tests lists, instead of stopping at the first failure with the tests most likely to fail first')
+    parser.add_argument('--test_history', type=str, default='', help='Where outcomes and durations of tests per bug are kept to order them, default is validation-cache/test-history.db')
+    parser.add_argument('--coverage_audit', type=int, default=10, help='With --tests covering, run the full relevant suite for every Nth patch that passes the selected tests, 0 disables the audits')
+    parser.add_argument('--timeout_multiplier', type=float, default=5, help='A test run may take this many times its expected duration, from the test history or the baseline test time of the bug')
+    parser.add_argument('--timeout_floor', type=int, default=60, help='Minimum seconds of any compile or test run of a patch')
+    parser.add_argument('--trace', type=str, help='jsonl file that gets a timed event per pipeline stage (checkout, compile, tests, apply, ...) of every bug and patch, see trace_report.py')
+    parser.add_argument('--command_log', type=str, help='jsonl file that gets the wall and cpu time of every defects4j, java and git call')
+    parser.add_argument('--workspace_pool', action='store_true', help='Checkout and compile each bug once and validate in cheap clones of it')
 
-    return parser.parse_args()         
+    args = parser.parse_args()
+    if args.patch_file is None and (args.queue is None or args.role == 'coordinator'):
+        parser.error('--patch_file is required')
+    return args         
 
 if __name__ == '__main__':
     args = parse_command_line_args()
@@ -22,7 +53,41 @@ if __name__ == '__main__':
 
     App.set("PATCH_GRANULARITY" , args.level)
     App.set("TESTS", args.tests)
+    App.set("WORKSPACE_POOL", args.workspace_pool)
+    App.set("WORKERS", args.workers)
+    App.set("PATCH_WORKERS", args.patch_workers)
+    App.set("BASELINE_DIR", args.baseline_dir)
+    App.set("REFRESH_BASELINE", args.refresh_baseline)
+    App.set("BATCH_TESTS", args.batch_tests)
+    App.set("BATCH_RELEVANT", args.batch_relevant)
+    App.set("TEST_DAEMON", args.test_daemon)
+    App.set("VERDICT_CACHE", args.verdict_cache)
+    App.set("REUSE_VERDICTS", not args.no_verdict_cache)
+    App.set("PRESCREEN", not args.no_prescreen)
+    App.set("BUG_TIMEOUT", args.bug_timeout)
+    App.set("STOP_POLICY", args.stop_policy)
+    App.set("STOP_PLAUSIBLE", args.stop_plausible)
+    App.set("STOP_K", args.stop_k)
+    App.set("QUEUE_LEASE", args.queue_lease)
+    App.set("QUEUE_ATTEMPTS", args.queue_attempts)
+    App.set("FAIL_FAST", not args.full_suite)
+    App.set("TEST_HISTORY", args.test_history)
+    App.set("COVERAGE_AUDIT", args.coverage_audit)
+    App.set("TIMEOUT_MULTIPLIER", args.timeout_multiplier)
+    App.set("TIMEOUT_FLOOR", args.timeout_floor)
+    if args.command_log:
+        command_runner.set_command_log(args.command_log)
+    if args.trace:
+        tracing.set_trace_file(os.path.abspath(args.trace))
     input_patch_file =  args.patch_file
     num_examples = args.num_examples
  
-    validate.validate_defects4j(input_patch_file, num_examples)
\ No newline at end of file
+    if args.queue is None:
+        validate.validate_defects4j(input_patch_file, num_examples)
+    elif args.role == 'coordinator':
+        validate.enqueue_bugs(args.queue, input_patch_file, num_examples)
+        validate.monitor_queue(args.queue)
+    elif args.role == 'worker':
+        validate.run_queue_workers(args.queue)
+    else:
+        validate.export_queue_results(args.queue)
\ No newline at end of file
@@ -5,13 +5,29 @@ import shutil
 import subprocess
 import time
 import sys
-from pebble import ProcessPool
+import signal
+import socket
+import threading
+from pebble import ProcessPool, ProcessExpired
+import multiprocessing
 from multiprocessing import Value
-from concurrent.futures import TimeoutError
+import concurrent.futures as cf
+from concurrent.futures import TimeoutError, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import traceback
 import datetime
 import tokenization
 import patch_utils as utils
+import patch_io
+import workspace
+import test_runner
+import command_runner
+import verdict_cache
+import prescreen
+import work_queue
+import test_history
+import coverage_map
+import itertools
+import tracing
 import tqdm
 from config import App
 
@@ -31,67 +47,96 @@ def clean_tmp_folder(tmp_dir):
 
 #checkout the defects4j project to be tested 
 # project name, bug id, and where to checkout the project
-def checkout_defects4j_project(project, bug_id, tmp_dir):
+def checkout_defects4j_project(project, bug_id, tmp_dir, timeout=1800):
     print("Checking out ", project, " ", bug_id, " to ", tmp_dir)
-    FNULL = open(os.devnull, 'w')
-    #command from defects4j installation
-    command = "defects4j checkout " + " -p " + project + " -v " + bug_id + " -w " + tmp_dir
-    p = subprocess.Popen([command], shell=True, stdout=FNULL, stderr=FNULL)
-    p.wait()
+    with tracing.span('checkout') as span:
+        #command from defects4j installation
+        result = command_runner.run_command(["defects4j", "checkout", "-p", project, "-v", bug_id, "-w", tmp_dir], timeout)
+        span.status = 'timeout' if result.timed_out else result.returncode
+    if result.timed_out or result.returncode != 0:
+        print("Checkout failed for ", project, " ", bug_id, result.err[-1000:])
 
 #catch compilation errors for defects4j projects, mostly for Mockito
-def compile_fix(project_dir):
-    os.chdir(project_dir)
+def compile_fix(project_dir, timeout=1800):
     print("Compiling ", project_dir)
-    p = subprocess.Popen(["defects4j", "compile"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = p.communicate()
-    if "FAIL" in str(err) or "FAIL" in str(out):
-        return False
+    with tracing.span('compile-checkout') as span:
+        out, err = command_with_timeout(["defects4j", "compile"], timeout, cwd=project_dir)
+        if "FAIL" in str(err) or "FAIL" in str(out) or out == 'TIMEOUT':
+            span.status = 'fail'
+            return False
     return True
 
 #execute the defects4j with a set timeout
-def command_with_timeout(cmd, timeout=300):
-    p = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
-    t_beginning = time.time()
-    while True:
-        if p.poll() is not None:
-            break
-        seconds_passed = time.time() - t_beginning
-        if timeout and seconds_passed > timeout:
-            p.terminate()
-            return 'TIMEOUT', 'TIMEOUT'
-        time.sleep(1)
-    out, err = p.communicate()
-    return out, err
+def command_with_timeout(cmd, timeout=300, cwd=None):
+    result = command_runner.run_command(cmd, timeout, cwd=cwd)
+    if result.timed_out:
+        return 'TIMEOUT', 'TIMEOUT'
+    return result.out, result.err
 
 #runs all defects4j tests on instance
 # -r Only execute relevant developer-written tests
 def defects4j_test_suite(project_dir, timeout=300):
-    os.chdir(project_dir)
-    out, err = command_with_timeout(["defects4j", "test", "-r"], timeout)
+    out, err = command_with_timeout(["defects4j", "test", "-r"], timeout, cwd=project_dir)
     if "Compilation failed" in str(out):
         print("FAIL to Compile tests for ", project_dir)
     return out, err
 
 # export number of trigger tests for buggy instance
 def defects4j_trigger(project_dir, timeout=300):
-    os.chdir(project_dir)
-    out, err = command_with_timeout(["defects4j", "export", "-p", "tests.trigger"], timeout)
+    out, err = command_with_timeout(["defects4j", "export", "-p", "tests.trigger"], timeout, cwd=project_dir)
     return out, err
 
 #export number of relevant tests for buggy instance
 def defects4j_relevant(project_dir, timeout=300):
-    os.chdir(project_dir)
-    out, err = command_with_timeout(["defects4j", "export", "-p", "tests.relevant"], timeout)
+    out, err = command_with_timeout(["defects4j", "export", "-p", "tests.relevant"], timeout, cwd=project_dir)
     return out, err
 
 #run only one tests
 def defects4j_test_one(project_dir, test_case, timeout=300):
-    os.chdir(project_dir)
-    out, err = command_with_timeout(["defects4j", "test", "-t", test_case], timeout)
+    out, err = command_with_timeout(["defects4j", "test", "-t", test_case], timeout, cwd=project_dir)
     return out, err
 
+#compile the sources and tests of the checkout
+def defects4j_compile(project_dir, timeout=300):
+    out, err = command_with_timeout(["defects4j", "compile"], timeout, cwd=project_dir)
+    return out, err
+
+#coverage of one test, <test_class>::<test_method>, only the classes listed in classes_file are instrumented
+def defects4j_coverage(project_dir, test, classes_file, timeout=600):
+    out, err = command_with_timeout(["defects4j", "coverage", "-t", test, "-i", classes_file], timeout, cwd=project_dir)
+    return out, err
+
+#export a defects4j property of the checkout, e.g. dir.bin.classes
+def defects4j_export(project_dir, prop, timeout=300):
+    out, err = command_with_timeout(["defects4j", "export", "-p", prop], timeout, cwd=project_dir)
+    return out.strip()
+
+#checkout and compile a bug once into a template that workspaces are cloned from
+def prepare_bug_template(proj, bug_id):
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    template = os.path.join(current_dir, 'tmp', 'templates', proj + '_' + bug_id)
+    with tracing.span('template'), workspace.template_lock(template):
+        if workspace.verify_template(template):
+            return template
+        print("Preparing template for ", proj, " ", bug_id)
+        clean_tmp_folder(template)
+        checkout_defects4j_project(proj, bug_id + 'b', template)
+        compile_fix(template)
+        # build output is copied into every clone, not shared
+        build_dirs = set()
+        for prop in ["dir.bin.classes", "dir.bin.tests"]:
+            build_dir = defects4j_export(template, prop)
+            if build_dir and build_dir != 'TIMEOUT':
+                build_dirs.add(build_dir.split('/')[0])
+        workspace.seal_template(template, build_dirs)
+    return template
+
 def get_bug_stats(tmp_dir):
+    with tracing.span('baseline'):
+        return compute_bug_stats(tmp_dir)
+
+#bug stats and whether the test suite timed out, which leaves no failing tests and a meaningless test time
+def compute_bug_stats(tmp_dir):
     # check standard test time
     start_time = time.time()
     init_out, init_err = defects4j_test_suite(tmp_dir)
@@ -121,34 +166,546 @@ def get_bug_stats(tmp_dir):
         relevant_tests[i] = test.strip()
     print('relevant number:', len(relevant_tests))
 
+    return (standard_exec_time, trigger_tests, relevant_tests, failed_test_cases), init_out == 'TIMEOUT'
+
+
+
+# shared by bugs and patch workers of all pool processes, see validate_defects4j
+worker_budget = None
+# tokens of the budget this process holds, given back if the process is stopped
+held_tokens = 0
+
+def set_worker_budget(budget):
+    global worker_budget
+    worker_budget = budget
+
+def init_worker(budget):
+    set_worker_budget(budget)
+    signal.signal(signal.SIGTERM, stop_worker)
+
+def acquire_worker(block=True):
+    global held_tokens
+    if worker_budget is None:
+        return True
+    if not worker_budget.acquire(block=block):
+        return False
+    held_tokens += 1
+    return True
+
+def release_worker():
+    global held_tokens
+    if worker_budget is not None:
+        held_tokens -= 1
+        worker_budget.release()
+
+#pebble terminates a worker that overran the deadline of its bug by BACKSTOP_GRACE
+def stop_worker(signum, frame):
+    command_runner.kill_running()
+    if worker_budget is not None:
+        for _ in range(held_tokens):
+            worker_budget.release()
+    os._exit(1)
+
+#version of the defects4j installation, part of the baseline cache key
+def get_defects4j_version():
+    global defects4j_version
+    if defects4j_version is None:
+        d4j_home = os.getenv("D4J_HOME")
+        if d4j_home is None:
+            executable = shutil.which("defects4j")
+            if executable is not None:
+                # <d4j_home>/framework/bin/defects4j
+                d4j_home = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(executable))))
+        defects4j_version = 'unknown'
+        if d4j_home is not None:
+            out, err = command_with_timeout(["git", "rev-parse", "--short", "HEAD"], 60, cwd=d4j_home)
+            if out and out != 'TIMEOUT' and 'fatal' not in str(err):
+                defects4j_version = out.strip()
+    return defects4j_version
+
+defects4j_version = None
+# outcomes and durations of tests of the bug this process validates, see open_test_history
+history = None
+# relevant test classes covering the patched lines with --tests covering, see get_coverage_map
+selected_relevant = None
+# whether defects4j test -t takes a bare test class, None until a run of the bug tells, see run_test_class
+bare_class_tests = None
+# test source directory of the bug relative to its checkout, see get_test_methods
+test_src_dir = None
+# patches whose selected tests passed, every COVERAGE_AUDIT-th is checked with the full relevant suite
+audit_counter = itertools.count(1)
+
+def get_baseline_file(proj, bug_id):
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    baseline_dir = App.config("BASELINE_DIR") or os.path.join(current_dir, 'validation-cache', 'baselines')
+    return os.path.join(baseline_dir, proj + '_' + bug_id + '_' + get_defects4j_version() + '.json')
+
+def load_baseline(baseline_file):
+    if not os.path.exists(baseline_file):
+        return None
+    with open(baseline_file, 'r') as f:
+        return json.load(f)
+
+#baseline stats only depend on project, bug id and defects4j version, keep them across runs
+def get_bug_stats_cached(proj, bug_id, tmp_dir):
+    baseline_file = get_baseline_file(proj, bug_id)
+    baseline_dir = os.path.dirname(baseline_file)
+    baseline = load_baseline(baseline_file)
+    if not App.config("REFRESH_BASELINE") and baseline is not None:
+        print("Using baseline from", baseline_file)
+        return baseline['standard_exec_time'], baseline['trigger_tests'], baseline['relevant_tests'], baseline['failed_test_cases']
+
+    bug_stats, suite_timed_out = get_bug_stats(tmp_dir)
+    standard_exec_time, trigger_tests, relevant_tests, failed_test_cases = bug_stats
+    # do not keep a baseline that timed out, failed to export or was cut off by the deadline of the bug,
+    # every later run would mark all patches init-error
+    if suite_timed_out or command_runner.past_deadline():
+        print("Baseline test suite did not finish, not caching it")
+    elif 'TIMEOUT' not in trigger_tests + relevant_tests and trigger_tests != ['']:
+        os.makedirs(baseline_dir, exist_ok=True)
+        with open(baseline_file + '.tmp', 'w') as f:
+            json.dump({
+                'project': proj,
+                'bug_id': bug_id,
+                'defects4j_version': get_defects4j_version(),
+                'standard_exec_time': standard_exec_time,
+                'trigger_tests': trigger_tests,
+                'relevant_tests': relevant_tests,
+                'failed_test_cases': failed_test_cases,
+            }, f, indent=2)
+        os.replace(baseline_file + '.tmp', baseline_file)
     return standard_exec_time, trigger_tests, relevant_tests, failed_test_cases
 
+def get_coverage_file(proj, bug_id):
+    return get_baseline_file(proj, bug_id)[:-len('.json')] + '.coverage.json'
 
+#lines of the patched file and the relevant test classes running them, computed once per bug and defects4j version
+def get_coverage_map(proj, bug_id, tmp_dir, path, relevant_tests):
+    coverage_file = get_coverage_file(proj, bug_id)
+    coverage = coverage_map.load_coverage(coverage_file, path)
+    if not App.config("REFRESH_BASELINE") and coverage is not None:
+        print("Using coverage from", coverage_file)
+        return coverage
 
-def validate_defects4j(patch_file, num_examples):
-     
-    candidate_patches = json.load(open(patch_file, 'r'))
-    
+    coverage = coverage_map.CoverageMap(path)
+    src_dir = defects4j_export(tmp_dir, "dir.src.classes")
+    if not src_dir or src_dir == 'TIMEOUT':
+        coverage.unknown = list(relevant_tests)
+        return coverage
+    print("Computing coverage of", path, "for", len(relevant_tests), "relevant test classes")
+    coverage_span = tracing.start('coverage')
+    bin_dir = os.path.join(tmp_dir, defects4j_export(tmp_dir, "dir.bin.classes"))
+    classes_file = os.path.join(tmp_dir, '.nl2fix-instrument')
+    with open(classes_file, 'w') as f:
+        f.write('\n'.join(coverage_map.instrumented_classes(bin_dir, coverage_map.source_class(src_dir, path))) + '\n')
+    rel_path = os.path.relpath(path, src_dir)
+    test_src_dir = os.path.join(tmp_dir, defects4j_export(tmp_dir, "dir.src.tests"))
+    # defects4j documents -t as <test_class>::<test_method>, a version that
+    # rejects a bare class fails the first run and every class is then
+    # covered method by method
+    class_runs = None
+    for test_class in relevant_tests:
+        lines = None
+        if class_runs is not False:
+            lines = run_coverage(tmp_dir, [test_class], classes_file, rel_path)
+            if class_runs is None:
+                class_runs = lines is not None
+        if lines is None and class_runs is False:
+            methods = coverage_map.test_methods(test_src_dir, test_class)
+            if len(methods) > 0:
+                lines = run_coverage(tmp_dir, [test_class + '::' + method for method in methods], classes_file, rel_path)
+        if lines is None:
+            coverage.unknown.append(test_class)
+        else:
+            coverage.add(test_class, lines)
+    coverage_map.clear_outputs(tmp_dir)
+    os.remove(classes_file)
+    tracing.finish(coverage_span)
+    if len(relevant_tests) > 0 and len(coverage.unknown) == len(relevant_tests):
+        print("Warning: every coverage run of", proj, bug_id, "failed, all relevant test classes are run, check defects4j coverage in", tmp_dir)
+    # a pass cut off by the deadline of the bug is computed again next time
+    if not command_runner.past_deadline() and len(coverage.unknown) < len(relevant_tests):
+        coverage_map.store_coverage(coverage_file, coverage)
+    return coverage
+
+#lines of rel_path that the tests run together, None if the run of any of them failed
+def run_coverage(tmp_dir, tests, classes_file, rel_path):
+    xml_path = os.path.join(tmp_dir, coverage_map.COVERAGE_XML)
+    lines = set()
+    for test in tests:
+        coverage_map.clear_outputs(tmp_dir)
+        out, err = defects4j_coverage(tmp_dir, test, classes_file)
+        test_lines = coverage_map.covered_lines(xml_path, rel_path) if out != 'TIMEOUT' and os.path.exists(xml_path) else None
+        if test_lines is None:
+            return None
+        lines.update(test_lines)
+    return lines
+
+#rough seconds of checking out a bug and computing its baseline
+CHECKOUT_COST = 120
+#seconds a patch is assumed to take when no baseline of any bug is known
+DEFAULT_PATCH_COST = 60
+#seconds pebble waits past the deadline of a bug before it stops the worker
+BACKSTOP_GRACE = 600
+
+#estimated seconds of validating every bug, from patch count x baseline test time
+def estimate_bug_costs(candidate_patches):
+    patch_costs = {}
+    for key in candidate_patches:
+        proj, bug_id = key.split('_')[:2]
+        baseline = load_baseline(get_baseline_file(proj, bug_id))
+        if baseline is None:
+            continue
+        # a compile and test run per trigger test, plus the relevant tests with --tests all
+        runs = len(baseline['trigger_tests']) if App.config("TESTS") != 'relevant' else 0
+        if App.config("TESTS") != 'trigger':
+            runs += 1
+        patch_costs[key] = max(baseline['standard_exec_time'], 1) * max(runs, 1)
+    # bugs without a baseline yet get the median patch cost of the others
+    default_cost = sorted(patch_costs.values())[len(patch_costs) // 2] if patch_costs else DEFAULT_PATCH_COST
+    costs = {}
+    for key, record in candidate_patches.items():
+        num_patches = len(set(patch['patch'] for patch in record['patches']))
+        costs[key] = CHECKOUT_COST + num_patches * patch_costs.get(key, default_cost)
+    return costs
+
+def load_candidate_patches(patch_file, num_examples):
+    candidate_patches = patch_io.load_patch_file(patch_file)
     if num_examples is not None:
         candidate_patches = {k: candidate_patches[k] for k in list(candidate_patches.keys())[:num_examples]}
+    return candidate_patches
 
-    with ProcessPool() as pool:
-        future = pool.map(validate_patches_per_bug, candidate_patches.items())
-        iterator = future.result()
-        while True:
-                try:
-                    result = next(iterator)  
-                except StopIteration:
-                    break
-                except (cf.TimeoutError, ProcessExpired):
-                    continue
-                except Exception as e:
-                    print(f"Final catastrophic exception {str(e)}")
-                    print(error.traceback)
-                    continue
+def validate_defects4j(patch_file, num_examples):
+     
+    candidate_patches = load_candidate_patches(patch_file, num_examples)
+
+    # longest first, so that no heavy bug is left to run alone at the end
+    costs = estimate_bug_costs(candidate_patches)
+    order = sorted(candidate_patches, key=lambda key: costs[key], reverse=True)
+
+    num_workers = App.config("WORKERS") or multiprocessing.cpu_count()
+    budget = multiprocessing.Semaphore(num_workers)
+    failed = []
+    with ProcessPool(max_workers=num_workers, initializer=init_worker, initargs=(budget,)) as pool:
+        futures = {}
+        for key in order:
+            future = pool.schedule(validate_patches_per_bug, args=[(key, candidate_patches[key])],
+                                   timeout=App.config("BUG_TIMEOUT") + BACKSTOP_GRACE)
+            futures[future] = key
+        # progress in estimated seconds of work, so the ETA accounts for the cost of the remaining bugs
+        progress = tqdm.tqdm(total=int(sum(costs.values())), unit='s', desc='Validating', smoothing=0)
+        for done, future in enumerate(cf.as_completed(futures), start=1):
+            key = futures[future]
+            try:
+                future.result()
+            except TimeoutError:
+                print(key, 'Stopped after the deadline of the bug')
+                failed.append(key)
+            except ProcessExpired as e:
+                print(key, 'Worker died with exit code', e.exitcode)
+                failed.append(key)
+            except Exception as e:
+                print(key, 'Final catastrophic exception', str(e))
+                print(getattr(e, 'traceback', ''))
+                failed.append(key)
+            progress.update(int(costs[key]))
+            progress.set_postfix(bugs=str(done) + '/' + str(len(futures)))
+        progress.close()
     pool.close()
     pool.join()
+    if len(failed) > 0:
+        print('Validation did not finish for', len(failed), 'bugs:', ' '.join(failed))
     
+#seconds between two polls of an idle queue worker
+QUEUE_POLL_SECONDS = 30
+
+#coordinator: split the patch file into bug level items of a durable queue
+def enqueue_bugs(queue_path, patch_file, num_examples):
+    candidate_patches = load_candidate_patches(patch_file, num_examples)
+    costs = estimate_bug_costs(candidate_patches)
+    queue = work_queue.WorkQueue(queue_path)
+    queue.add([(key, record, costs[key]) for key, record in candidate_patches.items()])
+    print('Queued', len(candidate_patches), 'bugs in', queue_path, queue.counts())
+    queue.close()
+
+#coordinator: show progress until every item is done or failed, then export the results
+def monitor_queue(queue_path, output_dir=None):
+    queue = work_queue.WorkQueue(queue_path)
+    costs = queue.costs()
+    progress = tqdm.tqdm(total=int(sum(costs.values())), unit='s', desc='Validating', smoothing=0)
+    finished = 0
+    while True:
+        costs = queue.costs()
+        done = int(costs.get(work_queue.DONE, 0) + costs.get(work_queue.FAILED, 0))
+        progress.update(done - finished)
+        finished = done
+        counts = queue.counts()
+        progress.set_postfix(counts)
+        if queue.unfinished() == 0:
+            break
+        time.sleep(QUEUE_POLL_SECONDS)
+    progress.close()
+    queue.close()
+    export_queue_results(queue_path, output_dir)
+
+def export_queue_results(queue_path, output_dir=None):
+    if output_dir is None:
+        output_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'validation-output')
+    queue = work_queue.WorkQueue(queue_path)
+    for key, validated_result in queue.results():
+        proj, bug_id = key.split('_')[:2]
+        write_results_to_file(validated_result, output_dir, proj + '_' + bug_id)
+    for key, error in queue.failures():
+        print(key, 'failed:', error)
+    print(queue.counts())
+    queue.close()
+
+def heartbeat_loop(queue_path, key, owner, stop):
+    queue = work_queue.WorkQueue(queue_path, App.config("QUEUE_LEASE"))
+    while not stop.wait(App.config("QUEUE_LEASE") / 3):
+        if not queue.heartbeat(key, owner):
+            print(key, 'Lease lost by', owner)
+            break
+    queue.close()
+
+#worker: lease bugs from the queue until no work is left
+def queue_worker(queue_path, budget):
+    init_worker(budget)
+    owner = socket.gethostname() + ':' + str(os.getpid())
+    queue = work_queue.WorkQueue(queue_path, App.config("QUEUE_LEASE"), App.config("QUEUE_ATTEMPTS"))
+    while True:
+        item = queue.lease(owner)
+        if item is None:
+            if queue.unfinished() == 0:
+                break
+            # leases of other workers may still expire and be retried
+            time.sleep(QUEUE_POLL_SECONDS)
+            continue
+        key, record = item
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=heartbeat_loop, args=(queue_path, key, owner, stop), daemon=True)
+        heartbeat.start()
+        try:
+            validated_result = validate_patches_per_bug((key, record))
+            queue.complete(key, owner, validated_result)
+        except Exception as e:
+            traceback.print_exc()
+            queue.fail(key, owner, repr(e))
+        finally:
+            stop.set()
+            heartbeat.join()
+    queue.close()
+
+def run_queue_workers(queue_path):
+    num_workers = App.config("WORKERS") or multiprocessing.cpu_count()
+    budget = multiprocessing.Semaphore(num_workers)
+    workers = [multiprocessing.Process(target=queue_worker, args=(queue_path, budget)) for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def scaled_timeout(seconds):
+    """Timeout of a step expected to take seconds, by the baseline or the test history"""
+    return max(App.config("TIMEOUT_FLOOR"), App.config("TIMEOUT_MULTIPLIER") * seconds)
+
+def tests_timeout(current_bug, standard_exec_time, tests, kind):
+    """Timeout of running tests with kind (test_history.JVM or DEFECTS4J), from
+    their mean duration in the test history when run the same way.
+    Tests never timed are together assumed to take the baseline suite time."""
+    seconds, untimed = history.expected_seconds(current_bug, tests, kind)
+    if len(untimed) > 0:
+        seconds += standard_exec_time
+    return scaled_timeout(seconds)
+
+def timeout_reason(stage):
+    """Which limit stopped a patch, the deadline of the bug cuts every stage short"""
+    return 'bug-deadline' if command_runner.past_deadline() else stage
+
+def run_tests_batched(tmp_dir, current_bug, trigger_tests, relevant_tests, run_trigger, run_relevant, start_time,
+                      standard_exec_time):
+    """Compile the patched checkout once and run the trigger tests, and optionally
+    the relevant test classes, in a single JVM. Returns None to fall back to
+    one defects4j test call per trigger test."""
+    result = {'correctness': None, 'passing_tests': [], 'failing_tests': [], 'errors': [],
+              'compiles': True, 'relevant_failures': None, 'timeout_reason': None}
+    with tracing.span('compile'):
+        out, err = defects4j_compile(tmp_dir, scaled_timeout(standard_exec_time))
+    if 'TIMEOUT' in str(out) or 'TIMEOUT' in str(err):
+        print(current_bug, 'Patch Timeout', str(int(time.time() - start_time)) + 's')
+        result['correctness'] = 'timeout'
+        result['timeout_reason'] = timeout_reason('compile')
+        result['compiles'] = False
+        return result
+    if 'FAIL' in str(out) or 'FAIL' in str(err):
+        print(current_bug, 'Uncompilable patch', str(int(time.time() - start_time)) + 's')
+        result['correctness'] = 'uncompilable'
+        result['compiles'] = False
+        result['failing_tests'] = list(trigger_tests) if run_trigger else []
+        result['errors'].append(err)
+        return result
+
+    fail_fast = App.config("FAIL_FAST")
+    triggers = list(trigger_tests) if run_trigger else []
+    relevant = list(relevant_tests) if run_relevant else []
+    if fail_fast:
+        # the trigger tests decide the verdict, so they run before the relevant classes
+        triggers = history.order(current_bug, triggers, test_history.JVM)
+        relevant = history.order(current_bug, relevant, test_history.JVM)
+    tests = triggers + relevant
+    if len(tests) == 0:
+        return result
+    timeout = tests_timeout(current_bug, standard_exec_time, tests, test_history.JVM)
+    with tracing.span('tests', tests=len(tests)):
+        if App.config("TEST_DAEMON"):
+            results, failed_methods, out, err = test_runner.run_tests_in_daemon(tmp_dir, tests, timeout, fail_fast)
+        else:
+            results, failed_methods, out, err = test_runner.run_tests(tmp_dir, tests, timeout, fail_fast)
+    if out == 'TIMEOUT':
+        print(current_bug, 'Patch Timeout', str(int(time.time() - start_time)) + 's')
+        result['correctness'] = 'timeout'
+        result['timeout_reason'] = timeout_reason('test')
+        return result
+    if results is None:
+        print(current_bug, 'Test runner unavailable, running tests one by one')
+        return None
+    for test, test_result in results.items():
+        history.record(current_bug, test, test_history.JVM, test_result['passed'], test_result['millis'])
+
+    if run_trigger:
+        for trigger in triggers:
+            if trigger not in results:
+                # not run after the first failure
+                continue
+            if results[trigger]['passed']:
+                result['passing_tests'].append(trigger)
+            else:
+                result['failing_tests'].append(trigger)
+        result['correctness'] = 'wrong' if len(result['failing_tests']) > 0 else 'plausible'
+        if len(result['failing_tests']) > 0:
+            result['errors'].append(err)
+        print(current_bug, 'Wrong patch' if result['correctness'] == 'wrong' else 'Plausible patch',
+              str(int(time.time() - start_time)) + 's')
+    if run_relevant:
+        relevant_classes = set(relevant_tests)
+        result['relevant_failures'] = [
+            method for method in failed_methods if method.split('::')[0] in relevant_classes]
+    return result
+
+#relevant test classes that failed before are run alone first, at most this many
+MAX_PROBES = 3
+
+def parse_failing_tests(out):
+    return [failed_test_case.strip() for failed_test_case in str(out).split(' - ')[1:]]
+
+#test methods declared in the source of test_class, see coverage_map.test_methods
+def get_test_methods(tmp_dir, test_class):
+    global test_src_dir
+    if test_src_dir is None:
+        test_src_dir = defects4j_export(tmp_dir, "dir.src.tests")
+    if not test_src_dir or test_src_dir == 'TIMEOUT':
+        return []
+    return coverage_map.test_methods(os.path.join(tmp_dir, test_src_dir), test_class)
+
+def run_test_class(tmp_dir, current_bug, test_class, fail_fast, standard_exec_time, by_method):
+    """Run one test class with defects4j test -t
+
+    defects4j documents -t as <test_class>::<test_method>. The first bare
+    class run of a bug tells whether the installed version takes a class;
+    if it does not, the class runs method by method with by_method and is
+    unknown without. Returns the failing test methods, the error output
+    and 'passed', 'failed', 'timeout', or 'unknown' when no test ran.
+    """
+    global bare_class_tests
+    if bare_class_tests is not False:
+        start = time.time()
+        out, err = defects4j_test_one(tmp_dir, test_class,
+                                      tests_timeout(current_bug, standard_exec_time, [test_class], test_history.DEFECTS4J))
+        if out == 'TIMEOUT':
+            return [], err, 'timeout'
+        if 'Failing tests:' in str(out):
+            bare_class_tests = True
+            failed = parse_failing_tests(out)
+            history.record(current_bug, test_class, test_history.DEFECTS4J, len(failed) == 0, (time.time() - start) * 1000)
+            return failed, err, 'failed' if len(failed) > 0 else 'passed'
+        if bare_class_tests:
+            # classes ran before, this one did not build or start
+            return [], err, 'unknown'
+        bare_class_tests = False
+        print(current_bug, 'defects4j test -t takes no bare test class')
+    methods = get_test_methods(tmp_dir, test_class) if by_method else []
+    if len(methods) == 0:
+        return [], '', 'unknown'
+    failed = []
+    errors = []
+    class_start = time.time()
+    for method in methods:
+        test = test_class + '::' + method
+        start = time.time()
+        out, err = defects4j_test_one(tmp_dir, test, tests_timeout(current_bug, standard_exec_time, [test], test_history.DEFECTS4J))
+        if out == 'TIMEOUT':
+            return failed, '\n'.join(errors), 'timeout'
+        if 'Failing tests:' not in str(out):
+            return failed, '\n'.join(errors), 'unknown'
+        method_failed = parse_failing_tests(out)
+        history.record(current_bug, test, test_history.DEFECTS4J, len(method_failed) == 0, (time.time() - start) * 1000)
+        if len(method_failed) > 0:
+            failed += method_failed
+            errors.append(err)
+            if fail_fast:
+                break
+    complete = len(failed) == 0 or not fail_fast
+    history.record(current_bug, test_class, test_history.DEFECTS4J, len(failed) == 0,
+                   (time.time() - class_start) * 1000 if complete else None)
+    return failed, '\n'.join(errors), 'failed' if len(failed) > 0 else 'passed'
+
+def run_test_classes(tmp_dir, current_bug, test_classes, fail_fast, standard_exec_time, by_method=True):
+    """Run test classes with defects4j test -t, in order, see run_test_class
+
+    Returns the failing test methods, the error output of the classes that
+    failed, with fail_fast only up to the first of them, and whether a
+    class timed out, which ends the run. The failing tests are None when a
+    class ran no tests, they are unknown then and the caller runs the suite.
+    """
+    failed = []
+    errors = []
+    for test_class in test_classes:
+        class_failed, err, status = run_test_class(tmp_dir, current_bug, test_class, fail_fast, standard_exec_time, by_method)
+        if status == 'timeout':
+            return failed + class_failed, '\n'.join(errors + [err]), True
+        if status == 'unknown':
+            return None, '\n'.join(errors + [err]), False
+        if status == 'failed':
+            failed += class_failed
+            errors.append(err)
+            if fail_fast:
+                break
+    return failed, '\n'.join(errors), False
+
+def run_relevant_tests(tmp_dir, current_bug, relevant_tests, standard_exec_time):
+    """Failing relevant test methods of the patched checkout with defects4j,
+    the error output and whether the tests timed out
+
+    With FAIL_FAST the relevant classes that failed for earlier patches of
+    the bug are run one by one first, and a failure among them ends the run
+    without the full defects4j test -r.
+    """
+    # a probe method by method would cost more than it saves, so probing
+    # stops for the bug once defects4j turns down a bare class
+    if App.config("FAIL_FAST") and bare_class_tests is not False:
+        probes = history.failed_before(current_bug, relevant_tests, test_history.DEFECTS4J)[:MAX_PROBES]
+        failed, err, timed_out = run_test_classes(tmp_dir, current_bug, probes, True, standard_exec_time, by_method=False)
+        if failed is not None and (len(failed) > 0 or timed_out):
+            return failed, err, timed_out
+    out, err = defects4j_test_suite(tmp_dir, scaled_timeout(standard_exec_time))
+    if out == 'TIMEOUT':
+        return [], err, True
+    failed = parse_failing_tests(out)
+    failed_classes = set(test.split('::')[0] for test in failed)
+    for test_class in relevant_tests:
+        history.record(current_bug, test_class, test_history.DEFECTS4J, test_class not in failed_classes)
+    return failed, err, False
+
 def extract_d4j_result( err, out, current_bug, tokenized_patch, start_time,  init_fail_num, failed_test_cases):
 
     patch_err = ""
@@ -192,104 +749,488 @@ def validate_patches_per_bug(candidate_patch):
  
     validated_result = {}
     current_bug = proj + '_' + bug_id
- 
-    # checkout project
-    clean_tmp_folder(tmp_dir)
-    checkout_defects4j_project(proj, bug_id + 'b', tmp_dir)
-    
-    if proj == "Mockito" or proj == "mockito":
-        print("Mockito needs separate compilation")
-        compile_fix(tmp_dir)
 
-    #get relevant stats for current bug
-    standard_exec_time, trigger_tests, relevant_tests, failed_test_cases = get_bug_stats(tmp_dir)
-    init_fail_num = len(failed_test_cases)
-    validated_result[key] = {'patches': []}
-    bug_start_time = time.time()
-    validated_patch_list = []
-
-    for tokenized_patch in candidate_patch[1]['patches']:
-        if (tokenized_patch['patch'] not in validated_patch_list):
-            # timeout after 1 hour per bug at most
-            if time.time() - bug_start_time > 1 * 3600:
-                break
+    global history, selected_relevant, bare_class_tests, test_src_dir
+    history = open_test_history()
+    bare_class_tests = None
+    test_src_dir = None
+    bug_span = tracing.start('bug', bug=current_bug)
+    # the slot of this bug in the global worker budget
+    with tracing.span('worker-wait'):
+        acquire_worker()
+    # every command of this bug is clipped to its deadline
+    command_runner.set_deadline(App.config("BUG_TIMEOUT"))
+    try:
+        if App.config("WORKSPACE_POOL"):
+            # clone the checked out and compiled template of this bug
+            template = prepare_bug_template(proj, bug_id)
+            with tracing.span('clone'):
+                workspace.clone_workspace(template, tmp_dir)
+        else:
+            # checkout project
+            clean_tmp_folder(tmp_dir)
+            checkout_defects4j_project(proj, bug_id + 'b', tmp_dir)
+
+            if proj == "Mockito" or proj == "mockito":
+                print("Mockito needs separate compilation")
+                compile_fix(tmp_dir)
 
-            index = ""
-            if 'index' in tokenized_patch:
-                index = tokenized_patch['index']
-            
-            tokenized_patch = tokenized_patch['patch']
-            validated_patch_list.append(tokenized_patch)
-            
-            with open(path, 'r') as file:
-                clean_file = file.readlines()
-
-            backup_file = utils.apply_patch(tmp_dir, path, start_loc, end_loc, tokenized_patch, App.config("PATCH_GRANULARITY"))
-            test_errors = []
-            failing_tests = []
-            passing_tests = []
-            correctness = None
-            start_time = time.time()
-            passing_relevant = 0
-            passing_trigger = 0
-            patch_compiles = True
-            all_trigger_pass = True
-            rel_fail_num = 0
-            if init_fail_num == 0:
-                correctness = 'init-error'
+        #get relevant stats for current bug
+        bug_stats = get_bug_stats_cached(proj, bug_id, tmp_dir)
+        validated_result[key] = {'patches': []}
+        selected_relevant = None
+        if App.config("TESTS") == 'covering' and len(bug_stats[3]) != 0:
+            # on the unpatched checkout, before any patch is applied
+            coverage = get_coverage_map(proj, bug_id, tmp_dir, path, bug_stats[2])
+            selected_relevant = coverage.covering(bug_stats[2], start_loc, end_loc)
+            print(current_bug, len(selected_relevant), 'of', len(bug_stats[2]), 'relevant test classes cover lines', start_loc, 'to', end_loc)
+
+        unique_patches, groups = group_equivalent_patches(candidate_patch[1]['patches'])
+        dropped = []
+        cache = open_verdict_cache()
+        mode = get_verdict_mode()
+        verdicts = {}
+        if cache is not None:
+            verdicts = cache.lookup(key, groups, mode)
+            print(current_bug, 'Reusing', len(verdicts), 'of', len(groups), 'cached verdicts')
+        # one representative per class of equivalent patches
+        representatives = [groups[patch_hash][0] for patch_hash in groups if patch_hash not in verdicts]
+        hashes = {tokenized_patch['patch']: tokenized_patch['normalized_hash'] for tokenized_patch in unique_patches}
+
+        def should_stop(records):
+            # a plausible verdict counts for every unique patch equivalent to it
+            plausible = [patch_hash for patch_hash, verdict in verdicts.items() if is_plausible(verdict)]
+            plausible += [hashes[record['patch']] for record in records if is_plausible(record)]
+            return early_stop_reached(len(unique_patches), sum(len(groups[patch_hash]) for patch_hash in plausible))
+
+        if App.config("PATCH_WORKERS") > 1:
+            validated = validate_patches_in_parallel(key, tmp_dir, representatives, bug_stats, should_stop)
+        else:
+            validated = []
+            for tokenized_patch in representatives:
+                if command_runner.past_deadline() or should_stop(validated):
+                    break
+                validated.append(validate_patch(key, tmp_dir, tokenized_patch, bug_stats))
+        if command_runner.past_deadline():
+            # patches cut off by the deadline of the bug have no verdict
+            print(current_bug, 'Deadline of the bug reached')
+            dropped = [record for record in validated if record['timeout_reason'] == 'bug-deadline']
+            validated = [record for record in validated if record['timeout_reason'] != 'bug-deadline']
+
+        new_verdicts = {}
+        for record in validated:
+            new_verdicts[hashes[record['patch']]] = record
+        if cache is not None:
+            cache.store(key, new_verdicts, mode)
+            cache.close()
+        validated_result[key]['patches'] = expand_verdicts(unique_patches, verdicts, new_verdicts)
+        if selected_relevant is not None:
+            audits = [record['coverage_audit'] for record in validated if 'coverage_audit' in record]
+            validated_result[key]['coverage_audit'] = {
+                'selected': len(selected_relevant),
+                'relevant': len(bug_stats[2]),
+                'audited': len(audits),
+                # patches the selected tests pass but the full relevant suite fails
+                'missed': sum(1 for audit in audits if audit['missed_tests'] > 0),
+                'missed_tests': sum(audit['missed_tests'] for audit in audits),
+            }
+        if App.config("STOP_POLICY") != 'none':
+            stopped = should_stop(validated)
+            # unique patches left without a verdict, cached verdicts fill in patches of any position
+            missing = len(unique_patches) - len(validated_result[key]['patches'])
+            if stopped or not command_runner.past_deadline():
+                # the patches cut off while running, the ones never started were not needed
+                deadline = sum(len(groups[hashes[record['patch']]]) for record in dropped)
             else:
-                if (App.config("TESTS") == 'trigger') or (App.config("TESTS") == 'all'):
-                    for trigger in trigger_tests:
-                        #if patch does not compile, do not run every test
-                        if patch_compiles and all_trigger_pass:
-                            out, err = defects4j_test_one(tmp_dir, trigger)
-                            correctness, patch_err = extract_d4j_result( err, out, current_bug, tokenized_patch, start_time, init_fail_num, failed_test_cases)
-                            if correctness == 'plausible':
-                                passing_trigger += 1
-                                passing_tests.append(trigger)
-                            elif correctness == 'wrong': 
-                                failing_tests.append(trigger)
-                                test_errors.append(err)
-                                all_trigger_pass = False
-                            elif correctness == 'uncompilable':
-                                failing_tests.append(trigger)
-                                test_errors.append(err)
-                                patch_compiles = False
-                                all_trigger_pass = False
-                
-                  
-                if (App.config("TESTS") == 'relevant' or App.config("TESTS") == 'all'):
-                    if patch_compiles:
-                        out, err = defects4j_test_suite(tmp_dir)
-                        failed_test_cases = str(out).split(' - ')[1:]
-                        for i, failed_test_case in enumerate(failed_test_cases):
-                            failed_test_cases[i] = failed_test_case.strip()
-                        rel_fail_num = len(failed_test_cases)
-                        if rel_fail_num > 0:
-                            failing_tests.append(failed_test_cases) 
-                            test_errors.append(err)        
-            
-                shutil.copyfile(backup_file, backup_file.replace('.bak', ''))
-                with open(backup_file.replace('.bak', ''), 'r') as file:
-                    assert clean_file == file.readlines()
-             
-
-            validated_result[key]['patches'].append({
-                'patch': tokenized_patch, 
-                'index': index,
-                'correctness': correctness, 
-                'errors': test_errors, 
-                'total_trigger': len(trigger_tests), 
-                'passing_trigger': passing_trigger,
-                'total_relevant': len(relevant_tests),
-                'failing_relevant': rel_fail_num,
-                'passing_tests': passing_tests,
-                'failing_tests': failing_tests,
-            })
-            
-    write_results_to_file(validated_result, output_dir, current_bug)
+                deadline = missing
+            validated_result[key]['early_stop'] = {
+                'policy': App.config("STOP_POLICY"),
+                'stopped': stopped,
+                # left out because the policy needed no more verdicts
+                'skipped': missing - deadline,
+                # left out because the deadline of the bug was reached
+                'deadline': deadline,
+                'total': len(unique_patches),
+            }
+            if App.config("STOP_POLICY") == 'pass_at_k':
+                # pass@k of the bug is exact for every k of at least the smallest of them
+                validated_result[key]['early_stop']['stop_k'] = list(App.config("STOP_K"))
+            if stopped:
+                print(current_bug, 'Stopped early, skipped', missing - deadline, 'patches')
+    finally:
+        if App.config("TEST_DAEMON"):
+            test_runner.stop_daemons()
+        command_runner.set_deadline(None)
+        utils.release_patch_targets()
+        history.close()
+        release_worker()
+        tracing.finish(bug_span)
+
+    with tracing.span('write-results', bug=current_bug):
+        write_results_to_file(validated_result, output_dir, current_bug)
+    if App.config("WORKSPACE_POOL"):
+        with tracing.span('release-workspace', bug=current_bug):
+            workspace.release_workspace(tmp_dir)
     return validated_result      
+
+
+def is_plausible(record):
+    return record['correctness'] == 'plausible' and record.get('failing_relevant', 0) == 0
+
+
+def early_stop_reached(num_patches, num_plausible):
+    """True once the stopping policy needs no more verdicts of a bug with
+    num_patches unique patches, num_plausible of them known to be plausible"""
+    policy = App.config("STOP_POLICY")
+    if policy == 'first_plausible':
+        return num_plausible >= 1
+    if policy == 'n_plausible':
+        return num_plausible >= App.config("STOP_PLAUSIBLE")
+    if policy == 'pass_at_k':
+        # pass@k is 1 as soon as fewer than k patches are not plausible,
+        # the verdicts still missing can only add plausible patches
+        return all(num_patches - num_plausible < min(k, num_patches) for k in App.config("STOP_K"))
+    return False
+
+
+def group_equivalent_patches(patches):
+    """Unique patches, with their sample multiplicity, and the unique patches
+    grouped by normalized hash, so that patches which only differ in layout
+    or comments are validated once"""
+    unique_patches = {}
+    for tokenized_patch in patches:
+        if tokenized_patch['patch'] not in unique_patches:
+            unique_patches[tokenized_patch['patch']] = dict(tokenized_patch, multiplicity=0)
+        unique_patches[tokenized_patch['patch']]['multiplicity'] += 1
+    groups = {}
+    for tokenized_patch in unique_patches.values():
+        code = tokenized_patch['patch']
+        if App.config("PRESCREEN"):
+            code = prescreen.extract_code(code, App.config("PATCH_GRANULARITY"))
+        tokenized_patch['normalized_hash'] = tokenization.patch_hash(code)
+        groups.setdefault(tokenized_patch['normalized_hash'], []).append(tokenized_patch)
+    return list(unique_patches.values()), groups
+
+
+def get_verdict_mode():
+    """Everything besides bug and patch that a verdict depends on"""
+    runner = 'batch' if App.config("BATCH_TESTS") else 'd4j'
+    if App.config("BATCH_TESTS") and App.config("BATCH_RELEVANT"):
+        runner += '-relevant'
+    if App.config("PRESCREEN"):
+        # the code extracted from the response is applied instead of the response
+        runner += '-prescreen'
+    if App.config("FAIL_FAST"):
+        # failing_tests only go up to the first failure
+        runner += '-failfast'
+    return '|'.join([App.config("TESTS"), App.config("PATCH_GRANULARITY"), runner, get_defects4j_version()])
+
+
+def open_test_history():
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    history_file = App.config("TEST_HISTORY") or os.path.join(current_dir, 'validation-cache', 'test-history.db')
+    os.makedirs(os.path.dirname(os.path.abspath(history_file)), exist_ok=True)
+    return test_history.TestHistory(history_file)
+
+
+def open_verdict_cache():
+    if not App.config("REUSE_VERDICTS"):
+        return None
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    cache_file = App.config("VERDICT_CACHE") or os.path.join(current_dir, 'validation-cache', 'verdicts.db')
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    return verdict_cache.VerdictCache(cache_file)
+
+
+def expand_verdicts(unique_patches, cached_verdicts, new_verdicts):
+    """One record per unique patch, equivalent patches share the verdict of
+    their representative. Patches without a verdict (bug timeout) are left out."""
+    records = []
+    for tokenized_patch in unique_patches:
+        patch_hash = tokenized_patch['normalized_hash']
+        if patch_hash in new_verdicts:
+            verdict = new_verdicts[patch_hash]
+            source = 'validated' if verdict['patch'] == tokenized_patch['patch'] else 'equivalent'
+        elif patch_hash in cached_verdicts:
+            verdict = cached_verdicts[patch_hash]
+            source = 'cache'
+        else:
+            continue
+        record = {field: verdict.get(field) for field in verdict_cache.VERDICT_FIELDS}
+        records.append(dict(
+            {'patch': tokenized_patch['patch'], 'index': tokenized_patch.get('index', '')},
+            **record,
+            multiplicity=tokenized_patch['multiplicity'],
+            normalized_hash=patch_hash,
+            verdict_source=source,
+        ))
+    return records
+
+
+def validate_patch(key, tmp_dir, tokenized_patch, bug_stats):
+    """Apply one patch in tmp_dir, run the selected tests and restore the file"""
+    proj, bug_id = key.split('_')[:2]
+    with tracing.span('patch', bug=proj + '_' + bug_id, patch=tokenized_patch.get('index')) as span:
+        record = test_patch(key, tmp_dir, tokenized_patch, bug_stats)
+        span.status = record['correctness']
+    return record
+
+
+def test_patch(key, tmp_dir, tokenized_patch, bug_stats):
+    proj, bug_id, path, start_loc, end_loc = key.split('_')
+    current_bug = proj + '_' + bug_id
+    standard_exec_time, trigger_tests, relevant_tests, failed_test_cases = bug_stats
+    init_fail_num = len(failed_test_cases)
+
+    index = ""
+    if 'index' in tokenized_patch:
+        index = tokenized_patch['index']
     
+    tokenized_patch = tokenized_patch['patch']
+    code = tokenized_patch
+    if App.config("TESTS") == 'covering' and selected_relevant is not None:
+        relevant_tests = selected_relevant
+
+    if App.config("PRESCREEN") and init_fail_num != 0:
+        # reject patches that can not compile before touching the workspace
+        with tracing.span('prescreen'):
+            code = prescreen.extract_code(tokenized_patch, App.config("PATCH_GRANULARITY"))
+            reason = prescreen.check_patch(code, App.config("PATCH_GRANULARITY"))
+        if reason is not None:
+            print(current_bug, 'Uncompilable patch, pre-screen', reason)
+            return {
+                'patch': tokenized_patch,
+                'index': index,
+                'correctness': 'uncompilable',
+                'uncompilable_reason': reason,
+                'timeout_reason': None,
+                'errors': [],
+                'total_trigger': len(trigger_tests),
+                'passing_trigger': 0,
+                'total_relevant': len(relevant_tests),
+                'failing_relevant': 0,
+                'passing_tests': [],
+                'failing_tests': [],
+            }
+
+    target = utils.get_patch_target(tmp_dir, path)
+    test_errors = []
+    failing_tests = []
+    passing_tests = []
+    correctness = None
+    start_time = time.time()
+    passing_relevant = 0
+    passing_trigger = 0
+    patch_compiles = True
+    all_trigger_pass = True
+    rel_fail_num = 0
+    coverage_audit = None
+    # the step that timed out, see timeout_reason
+    timeout_stage = None
+    if init_fail_num == 0:
+        correctness = 'init-error'
+    else:
+        target.apply(start_loc, end_loc, code, App.config("PATCH_GRANULARITY"))
+        try:
+            run_trigger = App.config("TESTS") in ('trigger', 'all', 'covering')
+            run_relevant = App.config("TESTS") in ('relevant', 'all', 'covering')
+            batched = None
+            if App.config("BATCH_TESTS"):
+                batched = run_tests_batched(tmp_dir, current_bug, trigger_tests, relevant_tests,
+                                            run_trigger, run_relevant and App.config("BATCH_RELEVANT"), start_time,
+                                            standard_exec_time)
+            if batched is not None:
+                correctness = batched['correctness']
+                passing_tests = batched['passing_tests']
+                failing_tests = batched['failing_tests']
+                test_errors = batched['errors']
+                passing_trigger = len(passing_tests)
+                patch_compiles = batched['compiles']
+                timeout_stage = batched['timeout_reason']
+                if batched['relevant_failures'] is not None:
+                    rel_fail_num = len(batched['relevant_failures'])
+                    if rel_fail_num > 0:
+                        failing_tests.append(batched['relevant_failures'])
+                    # relevant classes already ran in the same JVM
+                    run_relevant = False
+            elif run_trigger:
+                ordered_triggers = history.order(current_bug, trigger_tests, test_history.DEFECTS4J) if App.config("FAIL_FAST") else trigger_tests
+                for trigger in ordered_triggers:
+                    #if patch does not compile, do not run every test
+                    if patch_compiles and all_trigger_pass:
+                        test_start = time.time()
+                        with tracing.span('trigger', test=trigger) as span:
+                            out, err = defects4j_test_one(tmp_dir, trigger, tests_timeout(current_bug, standard_exec_time, [trigger],
+                                                                                          test_history.DEFECTS4J))
+                        correctness, patch_err = extract_d4j_result( err, out, current_bug, tokenized_patch, start_time, init_fail_num, failed_test_cases)
+                        span.status = correctness
+                        if correctness in ('plausible', 'wrong'):
+                            history.record(current_bug, trigger, test_history.DEFECTS4J, correctness == 'plausible',
+                                           (time.time() - test_start) * 1000)
+                        if correctness == 'plausible':
+                            passing_trigger += 1
+                            passing_tests.append(trigger)
+                        elif correctness == 'wrong': 
+                            failing_tests.append(trigger)
+                            test_errors.append(err)
+                            all_trigger_pass = False
+                        elif correctness == 'uncompilable':
+                            failing_tests.append(trigger)
+                            test_errors.append(err)
+                            patch_compiles = False
+                            all_trigger_pass = False
+                        elif correctness == 'timeout':
+                            # the verdict stays timeout, the next trigger test must not overwrite it
+                            failing_tests.append(trigger)
+                            timeout_stage = timeout_reason('test')
+                            all_trigger_pass = False
+        
+          
+            if run_relevant:
+                # with FAIL_FAST a failing trigger test already decided the verdict
+                if patch_compiles and not (App.config("FAIL_FAST") and correctness in ('wrong', 'timeout')):
+                    relevant_span = tracing.start('relevant')
+                    if App.config("TESTS") == 'covering':
+                        selected = history.order(current_bug, relevant_tests, test_history.DEFECTS4J) if App.config("FAIL_FAST") else relevant_tests
+                        failed_test_cases, err, timed_out = run_test_classes(tmp_dir, current_bug, selected, App.config("FAIL_FAST"),
+                                                                             standard_exec_time)
+                        if failed_test_cases is None:
+                            # a selected class ran no tests, it must not count as passing
+                            print(current_bug, 'Selected relevant classes did not run, running the relevant suite')
+                            failed_test_cases, err, timed_out = run_relevant_tests(tmp_dir, current_bug, relevant_tests,
+                                                                                   standard_exec_time)
+                    else:
+                        failed_test_cases, err, timed_out = run_relevant_tests(tmp_dir, current_bug, relevant_tests, standard_exec_time)
+                    relevant_span.status = 'timeout' if timed_out else len(failed_test_cases)
+                    tracing.finish(relevant_span)
+                    if timed_out:
+                        # a relevant test that does not finish is not a passing one
+                        print(current_bug, 'Patch Timeout in relevant tests', str(int(time.time() - start_time)) + 's')
+                        correctness = 'timeout'
+                        timeout_stage = timeout_reason('suite')
+                    rel_fail_num = len(failed_test_cases)
+                    if rel_fail_num > 0:
+                        failing_tests.append(failed_test_cases) 
+                        test_errors.append(err)        
+
+            if App.config("TESTS") == 'covering' and correctness == 'plausible' and rel_fail_num == 0 \
+                    and App.config("COVERAGE_AUDIT") > 0 and next(audit_counter) % App.config("COVERAGE_AUDIT") == 0:
+                # the selected tests pass, check whether the full relevant suite does too
+                with tracing.span('audit'):
+                    out, err = defects4j_test_suite(tmp_dir, scaled_timeout(standard_exec_time))
+                missed = parse_failing_tests(out)
+                coverage_audit = {'missed_tests': len(missed)}
+                print(current_bug, 'Coverage audit,', len(missed), 'failing tests missed by the selection')
+                if len(missed) > 0:
+                    rel_fail_num = len(missed)
+                    failing_tests.append(missed)
+                    test_errors.append(err)
+        finally:
+            # the file is rewritten from memory, so it never stays patched
+            target.restore()
+        history.flush()
+     
+
+    record = {
+        'patch': tokenized_patch, 
+        'index': index,
+        'correctness': correctness, 
+        'uncompilable_reason': 'compilation' if correctness == 'uncompilable' else None,
+        'timeout_reason': (timeout_stage or timeout_reason('test')) if correctness == 'timeout' else None,
+        'errors': test_errors, 
+        'total_trigger': len(trigger_tests), 
+        'passing_trigger': passing_trigger,
+        'total_relevant': len(relevant_tests),
+        'failing_relevant': rel_fail_num,
+        'passing_tests': passing_tests,
+        'failing_tests': failing_tests,
+    }
+    if coverage_audit is not None:
+        # summed up per bug, not part of the verdict
+        record['coverage_audit'] = coverage_audit
+    return record
+
+
+def make_working_copy(key, tmp_dir, slot, clean_source):
+    """Extra isolated checkout of the bug for patch worker slot"""
+    proj, bug_id, path = key.split('_')[:3]
+    copy_dir = tmp_dir + '_w' + str(slot)
+    if App.config("WORKSPACE_POOL"):
+        workspace.clone_workspace(prepare_bug_template(proj, bug_id), copy_dir)
+    else:
+        workspace.release_workspace(copy_dir)
+        shutil.copytree(tmp_dir, copy_dir, symlinks=True)
+        # tmp_dir may hold a patch under test while it is copied
+        with open(os.path.join(copy_dir, path), 'wb') as file:
+            file.write(clean_source)
+    return copy_dir
+
+
+def validate_patches_in_parallel(key, tmp_dir, unique_patches, bug_stats, should_stop=None):
+    """Validate the patches of one bug over several working copies
+
+    Slot 0 is tmp_dir and always runs. Every other slot takes an extra token
+    from the global worker budget per patch, so the copies only fan out while
+    other bugs leave workers idle, e.g. at the tail of a run. No patch is
+    started once should_stop is true for the records validated so far.
+    """
+    num_slots = App.config("PATCH_WORKERS")
+    working_copies = {0: tmp_dir}
+    free_slots = list(range(num_slots))
+    running = {}
+    results = [None] * len(unique_patches)
+    clean_source = utils.get_patch_target(tmp_dir, key.split('_')[2]).pristine
+
+    bug_span = tracing.current()
+
+    def run(slot, i, tokenized_patch):
+        with tracing.attach(bug_span):
+            if slot not in working_copies:
+                with tracing.span('working-copy'):
+                    working_copies[slot] = make_working_copy(key, tmp_dir, slot, clean_source)
+            results[i] = validate_patch(key, working_copies[slot], tokenized_patch, bug_stats)
+
+    def collect(done):
+        for future in done:
+            slot, extra_token = running.pop(future)
+            free_slots.append(slot)
+            if extra_token:
+                release_worker()
+            try:
+                future.result()
+            except Exception as e:
+                print(key, 'Patch validation failed', e)
+                traceback.print_exc()
+
+    with ThreadPoolExecutor(max_workers=num_slots) as executor:
+        for i, tokenized_patch in enumerate(unique_patches):
+            if command_runner.past_deadline():
+                break
+            if should_stop is not None and should_stop([result for result in results if result is not None]):
+                break
+            while True:
+                if 0 in free_slots:
+                    slot, extra_token = 0, False
+                    break
+                others = [s for s in free_slots if s != 0]
+                if len(others) > 0 and worker_budget is None:
+                    slot, extra_token = others[0], False
+                    break
+                if len(others) > 0 and acquire_worker(block=False):
+                    slot, extra_token = others[0], True
+                    break
+                # recheck the budget now and then while patches are running
+                done, _ = wait(list(running), timeout=5, return_when=FIRST_COMPLETED)
+                collect(done)
+            free_slots.remove(slot)
+            running[executor.submit(run, slot, i, tokenized_patch)] = (slot, extra_token)
+        collect(wait(list(running)).done)
+
+    for slot, copy_dir in working_copies.items():
+        if slot != 0:
+            workspace.release_workspace(copy_dir)
+    return [result for result in results if result is not None]
+
 
 def write_results_to_file(validated_result, output_dir, current_bug):
     filename = str(current_bug) + '-validated.jsonl'
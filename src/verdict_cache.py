@@ -0,0 +1,64 @@
+import json
+import time
+import sqlite3
+import threading
+
+# fields of a validated patch record that only depend on the normalized patch
+VERDICT_FIELDS = ['correctness', 'uncompilable_reason', 'timeout_reason', 'errors', 'total_trigger', 'passing_trigger',
+                  'total_relevant', 'failing_relevant', 'passing_tests', 'failing_tests']
+
+# verdicts that would come out the same when the patch is validated again
+CACHEABLE_VERDICTS = ('plausible', 'wrong', 'uncompilable')
+
+
+class VerdictCache:
+    """SQLite store of patch verdicts, one row per (bug key, normalized hash, test mode)
+
+    Verdicts do not depend on the model that sampled the patch, so they are
+    shared by runs over different patch files. Several validation processes
+    write to the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS verdicts ('
+            'bug_key TEXT, patch_hash TEXT, mode TEXT, verdict TEXT, created REAL, '
+            'PRIMARY KEY (bug_key, patch_hash, mode))'
+        )
+        self.conn.commit()
+
+    def lookup(self, bug_key, patch_hashes, mode):
+        """Cached verdicts of bug_key by normalized hash"""
+        patch_hashes = list(patch_hashes)
+        hits = {}
+        with self.lock:
+            # stay below the sqlite limit of bound parameters
+            for start in range(0, len(patch_hashes), 500):
+                chunk = patch_hashes[start:start + 500]
+                rows = self.conn.execute(
+                    'SELECT patch_hash, verdict FROM verdicts WHERE bug_key = ? AND mode = ? '
+                    'AND patch_hash IN (' + ','.join('?' * len(chunk)) + ')',
+                    [bug_key, mode] + chunk
+                ).fetchall()
+                hits.update({patch_hash: json.loads(verdict) for patch_hash, verdict in rows})
+        return hits
+
+    def store(self, bug_key, verdicts, mode):
+        rows = []
+        now = time.time()
+        for patch_hash, record in verdicts.items():
+            if record['correctness'] not in CACHEABLE_VERDICTS:
+                continue
+            verdict = {field: record[field] for field in VERDICT_FIELDS if field in record}
+            rows.append((bug_key, patch_hash, mode, json.dumps(verdict), now))
+        if len(rows) == 0:
+            return
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
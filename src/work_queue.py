@@ -0,0 +1,126 @@
+import json
+import time
+import sqlite3
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue:
+    """Durable queue of bug level work items in a SQLite file
+
+    Workers lease the most expensive pending item for lease_seconds and keep
+    the lease with heartbeat. An item whose lease expired, because its
+    worker died or lost the file, is leased again, up to max_attempts times.
+    The file can live on storage shared by several hosts as long as it
+    supports POSIX locks.
+    """
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # autocommit, transactions are opened explicitly
+        self.conn = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            'key TEXT PRIMARY KEY, payload TEXT, cost REAL, state TEXT, attempts INTEGER, '
+            'owner TEXT, lease_expires REAL, result TEXT, error TEXT, updated REAL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS items_state ON items (state, cost)')
+
+    def add(self, items):
+        """Enqueue (key, payload, cost) items, keys already queued are kept as they are"""
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO items (key, payload, cost, state, attempts, updated) '
+                'VALUES (?, ?, ?, ?, 0, ?)',
+                [(key, json.dumps(payload), cost, PENDING, now) for key, payload, cost in items]
+            )
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def lease(self, owner):
+        """(key, payload) of the most expensive item that is pending or whose
+        lease expired, None if there is none"""
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # expired leases go back to pending, or fail after max_attempts
+            self.conn.execute(
+                'UPDATE items SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, '
+                "owner = NULL, error = 'lease expired', updated = ? "
+                'WHERE state = ? AND lease_expires < ?',
+                (self.max_attempts, FAILED, PENDING, now, LEASED, now)
+            )
+            row = self.conn.execute(
+                'SELECT key, payload FROM items WHERE state = ? ORDER BY cost DESC LIMIT 1', (PENDING,)
+            ).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    'UPDATE items SET state = ?, owner = ?, lease_expires = ?, attempts = attempts + 1, '
+                    'updated = ? WHERE key = ?',
+                    (LEASED, owner, now + self.lease_seconds, now, row[0])
+                )
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, key, owner):
+        """Extend the lease, False if owner lost it"""
+        now = time.time()
+        cursor = self.conn.execute(
+            'UPDATE items SET lease_expires = ?, updated = ? WHERE key = ? AND owner = ? AND state = ?',
+            (now + self.lease_seconds, now, key, owner, LEASED)
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, key, owner, result):
+        cursor = self.conn.execute(
+            'UPDATE items SET state = ?, result = ?, error = NULL, updated = ? '
+            'WHERE key = ? AND owner = ? AND state = ?',
+            (DONE, json.dumps(result), time.time(), key, owner, LEASED)
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, key, owner, error):
+        """Give the item back for a retry, or fail it after max_attempts"""
+        self.conn.execute(
+            'UPDATE items SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, '
+            'owner = NULL, error = ?, updated = ? WHERE key = ? AND owner = ? AND state = ?',
+            (self.max_attempts, FAILED, PENDING, str(error), time.time(), key, owner, LEASED)
+        )
+
+    def counts(self):
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        for state, count in self.conn.execute('SELECT state, COUNT(*) FROM items GROUP BY state'):
+            counts[state] = count
+        return counts
+
+    def costs(self):
+        """Estimated cost of the items by state"""
+        return dict(self.conn.execute('SELECT state, COALESCE(SUM(cost), 0) FROM items GROUP BY state').fetchall())
+
+    def results(self):
+        for key, result in self.conn.execute('SELECT key, result FROM items WHERE state = ?', (DONE,)):
+            yield key, json.loads(result)
+
+    def failures(self):
+        return self.conn.execute('SELECT key, error FROM items WHERE state = ?', (FAILED,)).fetchall()
+
+    def unfinished(self):
+        counts = self.counts()
+        return counts[PENDING] + counts[LEASED]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,129 @@
+import os
+import json
+import shutil
+import fcntl
+import subprocess
+from contextlib import contextmanager
+
+# written into a template once it is checked out and compiled
+TEMPLATE_MARKER = '.nl2fix-template.json'
+
+reflink_checked = {}
+
+
+@contextmanager
+def template_lock(template):
+    """Serialize template preparation between worker processes"""
+    os.makedirs(os.path.dirname(template), exist_ok=True)
+    with open(template + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def walk_linked_files(template, copy_entries):
+    """Relative paths of the template files that clones share by hardlink"""
+    for root, dirs, files in os.walk(template):
+        rel_root = os.path.relpath(root, template)
+        if rel_root == '.':
+            dirs[:] = [d for d in dirs if d not in copy_entries]
+            files = [f for f in files if f not in copy_entries]
+        for name in files:
+            yield os.path.normpath(os.path.join(rel_root, name))
+
+
+def seal_template(template, copy_dirs):
+    """Record which entries clones copy and a manifest of the shared files
+
+    Every top level file is copied, defects4j rewrites several of them in
+    place, as well as the top level directories that hold build output.
+    """
+    copy_entries = set(copy_dirs)
+    for name in os.listdir(template):
+        if os.path.isfile(os.path.join(template, name)):
+            copy_entries.add(name)
+    manifest = {}
+    for rel_path in walk_linked_files(template, copy_entries):
+        st = os.lstat(os.path.join(template, rel_path))
+        manifest[rel_path] = [st.st_size, st.st_mtime_ns]
+    with open(os.path.join(template, TEMPLATE_MARKER), 'w') as f:
+        json.dump({'copy': sorted(copy_entries), 'manifest': manifest}, f)
+
+
+def read_marker(template):
+    marker = os.path.join(template, TEMPLATE_MARKER)
+    if not os.path.exists(marker):
+        return None
+    with open(marker, 'r') as f:
+        return json.load(f)
+
+
+def verify_template(template):
+    """True if the template is sealed and none of its shared files changed"""
+    marker = read_marker(template)
+    if marker is None:
+        return False
+    for rel_path, (size, mtime_ns) in marker['manifest'].items():
+        try:
+            st = os.lstat(os.path.join(template, rel_path))
+        except FileNotFoundError:
+            return False
+        if st.st_size != size or st.st_mtime_ns != mtime_ns:
+            print('Template file changed', os.path.join(template, rel_path))
+            return False
+    return True
+
+
+def supports_reflink(template, dest_parent):
+    key = (os.stat(template).st_dev, os.stat(dest_parent).st_dev)
+    if key not in reflink_checked:
+        probe = os.path.join(template, TEMPLATE_MARKER)
+        target = os.path.join(dest_parent, '.reflink-probe')
+        p = subprocess.run(['cp', '--reflink=always', probe, target],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        reflink_checked[key] = p.returncode == 0
+        if os.path.exists(target):
+            os.unlink(target)
+    return reflink_checked[key]
+
+
+def clone_workspace(template, dest):
+    """Create a cheap private copy of a sealed template at dest
+
+    Uses a reflink copy where the file system supports it. Otherwise the
+    source tree is hardlinked, and files are detached with detach_file
+    (or replaced, as patch_utils.PatchTarget does) before they are written.
+    """
+    release_workspace(dest)
+    parent = os.path.dirname(os.path.abspath(dest))
+    os.makedirs(parent, exist_ok=True)
+    if supports_reflink(template, parent):
+        subprocess.run(['cp', '-a', '--reflink=always', template, dest], check=True)
+        return dest
+    marker = read_marker(template)
+    copy_entries = set(marker['copy'])
+    os.makedirs(dest)
+    for name in os.listdir(template):
+        source = os.path.join(template, name)
+        if name in copy_entries:
+            subprocess.run(['cp', '-a', source, dest], check=True)
+        else:
+            subprocess.run(['cp', '-al', source, dest], check=True)
+    return dest
+
+
+def detach_file(workspace, rel_path):
+    """Give a hardlinked file its own inode so writing it leaves the template intact"""
+    file_path = os.path.join(workspace, rel_path)
+    if os.stat(file_path).st_nlink <= 1:
+        return
+    tmp_path = file_path + '.detach'
+    shutil.copy2(file_path, tmp_path)
+    os.replace(tmp_path, file_path)
+
+
+def release_workspace(dest):
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
@@ -0,0 +1,52 @@
+import coverage_map
+
+
+JUNIT3 = '''package org.example;
+
+public class FooTest extends TestCase {
+    public void setUp() {}
+    public void testAdd() { assertEquals(2, 1 + 1); }
+    // public void testCommented() {}
+    /* public void testBlock() {} */
+    public final void testFinal() {}
+    private void testHelper() {}
+    public void testWithArgument(int x) {}
+}
+'''
+
+JUNIT4 = '''package org.example;
+
+public class BarTest {
+    @Before
+    public void init() {}
+
+    @Test
+    public void adds() {}
+
+    @Test(expected = IllegalStateException.class)
+    public void throwsOnEmpty() {}
+
+    @Test @Ignore("slow")
+    void skipped() {}
+}
+'''
+
+
+def write_test(tmp_path, name, code):
+    package_dir = tmp_path / 'org' / 'example'
+    package_dir.mkdir(parents=True, exist_ok=True)
+    (package_dir / (name + '.java')).write_text(code)
+
+
+def test_junit3_methods(tmp_path):
+    write_test(tmp_path, 'FooTest', JUNIT3)
+    assert coverage_map.test_methods(str(tmp_path), 'org.example.FooTest') == ['testAdd', 'testFinal']
+
+
+def test_junit4_methods(tmp_path):
+    write_test(tmp_path, 'BarTest', JUNIT4)
+    assert coverage_map.test_methods(str(tmp_path), 'org.example.BarTest') == ['adds', 'throwsOnEmpty', 'skipped']
+
+
+def test_missing_source(tmp_path):
+    assert coverage_map.test_methods(str(tmp_path), 'org.example.MissingTest') == []
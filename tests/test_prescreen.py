@@ -0,0 +1,50 @@
+import prescreen
+
+
+JAVADOC_METHOD = '''/** Returns <code>null</code> for an empty list */
+public Object first(List l) {
+    return l.isEmpty() ? null : l.get(0);
+}'''
+
+
+def test_extract_code_keeps_valid_response():
+    assert prescreen.extract_code(JAVADOC_METHOD) == JAVADOC_METHOD
+    fenced_comment = '// like ```java x```\nprivate int count = 0;'
+    assert prescreen.extract_code(fenced_comment) == fenced_comment
+
+
+def test_extract_code_from_tags_and_fences():
+    assert prescreen.extract_code('The fix is <code>int x = 1;</code>, it works') == 'int x = 1;'
+    assert prescreen.extract_code('Sure:\n```java\npublic void f() {}\n```\nDone.') == 'public void f() {}\n'
+    # an unclosed tag runs to the end of the response
+    assert prescreen.extract_code('Fix: <code>int y = 2;') == 'int y = 2;'
+    # the longest block that passes is taken
+    response = 'Use <code>a</code> in <code>public int a() { return 1; }</code>'
+    assert prescreen.extract_code(response) == 'public int a() { return 1; }'
+
+
+def test_extract_code_without_valid_block():
+    response = 'I can not fix this <code>{</code>'
+    assert prescreen.extract_code(response) == response
+
+
+def test_check_patch_valid():
+    assert prescreen.check_patch(JAVADOC_METHOD) is None
+    assert prescreen.check_patch('@Override\npublic <T> List<T> of(T... items) throws IOException { return null; }') is None
+    assert prescreen.check_patch('private static final int[] SIZES = {1, 2};\nint count;') is None
+    assert prescreen.check_patch('static class Inner extends Base { void run() {} }') is None
+    assert prescreen.check_patch('Point(int x) { this.x = x; }') is None
+    unit = 'package a.b;\nimport java.util.*;\npublic class C { int x; enum E { A, B; void f() {} } }'
+    assert prescreen.check_patch(unit, 'file') is None
+
+
+def test_check_patch_reasons():
+    assert prescreen.check_patch('   // only a comment\n') == prescreen.EMPTY
+    assert prescreen.check_patch('String s = "open;') == prescreen.UNTERMINATED
+    assert prescreen.check_patch('/* open comment') == prescreen.UNTERMINATED
+    assert prescreen.check_patch('int x = 1; # comment') == prescreen.INVALID_TOKEN
+    assert prescreen.check_patch('void f() { if (x) { }') == prescreen.UNBALANCED
+    assert prescreen.check_patch('void f() { ) }') == prescreen.UNBALANCED
+    assert prescreen.check_patch('Here is the fix: int x = 1;') == prescreen.PARSE_ERROR
+    assert prescreen.check_patch('public class C { int x; }', 'file') is None
+    assert prescreen.check_patch('int x;', 'file') == prescreen.PARSE_ERROR
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+query_model = pytest.importorskip('query_model')
+
+
+class FakeClock:
+    """Monotonic clock that only moves when the limiter sleeps"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class StubClient:
+    """create_response that fails with each queued error before answering"""
+
+    def __init__(self, errors, choices):
+        self.errors = list(errors)
+        self.choices = choices
+        self.calls = 0
+
+    def create_response(self, prompt, buggy_file, n, model_type='edit'):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'choices': self.choices[:n]}
+
+
+def make_limiter(requests_per_minute, tokens_per_minute):
+    clock = FakeClock()
+    limiter = query_model.RateLimiter(
+        requests_per_minute, tokens_per_minute, clock=clock.monotonic, sleep=clock.sleep)
+    return limiter, clock
+
+
+def acquire_times(limiter, clock, costs):
+    async def run():
+        times = []
+        for tokens in costs:
+            await limiter.acquire(tokens)
+            times.append(clock.now)
+        return times
+    return asyncio.run(run())
+
+
+def test_requests_are_paced_after_the_bucket_empties():
+    limiter, clock = make_limiter(2, 100000)
+    assert acquire_times(limiter, clock, [1, 1, 1, 1]) == pytest.approx([0, 0, 30, 60])
+
+
+def test_tokens_are_paced_by_cost():
+    limiter, clock = make_limiter(100, 1000)
+    assert acquire_times(limiter, clock, [600, 600]) == pytest.approx([0, 12])
+
+
+def test_request_above_token_capacity_waits_for_a_full_bucket():
+    limiter, clock = make_limiter(100, 1000)
+    assert acquire_times(limiter, clock, [5000, 5000]) == pytest.approx([0, 60])
+
+
+def test_pause_holds_back_the_next_request():
+    limiter, clock = make_limiter(100, 100000)
+    limiter.pause(7)
+    assert acquire_times(limiter, clock, [1]) == pytest.approx([7])
+
+
+class HeaderError(Exception):
+    def __init__(self, headers):
+        super().__init__('rate limited')
+        self.headers = headers
+
+
+def test_backoff_honors_retry_after(monkeypatch):
+    monkeypatch.setattr(query_model.random, 'uniform', lambda low, high: high)
+    assert query_model.get_backoff_delay(0, HeaderError({'Retry-After': '7'})) == 8
+    assert query_model.get_backoff_delay(3, HeaderError({'retry-after': '2.5'})) == 3.5
+
+
+def test_backoff_is_exponential_and_capped(monkeypatch):
+    from config import App
+    monkeypatch.setitem(App._App__conf, 'MAX_BACKOFF', 10.0)
+    monkeypatch.setattr(query_model.random, 'uniform', lambda low, high: high)
+    delays = [query_model.get_backoff_delay(attempt) for attempt in range(6)]
+    assert delays == [1, 2, 4, 8, 10, 10]
+    # unparsable Retry-After falls back to the exponential delay
+    assert query_model.get_backoff_delay(2, HeaderError({'Retry-After': 'soon'})) == 4
+
+
+def test_query_async_waits_out_retry_after(monkeypatch):
+    from config import App
+    monkeypatch.setitem(App._App__conf, 'NUM_CODEX_RETRIES', 3)
+    monkeypatch.setitem(App._App__conf, 'MAX_NUM_CODEX_CODE_SUGGESTIONS', 10)
+    monkeypatch.setattr(query_model.random, 'uniform', lambda low, high: low)
+    monkeypatch.setattr(query_model, 'estimate_request_tokens', lambda *args: 10)
+    error = query_model.openai.error.RateLimitError('slow down', headers={'Retry-After': '7'})
+    client = StubClient([error], [{'text': 'a'}, {'text': 'b'}])
+    monkeypatch.setattr(query_model, 'create_response', client.create_response)
+    limiter, clock = make_limiter(100, 100000)
+    response, response_len = asyncio.run(
+        query_model.query_codex_async('prompt', 'file', 2, 'edit', limiter))
+    assert response == {'choices': [{'text': 'a'}, {'text': 'b'}]}
+    assert response_len == 2
+    assert client.calls == 2
+    # the retry waits for Retry-After before asking the limiter again
+    assert clock.now == pytest.approx(7)
+    assert limiter.blocked_until == pytest.approx(7)
+
+
+def test_query_async_gives_up_after_retries(monkeypatch):
+    from config import App
+    monkeypatch.setitem(App._App__conf, 'NUM_CODEX_RETRIES', 3)
+    monkeypatch.setitem(App._App__conf, 'MAX_BACKOFF', 60.0)
+    monkeypatch.setattr(query_model.random, 'uniform', lambda low, high: high)
+    monkeypatch.setattr(query_model, 'estimate_request_tokens', lambda *args: 10)
+    client = StubClient([Exception('server error')] * 3, [])
+    monkeypatch.setattr(query_model, 'create_response', client.create_response)
+    limiter, clock = make_limiter(100, 100000)
+    assert asyncio.run(
+        query_model.query_codex_async('prompt', 'file', 1, 'edit', limiter)) == (None, None)
+    assert client.calls == 3
+    assert clock.sleeps == [1, 2, 4]
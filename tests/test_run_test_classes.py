@@ -0,0 +1,86 @@
+import pytest
+
+import test_history
+
+validate_defects4j = pytest.importorskip('validate_defects4j')
+
+
+class FakeDefects4J:
+    """defects4j test -t that only takes <test_class>::<test_method> unless bare_classes"""
+
+    def __init__(self, failing, bare_classes=False):
+        self.failing = failing
+        self.bare_classes = bare_classes
+        self.calls = []
+
+    def test_one(self, project_dir, test, timeout=300):
+        self.calls.append(test)
+        if '::' not in test and not self.bare_classes:
+            return '', 'Wrong format for single test!'
+        failed = [name for name in self.failing if name == test or name.split('::')[0] == test]
+        return 'Failing tests: ' + str(len(failed)) + '\n' + ''.join('  - ' + name + '\n' for name in failed), ''
+
+
+@pytest.fixture
+def defects4j(tmp_path, monkeypatch):
+    from config import App
+    monkeypatch.setitem(App._App__conf, 'TIMEOUT_MULTIPLIER', 5)
+    monkeypatch.setitem(App._App__conf, 'TIMEOUT_FLOOR', 60)
+    history = test_history.TestHistory(str(tmp_path / 'history.db'))
+    monkeypatch.setattr(validate_defects4j, 'history', history)
+    monkeypatch.setattr(validate_defects4j, 'bare_class_tests', None)
+    monkeypatch.setattr(validate_defects4j, 'test_src_dir', 'test')
+    package_dir = tmp_path / 'test' / 'org' / 'example'
+    package_dir.mkdir(parents=True)
+    (package_dir / 'FooTest.java').write_text('public class FooTest { public void testA() {} public void testB() {} }')
+    fake = FakeDefects4J(['org.example.FooTest::testB'])
+    monkeypatch.setattr(validate_defects4j, 'defects4j_test_one', fake.test_one)
+    yield fake
+    history.close()
+
+
+def test_rejected_bare_class_runs_methods(tmp_path, defects4j):
+    failed, err, timed_out = validate_defects4j.run_test_classes(str(tmp_path), 'Lang_1', ['org.example.FooTest'], False, 10)
+    assert failed == ['org.example.FooTest::testB']
+    assert not timed_out
+    assert defects4j.calls == ['org.example.FooTest', 'org.example.FooTest::testA', 'org.example.FooTest::testB']
+    assert validate_defects4j.bare_class_tests is False
+
+
+def test_class_without_methods_is_unknown(tmp_path, defects4j):
+    failed, err, timed_out = validate_defects4j.run_test_classes(str(tmp_path), 'Lang_1', ['org.example.BarTest'], False, 10)
+    assert failed is None
+
+
+def test_probes_do_not_run_methods(tmp_path, defects4j):
+    failed, err, timed_out = validate_defects4j.run_test_classes(str(tmp_path), 'Lang_1', ['org.example.FooTest'], True, 10,
+                                                                 by_method=False)
+    assert failed is None
+    assert defects4j.calls == ['org.example.FooTest']
+
+
+def test_bare_classes(tmp_path, defects4j):
+    defects4j.bare_classes = True
+    failed, err, timed_out = validate_defects4j.run_test_classes(str(tmp_path), 'Lang_1', ['org.example.FooTest'], False, 10)
+    assert failed == ['org.example.FooTest::testB']
+    assert defects4j.calls == ['org.example.FooTest']
+    assert validate_defects4j.bare_class_tests is True
+
+
+def test_no_probes_once_bare_classes_are_rejected(tmp_path, defects4j, monkeypatch):
+    from config import App
+    monkeypatch.setitem(App._App__conf, 'FAIL_FAST', True)
+    history = validate_defects4j.history
+    history.record('Lang_1', 'org.example.FooTest', test_history.DEFECTS4J, False)
+    history.record('Lang_1', 'org.example.BazTest', test_history.DEFECTS4J, False)
+    suite_runs = []
+    monkeypatch.setattr(validate_defects4j, 'defects4j_test_suite',
+                        lambda project_dir, timeout=300: suite_runs.append(project_dir) or ('Failing tests: 0\n', ''))
+    relevant = ['org.example.FooTest', 'org.example.BazTest']
+    failed, err, timed_out = validate_defects4j.run_relevant_tests(str(tmp_path), 'Lang_1', relevant, 10)
+    assert failed == []
+    # the first probe is turned down, the second one is not tried
+    assert defects4j.calls == ['org.example.FooTest']
+    validate_defects4j.run_relevant_tests(str(tmp_path), 'Lang_1', relevant, 10)
+    assert defects4j.calls == ['org.example.FooTest']
+    assert len(suite_runs) == 2
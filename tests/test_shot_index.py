@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+
+import shot_index
+
+
+def clustered(rng, num_rows, dim, clusters, spread):
+    """Unit vectors around a few centers, like embeddings of similar methods"""
+    centers = rng.normal(size=(clusters, dim))
+    vectors = centers[rng.integers(0, clusters, size=num_rows)] + spread * rng.normal(size=(num_rows, dim))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def reference(queries, corpus, keys, k, metric, exclude):
+    """Full cdist, ordered by distance and then corpus row"""
+    distances = cdist(queries, corpus, metric)
+    neighbours = []
+    for i, key in enumerate(exclude):
+        order = [row for row in np.lexsort((np.arange(len(corpus)), distances[i])) if keys[row] != key]
+        neighbours.append([keys[row] for row in order[:k]])
+    return neighbours, distances
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+def test_matches_cdist(metric):
+    rng = np.random.default_rng(0)
+    corpus = clustered(rng, 283, 1536, 8, 0.02)
+    # exact duplicates tie at the k boundary
+    corpus[10] = corpus[20]
+    corpus[11] = corpus[20]
+    keys = ['bug' + str(row) for row in range(len(corpus))]
+    index = shot_index.ShotIndex(corpus, keys, metric=metric, query_block=50, corpus_block=64)
+    for k in (1, 4, 10):
+        neighbours, distances = index.query(corpus, k, exclude=keys)
+        expected, full = reference(corpus, corpus, keys, k, metric, keys)
+        assert neighbours == expected
+        for i in range(len(corpus)):
+            assert np.array_equal(distances[i], full[i, [index.key_to_row[key] for key in expected[i]]])
+
+
+def test_float32_corpus_and_new_queries():
+    rng = np.random.default_rng(1)
+    corpus = clustered(rng, 500, 64, 5, 0.05).astype(np.float32)
+    queries = clustered(rng, 30, 64, 5, 0.05)
+    keys = list(range(len(corpus)))
+    index = shot_index.ShotIndex(corpus, keys, corpus_block=100)
+    neighbours, _ = index.query(queries, 4)
+    expected, _ = reference(queries, corpus.astype(np.float64), keys, 4, 'euclidean', [None] * len(queries))
+    assert neighbours == expected
+
+
+def test_k_past_corpus():
+    corpus = np.eye(3)
+    index = shot_index.ShotIndex(corpus, ['a', 'b', 'c'])
+    neighbours, distances = index.query(corpus[:1], 5, exclude=['a'])
+    assert neighbours == [['b', 'c']]
+    assert len(distances[0]) == 2
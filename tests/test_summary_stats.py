@@ -0,0 +1,74 @@
+import numpy as np
+
+import summary_stats
+
+
+def bug(n, c, early_stop=None):
+    return {'n': n, 'compilable': n, 'c': c, 'early_stop': early_stop, 'coverage_audit': None}
+
+
+def bug_after(plausible, policy=None, stop=None):
+    """Result of validating the patches in order, stopped once stop(validated) holds"""
+    validated = len(plausible)
+    if stop is not None:
+        for i in range(len(plausible)):
+            if stop(plausible[:i]):
+                validated = i
+                break
+    early_stop = None
+    if policy is not None:
+        early_stop = {'policy': policy, 'stopped': validated < len(plausible), 'skipped': len(plausible) - validated,
+                      'deadline': 0, 'total': len(plausible)}
+    return bug(validated, int(sum(plausible[:validated])), early_stop)
+
+
+def test_first_plausible_bounds_pass_at_k():
+    rng = np.random.default_rng(2)
+    ks = [1, 5, 20]
+    full = {}
+    stopped = {}
+    for i in range(300):
+        plausible = rng.random(int(rng.integers(1, 60))) < rng.random() * 0.3
+        full[i] = bug_after(plausible)
+        stopped[i] = bug_after(plausible, 'first_plausible', lambda validated: validated.sum() >= 1)
+    (true, _), _ = summary_stats.summarize(full, ks, False)
+    (lower, upper), _ = summary_stats.summarize(stopped, ks, False)
+    assert np.all(lower <= true + 1e-12)
+    assert np.all(true <= upper + 1e-12)
+    # every bug with a plausible patch still counts, pass@k is not pulled down by leaving them out
+    assert np.all(upper >= true)
+    assert np.all(upper > lower)
+
+
+def test_completed_bugs_have_exact_pass_at_k():
+    bugs = {'a': bug(10, 2), 'b': bug(4, 0, {'policy': 'first_plausible', 'stopped': False, 'skipped': 0})}
+    (lower, upper), intervals = summary_stats.summarize(bugs, [1, 5], False, num_bugs=4, resamples=50)
+    assert np.allclose(lower, upper)
+    assert np.allclose(lower, summary_stats.pass_at_k_matrix([10], [2], [1, 5])[:, 0] / 4)
+    assert np.all(intervals[0] <= intervals[1])
+
+
+def test_pass_at_k_stop_is_exact():
+    # stopping once fewer than k patches can be wrong leaves pass@k at its true value of 1
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        plausible = rng.random(int(rng.integers(1, 40))) < rng.random()
+        k = int(rng.integers(1, 10))
+        total = len(plausible)
+        stop = lambda validated: total - validated.sum() < min(k, total)
+        full = summary_stats.pass_at_k_bounds([bug_after(plausible)], [k, k + 5], False)[0]
+        lower, upper = summary_stats.pass_at_k_bounds([bug_after(plausible, 'pass_at_k', stop)], [k, k + 5], False)
+        assert np.allclose(lower, full)
+        assert np.allclose(upper, full)
+
+
+def test_pass_at_k_matrix_matches_reference():
+    rng = np.random.default_rng(1)
+    n = rng.integers(0, 200, size=3000)
+    c = rng.integers(0, n + 1)
+    ks = [1, 5, 20, 100]
+    matrix = summary_stats.pass_at_k_matrix(n, c, ks)
+    for i, k in enumerate(ks):
+        expected = [summary_stats.get_pass_at_k(int(bug_n), int(bug_c), min(k, int(bug_n))) if bug_n > 0 else 0.0
+                    for bug_n, bug_c in zip(n, c)]
+        assert np.allclose(matrix[i], expected, rtol=0, atol=1e-12)
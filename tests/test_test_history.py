@@ -0,0 +1,101 @@
+import sqlite3
+
+import pytest
+
+import test_history
+
+
+def open_history(tmp_path):
+    return test_history.TestHistory(str(tmp_path / 'history.db'))
+
+
+def test_durations_are_kept_per_kind(tmp_path):
+    history = open_history(tmp_path)
+    # the JVM runner times the test alone, defects4j test -t the whole call
+    history.record('Lang_1', 'FooTest', test_history.JVM, True, 200)
+    history.record('Lang_1', 'FooTest', test_history.DEFECTS4J, True, 40000)
+    history.record('Lang_1', 'FooTest', test_history.DEFECTS4J, True, 50000)
+    assert history.expected_seconds('Lang_1', ['FooTest'], test_history.JVM) == (0.2, [])
+    assert history.expected_seconds('Lang_1', ['FooTest'], test_history.DEFECTS4J) == (45.0, [])
+    history.close()
+
+
+def test_jvm_durations_leave_defects4j_untimed(tmp_path):
+    history = open_history(tmp_path)
+    history.record('Lang_1', 'FooTest', test_history.JVM, True, 200)
+    # outcomes without a duration do not time the test either
+    history.record('Lang_1', 'BarTest', test_history.DEFECTS4J, False)
+    seconds, untimed = history.expected_seconds('Lang_1', ['FooTest', 'BarTest'], test_history.DEFECTS4J)
+    assert seconds == 0
+    assert untimed == ['FooTest', 'BarTest']
+    history.close()
+
+
+def test_history_survives_reopen(tmp_path):
+    history = open_history(tmp_path)
+    history.record('Lang_1', 'FooTest', test_history.DEFECTS4J, True, 30000)
+    history.close()
+    history = open_history(tmp_path)
+    history.record('Lang_1', 'FooTest', test_history.DEFECTS4J, False, 10000)
+    history.close()
+    history = open_history(tmp_path)
+    assert history.expected_seconds('Lang_1', ['FooTest'], test_history.DEFECTS4J) == (20.0, [])
+    assert history.expected_seconds('Lang_1', ['FooTest'], test_history.JVM) == (0, ['FooTest'])
+    history.close()
+
+
+def test_outcomes_of_both_kinds_order_tests(tmp_path):
+    history = open_history(tmp_path)
+    for _ in range(5):
+        history.record('Lang_1', 'FailingTest', test_history.JVM, False, 1000)
+        history.record('Lang_1', 'PassingTest', test_history.JVM, True, 1000)
+    # failures seen with the JVM runner count for defects4j runs, which only know the cost
+    history.record('Lang_1', 'FailingTest', test_history.DEFECTS4J, True, 30000)
+    history.record('Lang_1', 'PassingTest', test_history.DEFECTS4J, True, 30000)
+    tests = ['PassingTest', 'FailingTest']
+    assert history.order('Lang_1', tests, test_history.DEFECTS4J) == ['FailingTest', 'PassingTest']
+    assert history.failed_before('Lang_1', tests, test_history.DEFECTS4J) == ['FailingTest']
+    history.close()
+
+
+def test_order_by_cost_of_kind(tmp_path):
+    history = open_history(tmp_path)
+    history.record('Lang_1', 'SlowTest', test_history.DEFECTS4J, True, 60000)
+    history.record('Lang_1', 'FastTest', test_history.DEFECTS4J, True, 10000)
+    # with the same failure probability the cheaper test runs first
+    history.record('Lang_1', 'SlowTest', test_history.JVM, True, 10)
+    history.record('Lang_1', 'FastTest', test_history.JVM, True, 500)
+    tests = ['SlowTest', 'FastTest']
+    assert history.order('Lang_1', tests, test_history.DEFECTS4J) == ['FastTest', 'SlowTest']
+    assert history.order('Lang_1', tests, test_history.JVM) == ['SlowTest', 'FastTest']
+    history.close()
+
+
+def test_tests_timeout_after_jvm_runs(tmp_path, monkeypatch):
+    validate_defects4j = pytest.importorskip('validate_defects4j')
+    from config import App
+    monkeypatch.setitem(App._App__conf, 'TIMEOUT_MULTIPLIER', 5)
+    monkeypatch.setitem(App._App__conf, 'TIMEOUT_FLOOR', 60)
+    history = open_history(tmp_path)
+    monkeypatch.setattr(validate_defects4j, 'history', history)
+    history.record('Lang_1', 'FooTest', test_history.JVM, True, 200)
+    assert validate_defects4j.tests_timeout('Lang_1', 40, ['FooTest'], test_history.JVM) == 60
+    # a JVM batch says nothing about a defects4j call, which gets the baseline suite time
+    assert validate_defects4j.tests_timeout('Lang_1', 40, ['FooTest'], test_history.DEFECTS4J) == 200
+    history.record('Lang_1', 'FooTest', test_history.DEFECTS4J, True, 30000)
+    assert validate_defects4j.tests_timeout('Lang_1', 40, ['FooTest'], test_history.DEFECTS4J) == 150
+    history.close()
+
+
+def test_old_tests_table_is_dropped(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'history.db'))
+    conn.execute('CREATE TABLE tests (bug TEXT, test TEXT, runs INTEGER, failures INTEGER, timed_runs INTEGER, '
+                 'total_millis REAL, updated REAL, PRIMARY KEY (bug, test))')
+    conn.execute("INSERT INTO tests VALUES ('Lang_1', 'FooTest', 1, 0, 1, 200, 0)")
+    conn.commit()
+    conn.close()
+    history = open_history(tmp_path)
+    tables = [row[0] for row in history.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    assert tables == ['test_runs']
+    assert history.expected_seconds('Lang_1', ['FooTest'], test_history.JVM) == (0, ['FooTest'])
+    history.close()
@@ -0,0 +1,25 @@
+import trace_report
+
+
+def span(id, start, duration, parent=None, tid=1, stage='patch'):
+    return {'id': id, 'parent': parent, 'stage': stage, 'bug': 'Lang_1', 'start': start, 'duration': duration,
+            'pid': 1, 'tid': tid}
+
+
+def test_self_time_of_sequential_children():
+    events = [span('bug', 0, 10, stage='bug'), span('a', 1, 2, 'bug'), span('b', 5, 3, 'bug')]
+    own = trace_report.self_times(events)
+    assert own['bug'] == 5
+    assert own['a'] == 2
+
+
+def test_self_time_of_parallel_children():
+    # patches validated in parallel on other threads overlap within the bug
+    events = [span('bug', 0, 10, stage='bug'), span('a', 2, 6, 'bug', tid=2), span('b', 3, 6, 'bug', tid=3),
+              span('c', 4, 2, 'bug', tid=4)]
+    assert trace_report.self_times(events)['bug'] == 3
+
+
+def test_children_past_the_parent_are_clipped():
+    events = [span('bug', 0, 10, stage='bug'), span('a', 8, 5, 'bug', tid=2)]
+    assert trace_report.self_times(events)['bug'] == 8
@@ -0,0 +1,99 @@
+import time
+
+import work_queue
+from work_queue import WorkQueue
+
+
+def make_queue(tmp_path, lease_seconds=300, max_attempts=3):
+    queue = WorkQueue(str(tmp_path / 'queue.db'), lease_seconds=lease_seconds, max_attempts=max_attempts)
+    queue.add([('Chart_1', {'bug': 1}, 10.0), ('Lang_2', {'bug': 2}, 30.0), ('Math_3', {'bug': 3}, 20.0)])
+    return queue
+
+
+def test_lease_most_expensive_first(tmp_path):
+    queue = make_queue(tmp_path)
+    assert queue.lease('a') == ('Lang_2', {'bug': 2})
+    assert queue.lease('b') == ('Math_3', {'bug': 3})
+    assert queue.lease('c') == ('Chart_1', {'bug': 1})
+    assert queue.lease('d') is None
+    assert queue.counts()[work_queue.LEASED] == 3
+    queue.close()
+
+
+def test_add_keeps_queued_items(tmp_path):
+    queue = make_queue(tmp_path)
+    key, _ = queue.lease('a')
+    queue.add([(key, {'bug': 'again'}, 99.0)])
+    assert queue.counts() == {work_queue.PENDING: 2, work_queue.LEASED: 1, work_queue.DONE: 0, work_queue.FAILED: 0}
+    queue.close()
+
+
+def test_complete_stores_result(tmp_path):
+    queue = make_queue(tmp_path)
+    key, _ = queue.lease('a')
+    # only the owner of the lease completes the item
+    assert not queue.complete(key, 'b', {'patches': []})
+    assert queue.complete(key, 'a', {'patches': [1]})
+    assert list(queue.results()) == [(key, {'patches': [1]})]
+    assert queue.unfinished() == 2
+    queue.close()
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=0.2)
+    key, _ = queue.lease('a')
+    for _ in range(3):
+        time.sleep(0.1)
+        assert queue.heartbeat(key, 'a')
+    assert not queue.heartbeat(key, 'b')
+    # the lease was renewed, so the item is not handed out again
+    assert queue.lease('b')[0] != key
+    queue.close()
+
+
+def test_expired_lease_is_leased_again(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=0.05)
+    key, payload = queue.lease('crashed')
+    time.sleep(0.1)
+    # the other items have expired by now as well, the most expensive comes first again
+    assert queue.lease('b') == (key, payload)
+    # the worker that lost its lease can neither extend nor complete it
+    assert not queue.heartbeat(key, 'crashed')
+    assert not queue.complete(key, 'crashed', {})
+    assert queue.complete(key, 'b', {})
+    queue.close()
+
+
+def test_fail_after_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=3)
+    for attempt in range(3):
+        key, _ = queue.lease('a')
+        assert key == 'Lang_2'
+        queue.fail(key, 'a', 'attempt ' + str(attempt + 1))
+    assert queue.failures() == [('Lang_2', 'attempt 3')]
+    assert queue.counts()[work_queue.FAILED] == 1
+    assert queue.lease('a')[0] == 'Math_3'
+    queue.close()
+
+
+def test_expired_lease_fails_after_max_attempts(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.db'), lease_seconds=0.05, max_attempts=2)
+    queue.add([('Chart_1', {}, 1.0)])
+    for _ in range(2):
+        assert queue.lease('crashed')[0] == 'Chart_1'
+        time.sleep(0.1)
+    assert queue.lease('a') is None
+    assert queue.failures() == [('Chart_1', 'lease expired')]
+    assert queue.unfinished() == 0
+    queue.close()
+
+
+def test_queue_survives_reopen(tmp_path):
+    queue = make_queue(tmp_path)
+    key, _ = queue.lease('a')
+    queue.complete(key, 'a', {'done': True})
+    queue.close()
+    reopened = WorkQueue(str(tmp_path / 'queue.db'))
+    assert dict(reopened.results()) == {key: {'done': True}}
+    assert reopened.counts()[work_queue.PENDING] == 2
+    reopened.close()